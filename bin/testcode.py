@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-'''testcode [options] [action1 [action2...]]
+'''testcode [options] [action1 [action2...]] [results files]
 
 testcode is a simple framework for comparing output from (principally numeric)
 programs to previous output to reveal regression errors or miscompilation.
@@ -14,6 +14,9 @@ Available actions:
   make-benchmarks       create a new set of benchmarks and update the userconfig
                         file with the new benchmark id.  Also forces the tests
                         to be run unless the 'compare' action is also given.
+  merge                 combine the results files written by separate testcode
+                        runs (e.g. of each shard of the tests) and print the
+                        overall status of the tests.
   recheck               compare a set of test outputs and rerun failed tests.
   run                   run a set of tests and compare against the benchmark
                         outputs.  Default action.
@@ -26,7 +29,6 @@ documentation for further details.'''
 # copyright: (c) 2012 James Spencer
 # license: modified BSD; see LICENSE for more details
 
-import glob
 import optparse
 import os
 import re
@@ -49,13 +51,31 @@ import testcode2.config
 import testcode2.util
 import testcode2.compatibility
 import testcode2.exceptions
+import testcode2.affinity
+import testcode2.cache
+import testcode2.compare
+import testcode2.history
+import testcode2.mpmd
+import testcode2.pack
+import testcode2.process
+import testcode2.queues
+import testcode2.scheduler
+import testcode2.shard
 import testcode2.validation
 
+try:
+    import testcode2.async_runner
+    _HAVE_ASYNCIO = True
+except (ImportError, SyntaxError):
+    # python < 3.5.
+    _HAVE_ASYNCIO = False
+
 #--- testcode initialisation ---
 
 def init_tests(userconfig, jobconfig, test_id, reuse_id, executables=None,
         categories=None, nprocs=-1, benchmark=None, userconfig_options=None,
-        jobconfig_options=None):
+        jobconfig_options=None, timeout=None, limit_memory=False,
+        verify_on_node=False, data_cache=None):
     '''Initialise tests from the configuration files and command-line options.
 
 userconfig, executables, test_id and userconfig_options are passed to
@@ -75,6 +95,18 @@ defaults in the configuration files are used.
 benchmark is the benchmark id labelling the set of benchmarks to compare the
 tests too.  If None, the default in userconfig is used.
 
+timeout is the maximum time (in seconds) a job may run for locally.  If set, it
+is used for all tests which do not set a timeout in the configuration files.
+
+If limit_memory is true, the address space of each process in a test run
+locally is limited to the memory required by the test.
+
+If verify_on_node is true, tests run via a queueing system are checked against
+their benchmarks on the compute node at the end of the job.
+
+data_cache is the testcode2.cache.DataCache object used by the tests to store
+data extracted from output files.  If None, data is always extracted.
+
 Returns:
 
 user_options: dictionary containing user options specified in userconfig.
@@ -118,6 +150,27 @@ tests: list of selected tests.
             if test.nprocs > test.max_nprocs:
                 test.nprocs = test.max_nprocs
 
+    # Set time limit...
+    if timeout:
+        for test in tests:
+            if test.timeout is None:
+                test.timeout = timeout
+
+    # Set memory limit...
+    if limit_memory:
+        for test in tests:
+            test.memory_limit = test.memory
+
+    # Check tests on the compute node...
+    if verify_on_node:
+        for test in tests:
+            test.verify_on_node = True
+
+    # Reuse extracted data...
+    if data_cache:
+        for test in tests:
+            test.data_cache = data_cache
+
     # parse selected job categories from command line
     # Remove those tests which weren't run most recently if comparing.
     if categories:
@@ -152,69 +205,239 @@ actions: list of testcode2 actions to run.
     parser = optparse.OptionParser(usage=__doc__)
 
     allowed_actions = ['compare', 'run', 'diff', 'tidy', 'make-benchmarks',
-                       'recheck']
+                       'recheck', 'merge']
 
+    parser.add_option('--array', default=False, action='store_true',
+            help='Submit all tests which use the same submit template as '
+            'a single array job rather than submitting each test separately.  '
+            'Relevant only if --submit is used.  Default: %default.')
     parser.add_option('-b', '--benchmark', help='Set the file ID of the '
             'benchmark files.  Default: specified in the [user] section of the '
             'userconfig file.')
+    parser.add_option('--bind-cores', default=False, action='store_true',
+            help='Bind each test run concurrently on the local machine to its '
+            'own set of cores, keeping each test within as few NUMA nodes as '
+            'possible.  The cores are also available to the run command via '
+            'tc.cpus.  Relevant only to the run and recheck actions if '
+            '--total-processors is used.  Default: %default.')
+    parser.add_option('--cache', action='store_true', default=False,
+            help='Reuse the output of a job which passed previously rather '
+            'than running it again if the executable, input file and settings '
+            'of the job are unchanged.  Changes to other files (e.g. shared '
+            'libraries or data files) or to the environment are not '
+            'detected.  Only relevant to the run and recheck actions when '
+            'running tests locally; never used by the make-benchmarks action.  '
+            'Default: %default.')
+    parser.add_option('--cache-size', type='int', default=1000,
+            help='Set the maximum size (in MB) of the cache of the output of '
+            'jobs which passed (see --cache).  The least recently used '
+            'output is removed once the cache exceeds this size.  Zero '
+            'removes the limit.  Relevant only to the run and recheck '
+            'actions.  Default: %default MB.')
     parser.add_option('-c', '--category', action='append', default=[],
             help='Select the category/group of tests.  Can be specified '
             'multiple times.  Default: use the _default_ category if run is an '
             'action unless make-benchmarks is an action.  All other cases use '
             'the _all_ category by default.  The _default_ category contains '
             'all  tests unless otherwise set in the jobconfig file.')
+    parser.add_option('--data-cache-size', type='int', default=100,
+            help='Set the maximum size (in MB) of the cache of data extracted '
+            'from test and benchmark outputs.  Data is extracted again only '
+            'if the output file or the extraction settings have changed.  '
+            'Zero disables the cache.  Relevant only to the run, recheck and '
+            'compare actions.  Default: %default MB.')
     parser.add_option('-e', '--executable', action='append', default=[],
             help='Set the executable(s) to be used to run the tests.  Can be'
             ' a path or name of an option in the userconfig file, in which'
             ' case all test programs are set to use that value, or in the'
             ' format program_name=value, which affects only the specified'
             ' program.')
+    parser.add_option('--engine', default='threads',
+            choices=('threads', 'asyncio'), help='Set the method used to run '
+            'tests concurrently on the local machine.  Options: threads (one '
+            'thread per running test) and asyncio (a single event loop, which '
+            'scales better to very large numbers of tests and requires python '
+            '3.5 or later).  Relevant only to the run and recheck actions when '
+            'running tests locally.  Default: %default.')
     parser.add_option('-f', '--first-run', action='store_true', default=False,
             dest='first_run', help='Run tests that were not were not run in '
             'the previous testcode run.  Only relevant to the recheck action.  '
             'Default: %default.')
+    parser.add_option('--fail-fast', action='store_const', const=1,
+            dest='max_failures', help='Stop running tests as soon as a job '
+            'fails.  Equivalent to --max-failures=1.')
+    parser.add_option('--hybrid', default=False, action='store_true',
+            help='Run small tests (see --local-max-nprocs and '
+            '--local-max-time) on the local machine whilst submitting the '
+            'other tests to the queueing system.  The number of processors '
+            'used by tests run locally is set by --total-processors.  Tests '
+            'can be forced to run locally or be submitted using the execution '
+            'setting in the config files.  Relevant only if --submit is used.  '
+            'Default: %default.')
     parser.add_option('-i', '--insert', action='store_true', default=False,
             help='Insert the new benchmark into the existing list of benchmarks'
             ' in userconfig rather than overwriting it.  Only relevant to the'
             ' make-benchmarks action.  Default: %default.')
+    parser.add_option('-j', '--jobs', type='int', default=1,
+            help='Set the number of processes used to compare tests to their '
+            'benchmarks, or the number of diffs run at once.  The results are '
+            'printed in the same order regardless, except when running tests, '
+            'where each job is printed once it has been checked.  Relevant '
+            'only to the compare, recheck and diff actions and to the run '
+            'action if --total-processors is used.  Default: %default.')
     parser.add_option('--jobconfig', default='jobconfig', help='Set path to the'
             ' job configuration file.  Default: %default.')
     parser.add_option('--job-option', action='append', dest='job_option',
             default=[], nargs=3, help='Override/add setting to jobconfig.  '
             'Takes three arguments.  Format: section_name option_name value.  '
             'Default: none.')
+    parser.add_option('--limit-memory', default=False, action='store_true',
+            help='Limit the address space of each process in a test run '
+            'locally to the memory set for the test in the config files, so '
+            'that a test which uses more memory than expected fails rather '
+            'than exhausting the memory of the machine.  Default: %default.')
+    parser.add_option('--local-max-nprocs', type='int', default=1,
+            dest='local_max_nprocs', help='Set the maximum number of '
+            'processors used by a test run locally with --hybrid.  Default: '
+            '%default.')
+    parser.add_option('--local-max-time', type='float', default=None,
+            dest='local_max_time', help='Set the maximum run time (in '
+            'seconds), as recorded in previous runs, of a test run locally '
+            'with --hybrid.  Default: no limit.')
+    parser.add_option('--max-failures', type='int', dest='max_failures',
+            default=0, help='Stop running tests once the given number of jobs '
+            'have failed: no more tests are started, running tests are killed '
+            '(or removed from the queue) and all jobs which were not run are '
+            'marked as skipped.  Relevant only to the run and recheck actions.  '
+            'Default: no limit.')
+    parser.add_option('--max-queued-jobs', type='int', dest='max_queued',
+            default=0, help='Set the maximum number of tests submitted to '
+            'the queueing system at once.  A further test is submitted as '
+            'each test finishes.  Relevant only if --submit is used without '
+            '--array or --pack.  Default: no limit.')
+    parser.add_option('--moldable', default=False, action='store_true',
+            help='Let testcode choose the number of processors each parallel '
+            'test is run on, between the min_nprocs and max_nprocs settings '
+            'of the test, to reduce the total time taken when running tests '
+            'concurrently.  Relevant only to the run and recheck actions if '
+            '--total-processors is used.  Default: %default.')
+    parser.add_option('--mpmd', type='int', default=0, dest='mpmd_nprocs',
+            help='Co-launch small parallel tests which use the same parallel '
+            'launcher in a single invocation of the launcher (using the MPMD '
+            'colon syntax of mpirun) which uses at most the given number of '
+            'processors.  All tests in a launch share MPI_COMM_WORLD, so the '
+            'program must split it using MPI_APPNUM.  Relevant only to tests '
+            'run locally if --total-processors is used.  Default: launch '
+            'each test separately.')
     parser.add_option('--older-than', type='int', dest='older_than', default=14,
             help='Set the age (in days) of files to remove.  Only relevant to '
             'the tidy action.  Default: %default days.')
+    parser.add_option('--order', default='config',
+            choices=testcode2.scheduler.ORDERS, help='Set the order in which '
+            'tests are started when running tests concurrently.  Options: '
+            'config (order in the jobconfig file), largest-first (tests using '
+            'the most processors first), smallest-first (tests using the '
+            'fewest processors first) and history (tests which took longest '
+            'to run previously first; tests with no recorded run time are '
+            'assumed to take the average run time).  Smaller tests are always '
+            'started in any idle processors whilst larger tests wait for '
+            'processors to become free.  Relevant only to the run and recheck '
+            'actions.  Default: %default.')
+    parser.add_option('--pack', type='int', default=0, help='Pack tests '
+            'into jobs which use the given number of processors and run the '
+            'tests in each job concurrently, rather than submitting each test '
+            'as a separate job.  Relevant only if --submit is used.  Default: '
+            'submit each test separately.')
     parser.add_option('-p', '--processors', type='int', default=-1,
             dest='nprocs', help='Set the number of processors to run each test '
             'on.  Default: use settings in configuration files.')
     parser.add_option('-q', '--quiet', action='store_const', const=0, 
             dest='verbose', default=1, help='Print only minimal output.  '
             'Default: False.')
+    parser.add_option('--results-file', dest='results_file', default=None,
+            help='Write the status of each job to the given file (in JSON '
+            'format) after running or comparing tests.  Results files can be '
+            'combined using the merge action.  Default: %s if --shard is '
+            'used; no file is written otherwise.'
+            % (testcode2.shard.RESULTS_FILE % ('I', 'N')))
     parser.add_option('-s', '--submit', dest='queue_system', default=None,
             help='Submit tests to a queueing system of the specified type.  '
-            'Only PBS system is currently implemented.  Default: %default.')
+            'Options: PBS and SLURM.  Default: %default.')
+    parser.add_option('--shard', default=None, help='Run only the tests in '
+            'the given shard, in the format I/N, where the selected tests are '
+            'split into N shards (numbered from 1 to N) with approximately the '
+            'same expected cost, given by the number of processors multiplied '
+            'by the number of jobs in each test (or by the run time of each '
+            'test if --shard-history is used).  All shards must use the same '
+            'configuration files.  Default: run all selected tests.')
+    parser.add_option('--shard-history', default=None, help='Balance shards '
+            '(see --shard) using the run times recorded in the given runtime '
+            'history file (e.g. a copy of the %s file written by a previous '
+            'run, placed in the same directory as the userconfig file) rather '
+            'than the number of jobs in each test.  All shards must use the '
+            'same file.  Default: %%default.'
+            % (testcode2.history.HISTORY_FILE,))
     parser.add_option('-t', '--test-id', dest='test_id', help='Set the file ID '
             'of the test outputs.  Default: unique filename based upon date '
             'if running tests and most recent test_id if comparing tests.')
+    parser.add_option('--timeout', type='float', default=None,
+            help='Set the maximum time (in seconds) each job in a test may '
+            'run for.  Jobs which exceed the time limit are killed, along '
+            'with any processes they started, and marked as failed.  Only '
+            'applies to tests which do not set a timeout in the config files '
+            'and to tests run locally.  Default: no time limit.')
+    parser.add_option('--total-memory', dest='tot_memory', default=None,
+            help='Set the total amount of memory (e.g. 64G) available to '
+            'tests run concurrently.  Tests are only started if the memory '
+            'they require (set in the config files) is free.  Relevant only '
+            'if --total-processors is used.  Default: no limit.')
     parser.add_option('--total-processors', type='int', default=-1,
             dest='tot_nprocs', help='Set the total number of processors to use '
             'to run tests concurrently.  Relevant only to the run option.  '
             'Default: run all tests concurrently run if --submit is used; run '
             'tests sequentially otherwise.')
+    parser.add_option('--total-resources', dest='tot_resources', default='',
+            help='Set the amount of each named consumable resource (e.g. '
+            '"license:2 scratch:1") available to tests run concurrently.  '
+            'Tests are only started if the resources they require (set in '
+            'the config files) are free.  Relevant only if --total-processors '
+            'is used.  Default: no limit on any resource.')
     parser.add_option('--userconfig', default='userconfig', help='Set path to '
             'the user configuration file.  Default: %default.')
     parser.add_option('--user-option', action='append', dest='user_option',
             default=[], nargs=3, help='Override/add setting to userconfig.  '
             'Takes three arguments.  Format: section_name option_name value.  '
             'Default: none.')
+    parser.add_option('--verify-on-node', action='store_true', default=False,
+            help='Check tests run via a queueing system against their '
+            'benchmarks on the compute node at the end of each job.  The '
+            'status of each test is written to a small file in the test '
+            'directory, so the output files are not read on the submitting '
+            'machine.  Relevant only to the run and recheck actions with the '
+            '--submit option.  Default: %default.')
+    parser.add_option('--verify-workers', type='int', default=0,
+            dest='verify_workers', help='Set the number of tests which can be '
+            'checked against their benchmarks at the same time when running '
+            'tests concurrently.  Processors are released as soon as a test '
+            'has finished running and do not wait for its output to be '
+            'checked.  Relevant only to the run and recheck actions if '
+            '--total-processors is used.  Default: the same as '
+            '--total-processors.')
     parser.add_option('-v', '--verbose', default=1, action="count", 
             dest='verbose', help='Increase verbosity of output.  Can be '
             'specified multiple times.')
 
     (options, args) = parser.parse_args(args)
 
+    # Any other arguments to the merge action are results files.
+    options.merge_files = []
+    if 'merge' in args:
+        options.merge_files = [arg for arg in args
+                                if arg not in allowed_actions]
+        args = [arg for arg in args if arg in allowed_actions]
+        if not options.merge_files:
+            options.merge_files = [testcode2.shard.RESULTS_FILE % ('*', '*')]
+
     # Default action.
     if not args or ('make-benchmarks' in args and 'compare' not in args
             and 'run' not in args and 'recheck' not in args):
@@ -230,6 +453,18 @@ actions: list of testcode2 actions to run.
         if 'run' in args and 'make-benchmarks' not in args:
             options.category = ['_default_']
 
+    if options.engine == 'asyncio' and not _HAVE_ASYNCIO:
+        print('The asyncio engine requires python 3.5 or later.')
+        sys.exit(1)
+
+    if options.engine == 'asyncio' and options.mpmd_nprocs > 0:
+        print('Tests cannot be co-launched using the asyncio engine.')
+        sys.exit(1)
+
+    if options.bind_cores and not testcode2.affinity.HAVE_AFFINITY:
+        print('Binding tests to cores requires python 3.3 or later on Linux.')
+        sys.exit(1)
+
     test_args = (arg not in allowed_actions for arg in args)
     if testcode2.compatibility.compat_any(test_args):
         print('At least one action is not understood: %s.' % (' '.join(args)))
@@ -277,48 +512,101 @@ actions: list of testcode2 actions to run.
 
 #--- actions ---
 
-def run_tests(tests, verbose=1, cluster_queue=None, tot_nprocs=0):
+def run_tests(tests, verbose=1, cluster_queue=None, tot_nprocs=0,
+              order='config', history=None, engine='threads', verify_workers=0,
+              bind_cores=False, capacities=None, max_failures=0,
+              result_cache=None, array_jobs=False, pack_nprocs=0,
+              max_queued=0, hybrid=False, local_max_nprocs=1,
+              local_max_time=None, mpmd_nprocs=0, moldable=False, jobs=1):
     '''Run tests.
 
 tests: list of tests.
 verbose: level of verbosity in output.
-cluster_queue: name of cluster system to use.  If None, tests are run locally.
-    Currently only PBS is implemented.
+cluster_queue: testcode2.queues.QueueSystem object (or name of the queueing
+    system) to submit tests to.  If None, tests are run locally.
 tot_nprocs: total number of processors available to run tests on.  As many
-    tests (in a LIFO fashion from the tests list) are run at the same time as
-    possible without using more processors than this value.  If less than 1 and
+    tests as possible are run at the same time without using more processors
+    than this value, with smaller tests started in any idle processors whilst
+    larger tests wait for enough processors to become free.  If less than 1 and
     cluster_queue is specified, then all tests are submitted to the cluster at
     the same time.  If less than one and cluster_queue is not set, then
     tot_nprocs is ignored and the tests are run sequentially (default).
+order: order in which tests are started if tot_nprocs is used.  See
+    testcode2.scheduler.Scheduler.
+history: testcode2.history.RuntimeHistory object.  If supplied, the wall time
+    of each job run locally is recorded in and saved to the history.
+engine: method used to run tests concurrently on the local machine: threads
+    (one thread per running test) or asyncio (a single event loop; see
+    testcode2.async_runner).  Tests submitted to a queueing system are always
+    managed using threads.
+verify_workers: number of jobs which can be checked against their benchmarks
+    at the same time if tot_nprocs is used.  Processors are released as soon
+    as a test has finished running and checking its output happens in
+    a separate pool of workers.  If less than 1, tot_nprocs workers are used.
+bind_cores: if true and tot_nprocs is used, each test run locally is bound to
+    its own set of cores (see testcode2.affinity.CorePool).
+capacities: dictionary of the total amount of memory (in bytes) and of each
+    named resource available.  If tot_nprocs is used, tests are only started
+    if the memory and resources they require are free.  See
+    testcode2.scheduler.Scheduler.
+max_failures: if greater than 0, stop once max_failures jobs have failed.
+    Tests which have not been started are not run, running jobs are killed
+    (or removed from the queue) and all jobs not run are marked as skipped.
+result_cache: testcode2.cache.ResultCache object.  If supplied, jobs run
+    locally whose output is in the cache are not run; the cached output is
+    checked against the benchmark instead.
+array_jobs: if true and cluster_queue is specified, all tests with the same
+    submit template are submitted as a single array job (see submit_tests)
+    and tot_nprocs is ignored.
+pack_nprocs: if greater than 0 and cluster_queue is specified, tests are packed
+    into jobs using at most pack_nprocs processors, in which the tests are run
+    concurrently (see submit_tests), and tot_nprocs is ignored.
+max_queued: if greater than 0 and cluster_queue is specified, at most
+    max_queued tests are submitted to the queueing system at once, and
+    a further test is submitted as each test finishes.  Not used if array_jobs
+    or pack_nprocs is set.
+hybrid: if true and cluster_queue is specified, tests which use at most
+    local_max_nprocs processors and are expected to take at most local_max_time
+    seconds (see testcode2.scheduler.run_locally) are run locally using
+    tot_nprocs processors (default: all cores available) whilst the other
+    tests are submitted to cluster_queue.  Both sets of tests are run and
+    checked at the same time.
+local_max_nprocs: maximum number of processors used by a test run locally in
+    hybrid mode.
+local_max_time: maximum expected run time (in seconds) of a test run locally in
+    hybrid mode.  Default: no limit.
+mpmd_nprocs: if greater than 0 and tests are run locally using tot_nprocs,
+    small parallel tests are co-launched using a single invocation of the
+    parallel launcher using at most mpmd_nprocs processors (see
+    testcode2.mpmd.launch_groups).  Requires the threads engine.
+moldable: if true and tot_nprocs is used, the number of processors each
+    parallel test is run on is chosen when it is started, within its
+    min_nprocs and max_nprocs settings (see testcode2.scheduler.Scheduler).
+jobs: if greater than 1 and tot_nprocs is used, jobs are checked against their
+    benchmarks in a pool of jobs processes rather than in the verify_workers
+    threads (see testcode2.scheduler.VerificationPool).
 '''
-    def run_test_worker(semaphore, semaphore_lock, tests, *run_test_args):
-        '''Launch a test after waiting until resources are available to run it.
-
-semaphore: threading.Semaphore object containing the number of cores/processors
-    which can be used concurrently to run tests.
-semaphore.lock: threading.Lock object used to restrict acquiring the semaphore
-    to one thread at a time.
-tests: list of (serialized) tests to run in this thread.
+    def cancel_tests(schedulers):
+        '''Stop running tests as the maximum number of failures is reached.'''
+        not_started = sum(scheduler.cancel() for scheduler in schedulers)
+        if verbose > 0:
+            print('\nMaximum number of failed jobs (%s) reached: %s tests not '
+                  'started and running tests killed.\n'
+                  % (max_failures, not_started))
+        testcode2.process.kill_all()
+        testcode2.queues.cancel_all()
+
+    def run_test_worker(finished, test, *run_test_args):
+        '''Run a test and notify the scheduler once it has finished.
+
+finished: queue to which the test is added once it has finished running.
+test: test to run.
 run_test_args: arguments to pass to test.run_test method.
 '''
-
-        # Ensure that only one test attempts to register resources with the
-        # semaphore at a time.  This restricts running the tests to a LIFO
-        # fashion which is not perfect (we don't attempt to backfill with
-        # smaller tests, for example) but is a reasonable and (most
-        # importantly) simple first-order approach.
-        for test in tests:
-            semaphore_lock.acquire()
-            # test.nprocs is <1 when program is run in serial.
-            nprocs_used = max(1, test.nprocs)
-            for i in range(nprocs_used):
-                semaphore.acquire()
-            semaphore_lock.release()
-
+        try:
             test.run_test(*run_test_args)
-
-            for i in range(nprocs_used):
-                semaphore.release()
+        finally:
+            finished.put(test)
 
     # Check executables actually exist...
     compat = testcode2.compatibility
@@ -334,69 +622,339 @@ run_test_args: arguments to pass to test.run_test method.
             err = 'Executable does not exist: %s.' % (exe)
             raise testcode2.exceptions.TestCodeError(err)
 
-    if tot_nprocs <= 0 and cluster_queue:
+    # Need to serialize tests that run in the same directory with wildcard
+    # patterns in the output file--otherwise we can't figure out which
+    # output file belongs to which test.  We might be able to for some
+    # wildcards, but let's err on the side of caution.
+    wildcards = re.compile('.*(\*|\?|\[.*\]).*')
+    serialized_tests = []
+    test_store = {}
+    for test in tests:
+        if test.output and wildcards.match(test.output):
+            if test.path in test_store:
+                test_store[test.path].append(test)
+            else:
+                test_store[test.path] = [test]
+        else:
+            serialized_tests.append([test])
+    for (key, stests) in test_store.items():
+        if (len(stests) > 1) and verbose > 2:
+            print('Warning: cannot run tests in %s concurrently.' % stests[0].path)
+    serialized_tests += test_store.values()
+
+    # Split tests into those run locally and those submitted to the queueing
+    # system, along with the number of processors available to each.
+    if cluster_queue and hybrid:
+        local_groups = []
+        queue_groups = []
+        for group in serialized_tests:
+            if compat.compat_all(testcode2.scheduler.run_locally(test,
+                    local_max_nprocs, local_max_time, history)
+                    for test in group):
+                local_groups.append(group)
+            else:
+                queue_groups.append(group)
+        if tot_nprocs <= 0:
+            tot_nprocs = len(testcode2.affinity.available_cpus())
+        local_nprocs = tot_nprocs
+        queue_nprocs = 0
+        if verbose > 1:
+            print('Running %s tests locally and submitting %s tests.\n'
+                    % (sum(len(group) for group in local_groups),
+                       sum(len(group) for group in queue_groups)))
+    elif cluster_queue:
+        (local_groups, queue_groups) = ([], serialized_tests)
+        (local_nprocs, queue_nprocs) = (0, tot_nprocs)
+    else:
+        (local_groups, queue_groups) = (serialized_tests, [])
+        (local_nprocs, queue_nprocs) = (tot_nprocs, 0)
+    queue_tests = [test for group in queue_groups for test in group]
+
+    if mpmd_nprocs > 0 and local_nprocs > 0 and local_groups:
+        local_groups = testcode2.mpmd.launch_groups(local_groups,
+                min(mpmd_nprocs, local_nprocs))
+
+    max_running = max_queued
+    if queue_tests and (array_jobs or pack_nprocs > 0):
+        # All tests are submitted at once, so wait for all of them at once.
+        submit_tests(queue_tests, cluster_queue, verbose, array_jobs,
+                     pack_nprocs)
+        queue_nprocs = 0
+        max_running = 0
+
+    if queue_nprocs <= 0 and queue_tests:
         # Running on cluster.  Default to submitting all tests at once.
-        tot_nprocs = sum(test.nprocs for test in tests)
-
-    if tot_nprocs > 0:
-        # Allow at most tot_nprocs cores to be used at once by tests.
-        max_test_nprocs = max(test.nprocs for test in tests)
-        if max_test_nprocs > tot_nprocs:
-            err = ('Number of available cores less than the number required by '
-                   'the largest test: at least %d needed, %d available.'
-                   % (max_test_nprocs, tot_nprocs))
-            raise testcode2.exceptions.TestCodeError(err)
-
-        # Need to serialize tests that run in the same directory with wildcard
-        # patterns in the output file--otherwise we can't figure out which
-        # output file belongs to which test.  We might be able to for some
-        # wildcards, but let's err on the side of caution.
-        wildcards = re.compile('.*(\*|\?|\[.*\]).*')
-        serialized_tests = []
-        test_store = {}
-        for test in tests:
-            if test.output and wildcards.match(test.output):
-                if test.path in test_store:
-                    test_store[test.path].append(test)
-                else:
-                    test_store[test.path] = [test]
+        queue_nprocs = sum(testcode2.scheduler.test_nprocs(test)
+                           for test in queue_tests)
+
+    if local_nprocs > 0 or queue_tests:
+        # Allow at most local_nprocs (queue_nprocs) cores to be used at once
+        # by tests run locally (submitted to the queueing system).
+        for (groups, nprocs) in ((local_groups, local_nprocs),
+                                 (queue_groups, queue_nprocs)):
+            if not groups:
+                continue
+            if moldable:
+                # Run tests too large for the processors available on fewer
+                # processors if allowed.
+                for group in groups:
+                    for test in group:
+                        nprocs_limits = testcode2.scheduler.nprocs_range(test)
+                        nthreads = testcode2.scheduler.test_nthreads(test)
+                        if (testcode2.scheduler.test_nprocs(test) > nprocs
+                                and nprocs_limits and
+                                nprocs_limits[0]*nthreads <= nprocs):
+                            test.nprocs = nprocs//nthreads
+            max_test_nprocs = max(testcode2.scheduler.test_nprocs(test)
+                                  for group in groups for test in group)
+            if max_test_nprocs > nprocs:
+                err = ('Number of available cores less than the number '
+                       'required by the largest test: at least %d needed, %d '
+                       'available.' % (max_test_nprocs, nprocs))
+                raise testcode2.exceptions.TestCodeError(err)
+
+        core_pool = None
+        if bind_cores and local_groups:
+            core_pool = testcode2.affinity.CorePool()
+            if local_nprocs > core_pool.ncpus:
+                err = ('Cannot bind tests to cores: %d processors requested '
+                       'but only %d cores available.'
+                       % (local_nprocs, core_pool.ncpus))
+                raise testcode2.exceptions.TestCodeError(err)
+
+        rundir = os.getcwd()
+        if verify_workers < 1:
+            verify_workers = local_nprocs + queue_nprocs
+        verify_pool = testcode2.scheduler.VerificationPool(verify_workers,
+                                                           jobs)
+        try:
+            if engine == 'asyncio' and not queue_groups:
+                testcode2.async_runner.run_tests(local_groups, local_nprocs,
+                        verify_pool, order, history, verbose, rundir,
+                        core_pool, capacities, max_failures, result_cache,
+                        moldable)
             else:
-                serialized_tests.append([test])
-        for (key, stests) in test_store.items():
-            if (len(stests) > 1) and verbose > 2:
-                print('Warning: cannot run tests in %s concurrently.' % stests[0].path)
-        serialized_tests += test_store.values()
-
-        semaphore = threading.BoundedSemaphore(tot_nprocs)
-        slock = threading.Lock()
-        jobs = [threading.Thread(
-                    target=run_test_worker,
-                    args=(semaphore, slock, test, verbose, cluster_queue,
-                          os.getcwd())
-                                )
-                    for test in serialized_tests]
-        for job in jobs:
-            # daemonise so thread terminates when master dies
-            try:
-                job.setDaemon(True)
-            except AttributeError:
-                job.daemon = True  
-            job.start()
-
-        # We avoid .join() which is blocking making it unresponsive to TERM
-        while threading.activeCount() > 1:
-            time.sleep(0.5)
+                # Each stream of tests is a scheduler and the queueing system
+                # the tests are submitted to (or None to run locally).
+                streams = []
+                if local_groups:
+                    streams.append((testcode2.scheduler.Scheduler(
+                            local_groups, local_nprocs, order, history,
+                            core_pool, capacities, max_failures,
+                            moldable=moldable), None))
+                if queue_groups:
+                    # Memory and resources limit tests run on the local
+                    # machine if there are any.
+                    queue_capacities = capacities
+                    if local_groups:
+                        queue_capacities = None
+                    streams.append((testcode2.scheduler.Scheduler(
+                            queue_groups, queue_nprocs, order, history, None,
+                            queue_capacities, max_failures, max_running,
+                            moldable), cluster_queue))
+                schedulers = [scheduler for (scheduler, queue) in streams]
+                # Scheduler running each test, indexed by id(test).
+                test_schedulers = {}
+                finished = compat.queue.Queue()
+                while not compat.compat_all(scheduler.finished()
+                                            for scheduler in schedulers):
+                    if (not schedulers[0].cancelled and
+                            schedulers[0].failure_limit_reached(
+                                    schedulers[1:])):
+                        cancel_tests(schedulers)
+                    for (scheduler, stream_queue) in streams:
+                        for test in scheduler.dispatch():
+                            test_schedulers[id(test)] = scheduler
+                            job = threading.Thread(
+                                    target=run_test_worker,
+                                    args=(finished, test, verbose,
+                                          stream_queue, rundir, verify_pool,
+                                          result_cache)
+                                                  )
+                            # daemonise so thread terminates when master dies
+                            job.daemon = True
+                            job.start()
+                    # Wait for a test to finish.  Use a timeout rather than
+                    # blocking indefinitely so that we remain responsive to
+                    # TERM.
+                    try:
+                        test = finished.get(True, 0.5)
+                    except compat.queue.Empty:
+                        continue
+                    test_schedulers.pop(id(test)).release(test)
+                    if history:
+                        history.record_test(test)
+            verify_pool.join()
+        finally:
+            if history:
+                history.save()
     else:
         # run straight through, one at a time
-        for test in tests:
-            test.run_test(verbose, cluster_queue, os.getcwd())
+        try:
+            for (ind, test) in enumerate(tests):
+                # Only tests which have already run can have failed.
+                if (max_failures > 0 and
+                        testcode2.scheduler.count_failures(tests[:ind]) >=
+                        max_failures):
+                    for not_run in tests[ind:]:
+                        not_run.skip_remaining_jobs()
+                    if verbose > 0:
+                        print('\nMaximum number of failed jobs (%s) reached: '
+                              '%s tests not started.\n'
+                              % (max_failures, len(tests) - ind))
+                    break
+                test.run_test(verbose, cluster_queue, os.getcwd(),
+                              result_cache=result_cache)
+                if history:
+                    history.record_test(test)
+        finally:
+            if history:
+                history.save()
+
+
+def submit_tests(tests, cluster_queue, verbose=1, array_jobs=False,
+                 pack_nprocs=0):
+    '''Submit tests to a queueing system as array jobs and/or packed jobs.
+
+Only tests with the same submit template are submitted together.  If
+pack_nprocs is greater than 0, tests are packed into groups which use at most
+pack_nprocs processors (see testcode2.pack.pack_tests) and each group is run
+concurrently within a single job.  If array_jobs is true, all jobs using the
+same submit template (i.e. groups of packed tests or, if pack_nprocs is not
+used, individual tests) are submitted as a single array job, where each job in
+the array runs the script listed in a manifest file at the index of the job in
+the array.  The submit files, manifests and scripts are placed in the
+.testcode_jobs.TEST_ID directory in the current working directory.
+
+The job which runs each test is stored in test.queue_job, so test.run_test
+waits for it rather than submitting the test again.  Tests which are not
+packed with other tests are left to be submitted by test.run_test unless
+array_jobs is true.
+
+tests: list of tests.
+cluster_queue: testcode2.queues.QueueSystem object (or name of the queueing
+    system) to submit tests to.
+verbose: level of verbosity in output.
+array_jobs: submit jobs with the same submit template as an array job.
+pack_nprocs: number of processors in each job running packed tests.
+'''
+    def submit(job, job_packs):
+        '''Submit job and set it as the job run by the tests in job_packs.
 
+job_packs: list of (index, tests) tuples, where index is the index of the tests
+    in the array if job is an array job and None otherwise.
+'''
+        try:
+            job.start_job()
+        except testcode2.exceptions.RunError:
+            # Tests are submitted separately instead, which reports the error
+            # for each test.
+            if verbose > 2:
+                print('Failed to submit %s: %s'
+                        % (job.submit_file, sys.exc_info()[1]))
+            return
+        for (index, pack) in job_packs:
+            pack_job = job
+            if index is not None:
+                pack_job = job.task_job(index)
+            for test in pack:
+                test.queue_job = pack_job
+
+    groups = {}
+    test_cmds = {}
+    submissions = []
+    for test in tests:
+        if not test.submit_template:
+            continue
+        try:
+            jobs = [test.job_command(inp, args)
+                    for (inp, args) in test.inputs_args]
+        except testcode2.exceptions.RunError:
+            # Reported when the test is run.
+            continue
+        test_cmds[id(test)] = test.cluster_command([job[0] for job in jobs],
+                                                   [job[1] for job in jobs],
+                                                   verbose)
+        test.move_old_output_files(verbose)
+        key = (test.submit_template, test.test_program.submit_pattern)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(test)
+
+    jobs_dir = os.path.join(os.getcwd(), '.testcode_jobs.%s'
+                            % (tests[0].test_program.test_id,))
+    for (ind, key) in enumerate(sorted(groups)):
+        (template, pattern) = key
+        group_dir = os.path.join(jobs_dir, str(ind))
+        if not os.path.exists(group_dir):
+            os.makedirs(group_dir)
+        if pack_nprocs > 0:
+            packs = testcode2.pack.pack_tests(groups[key], pack_nprocs)
+        else:
+            packs = [[test] for test in groups[key]]
+        # Commands run by the job for each pack and processors used by it.
+        pack_cmds = []
+        job_nprocs = []
+        for (ipack, pack) in enumerate(packs):
+            job_nprocs.append(sum(testcode2.scheduler.test_nprocs(test)
+                                  for test in pack))
+            if len(pack) == 1:
+                pack_cmds.append((pack[0].path, test_cmds[id(pack[0])]))
+            else:
+                manifest = os.path.join(group_dir, 'pack.%s' % (ipack,))
+                testcode2.pack.write_pack(manifest,
+                        [(test.path, testcode2.scheduler.test_nprocs(test),
+                          test_cmds[id(test)]) for test in pack])
+                pack_cmds.append((group_dir,
+                        testcode2.pack.runner_command(manifest,
+                                                      job_nprocs[ipack])))
+        if verbose > 2:
+            print('Submitting %s tests in %s jobs using %s (template submit '
+                  'file) in %s' % (len(groups[key]), len(packs), template,
+                  group_dir))
+        try:
+            if array_jobs:
+                array = testcode2.queues.ClusterArrayJob(group_dir,
+                                                         cluster_queue)
+                array.create_submit_file(pattern, pack_cmds, template,
+                                         max(job_nprocs))
+                submissions.append((array, list(enumerate(packs))))
+            else:
+                for (ipack, pack) in enumerate(packs):
+                    if len(pack) == 1:
+                        continue
+                    job = testcode2.queues.ClusterQueueJob(os.path.join(
+                            group_dir, 'submit.%s' % (ipack,)), cluster_queue)
+                    job.create_submit_file(pattern, pack_cmds[ipack][1],
+                                           template, job_nprocs[ipack])
+                    submissions.append((job, [(None, pack)]))
+        except testcode2.exceptions.RunError:
+            # Tests are submitted separately instead, which reports the error
+            # for each test.
+            if verbose > 2:
+                print('Failed to create submit file: %s' % (sys.exc_info()[1],))
+
+    # Submit jobs concurrently, as each submission can be slow.
+    if testcode2.compatibility.futures and len(submissions) > 1:
+        executor = testcode2.compatibility.futures.ThreadPoolExecutor(
+                testcode2.queues.MAX_CONCURRENT_SUBMISSIONS)
+        futures = [executor.submit(submit, job, job_packs)
+                   for (job, job_packs) in submissions]
+        executor.shutdown(True)
+        for future in futures:
+            future.result()
+    else:
+        for (job, job_packs) in submissions:
+            submit(job, job_packs)
 
-def compare_tests(tests, verbose=1):
+def compare_tests(tests, verbose=1, jobs=1):
     '''Compare tests.
 
 tests: list of tests.
 verbose: level of verbosity in output.
+jobs: number of processes used to compare jobs to their benchmarks (see
+    testcode2.compare.check_jobs).  The results are printed in the same order
+    regardless.
 
 Returns:
 
@@ -405,6 +963,7 @@ number of tests not checked due to test output file not existing.
 
     not_checked = 0
 
+    test_jobs = []
     for test in tests:
         for (inp, args) in test.inputs_args:
             test_file = testcode2.util.testcode_filename(
@@ -412,34 +971,59 @@ number of tests not checked due to test output file not existing.
                     test.test_program.test_id, inp, args
                     )
             test_file = os.path.join(test.path, test_file)
-            if os.path.exists(test_file):
-                test.verify_job(inp, args, verbose, os.getcwd())
-            else:
-                if verbose > 0 and verbose <= 2:
-                    info_line = testcode2.util.info_line(test.path, inp, args, os.getcwd())
-                    print('%sNot checked.' % info_line)
-                if verbose > 1:
-                    print('Skipping comparison.  '
-                          'Test file does not exist: %s.\n' % test_file)
-                not_checked += 1
+            test_jobs.append((test, inp, args, test_file,
+                              os.path.exists(test_file)))
+
+    results = testcode2.compare.check_jobs(
+            [job[:3] for job in test_jobs if job[4]], jobs, verbose)
+    for (test, inp, args, test_file, exists) in test_jobs:
+        if exists:
+            (status, msg) = next(results)
+            test.record_job(inp, args, status, msg, verbose, os.getcwd())
+        else:
+            if verbose > 0 and verbose <= 2:
+                info_line = testcode2.util.info_line(test.path, inp, args, os.getcwd())
+                print('%sNot checked.' % info_line)
+            if verbose > 1:
+                print('Skipping comparison.  '
+                      'Test file does not exist: %s.\n' % test_file)
+            not_checked += 1
 
     return not_checked
 
 def recheck_tests(tests, verbose=1, cluster_queue=None, tot_nprocs=0,
-                  first_run=False):
+                  first_run=False, order='config', history=None,
+                  engine='threads', verify_workers=0, bind_cores=False,
+                  capacities=None, max_failures=0, result_cache=None,
+                  array_jobs=False, pack_nprocs=0, max_queued=0,
+                  hybrid=False, local_max_nprocs=1, local_max_time=None,
+                  mpmd_nprocs=0, moldable=False, jobs=1):
     '''Check tests and re-run any failed/skipped tests.
 
 tests: list of tests.
 verbose: level of verbosity in output.
-cluster_queue: name of cluster system to use.  If None, tests are run locally.
-    Currently only PBS is implemented.
-tot_nprocs: total number of processors available to run tests on.  As many
-    tests (in a LIFO fashion from the tests list) are run at the same time as
-    possible without using more processors than this value.  If less than 1 and
-    cluster_queue is specified, then all tests are submitted to the cluster at
-    the same time.  If less than one and cluster_queue is not set, then
-    tot_nprocs is ignored and the tests are run sequentially (default).
+cluster_queue: queueing system to submit tests to.  See run_tests.
+tot_nprocs: total number of processors available to run tests on.  See
+    run_tests.
 first_run: if true, run tests that were not run in the previous invocation.
+order: order in which tests are started if tot_nprocs is used.  See run_tests.
+history: runtime history of the tests.  See run_tests.
+engine: method used to run tests concurrently.  See run_tests.
+verify_workers: number of jobs checked concurrently.  See run_tests.
+bind_cores: bind tests to cores.  See run_tests.
+capacities: total amount of memory and other resources.  See run_tests.
+max_failures: stop after this many jobs have failed.  See run_tests.
+result_cache: cache of the output of jobs.  See run_tests.
+array_jobs: submit tests as array jobs.  See run_tests.
+pack_nprocs: pack tests into jobs using this many processors.  See run_tests.
+max_queued: maximum number of tests submitted at once.  See run_tests.
+hybrid: run small tests locally and submit the others.  See run_tests.
+local_max_nprocs, local_max_time: limits on tests run locally in hybrid mode.
+    See run_tests.
+mpmd_nprocs: co-launch small parallel tests.  See run_tests.
+moldable: choose the number of processors each test is run on.  See run_tests.
+jobs: number of processes used to compare tests before rerunning them (see
+    compare_tests) and to check the rerun tests (see run_tests).
 
 Returns:
 
@@ -453,7 +1037,7 @@ not_checked: number of tests not checked due to missing test output.
 
     sys.stdout.write('Comparing tests to benchmarks:'+sep)
 
-    not_checked = compare_tests(tests, verbose)
+    not_checked = compare_tests(tests, verbose, jobs)
     end_status(tests, not_checked, verbose, False)
 
     rerun_tests = []
@@ -475,21 +1059,35 @@ not_checked: number of tests not checked due to missing test output.
         print('')
     if rerun_tests:
         sys.stdout.write('Rerunning failed tests:'+sep)
-        run_tests(rerun_tests, verbose, cluster_queue, tot_nprocs)
+        run_tests(rerun_tests, verbose, cluster_queue, tot_nprocs, order,
+                  history, engine, verify_workers, bind_cores, capacities,
+                  max_failures, result_cache, array_jobs, pack_nprocs,
+                  max_queued, hybrid, local_max_nprocs, local_max_time,
+                  mpmd_nprocs, moldable, jobs)
 
     return not_checked
 
-def diff_tests(tests, diff_program, verbose=1):
+def _diff_output(diff_cmd, path):
+    '''Run diff_cmd in path and return its (standard and error) output.'''
+    diff_popen = subprocess.Popen(diff_cmd, shell=True, cwd=path,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
+    return diff_popen.communicate()[0]
+
+def diff_tests(tests, diff_program, verbose=1, jobs=1):
     '''Diff tests.
 
 tests: list of tests.
 diff_program: diff program to use.
 verbose: level of verbosity in output.
+jobs: number of diffs run at once.  If greater than 1, the output of each diff
+    is collected and printed in the same order as when running the diffs one
+    at a time.
 '''
 
+    # (message, diff command, test path) of each job.
+    diffs = []
     for test in tests:
-        cwd = os.getcwd()
-        os.chdir(test.path)
         for (inp, args) in test.inputs_args:
             have_benchmark = True
             try:
@@ -503,21 +1101,42 @@ verbose: level of verbosity in output.
                     testcode2.FILESTEM['test'],
                     test.test_program.test_id, inp, args
                     )
-            if not os.path.exists(test_file):
-                if verbose > 0:
-                    print('Skipping diff with %s in %s: %s does not exist.'
-                            % (benchmark, test.path, test_file))
+            if not os.path.exists(os.path.join(test.path, test_file)):
+                diffs.append(('Skipping diff with %s in %s: %s does not exist.'
+                              % (benchmark, test.path, test_file), None, None))
             elif not have_benchmark:
-                if verbose > 0:
-                    print('Skipping diff with %s. %s' % (test.path, err))
+                diffs.append(('Skipping diff with %s. %s' % (test.path, err),
+                              None, None))
             else:
-                if verbose > 0:
-                    print('Diffing %s and %s in %s.' %
-                            (benchmark, test_file, test.path))
                 diff_cmd = '%s %s %s' % (diff_program, benchmark, test_file)
-                diff_popen = subprocess.Popen(diff_cmd, shell=True)
+                diffs.append(('Diffing %s and %s in %s.' %
+                              (benchmark, test_file, test.path), diff_cmd,
+                              test.path))
+
+    if jobs > 1 and testcode2.compatibility.futures:
+        executor = testcode2.compatibility.futures.ThreadPoolExecutor(jobs)
+        try:
+            outputs = [diff_cmd and executor.submit(_diff_output, diff_cmd,
+                                                    path)
+                       for (msg, diff_cmd, path) in diffs]
+            for ((msg, diff_cmd, path), output) in zip(diffs, outputs):
+                if verbose > 0:
+                    print(msg)
+                if output:
+                    sys.stdout.flush()
+                    getattr(sys.stdout, 'buffer', sys.stdout).write(
+                            output.result())
+                    sys.stdout.flush()
+        finally:
+            executor.shutdown(True)
+    else:
+        for (msg, diff_cmd, path) in diffs:
+            if verbose > 0:
+                print(msg)
+            if diff_cmd:
+                sys.stdout.flush()
+                diff_popen = subprocess.Popen(diff_cmd, shell=True, cwd=path)
                 diff_popen.wait()
-        os.chdir(cwd)
 
 def tidy_tests(tests, ndays):
     '''Tidy up test directories.
@@ -528,7 +1147,7 @@ ndays: test files older than ndays are deleted.
 
     epoch_time = time.time() - 86400*ndays
 
-    test_globs = ['test.out*','test.err*']
+    test_globs = ['test.out*','test.err*', 'test.status*', 'test.verify*']
 
     print(
             'Delete all %s files older than %s days from each job directory?'
@@ -542,17 +1161,16 @@ ndays: test files older than ndays are deleted.
         print('No files deleted.')
     else:
         for test in tests:
-            cwd = os.getcwd()
-            os.chdir(test.path)
             if test.submit_template:
                 file_globs = test_globs + [test.submit_template]
             else:
                 file_globs = test_globs
             for file_glob in file_globs:
-                for test_file in glob.glob(file_glob):
+                for test_file in testcode2.util.glob_in_dir(test.path,
+                                                            file_glob):
+                    test_file = os.path.join(test.path, test_file)
                     if os.stat(test_file)[-2] < epoch_time:
                         os.remove(test_file)
-            os.chdir(cwd)
 
 def make_benchmarks(test_programs, tests, userconfig, copy_files_since,
         insert_id=False):
@@ -769,33 +1387,124 @@ args: command-line arguments passed to testcode2.
                 [action in actions for action in ['compare', 'diff', 'recheck']]
                 )
 
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(userconfig)),
+                             testcode2.cache.CACHE_DIR)
+    data_cache = None
+    if options.data_cache_size > 0:
+        data_cache = testcode2.cache.DataCache(os.path.join(cache_dir,
+                testcode2.cache.DATA_CACHE_DIR),
+                options.data_cache_size*1024*1024)
+
     (user_options, test_programs, tests) = init_tests(userconfig,
             options.jobconfig, options.test_id, reuse_id,
             options.executable, options.category, options.nprocs,
             options.benchmark, options.user_option,
-            options.job_option)
+            options.job_option, options.timeout, options.limit_memory,
+            options.verify_on_node, data_cache)
+
+    capacities = testcode2.config.parse_resources(options.tot_resources)
+    if options.tot_memory:
+        capacities['memory'] = testcode2.config.parse_memory(
+                options.tot_memory)
+
+    # Timings are only needed when running tests.
+    history = None
+    if testcode2.compatibility.compat_any(
+            [action in actions for action in
+                ['run', 'recheck', 'make-benchmarks']]):
+        history = testcode2.history.RuntimeHistory(os.path.join(
+                os.path.dirname(os.path.abspath(userconfig)),
+                testcode2.history.HISTORY_FILE))
+
+    # Benchmarks must be made from the output of the current executable.
+    result_cache = None
+    if options.cache and 'make-benchmarks' not in actions:
+        result_cache = testcode2.cache.ResultCache(cache_dir,
+                max_size=options.cache_size*1024*1024)
+
+    # Paths in results files are relative to the jobconfig directory.
+    jobconfig_dir = os.path.dirname(os.path.abspath(options.jobconfig))
+    shard = None
+    results_file = options.results_file
+    checking = testcode2.compatibility.compat_any(
+            [action in actions for action in ['run', 'recheck', 'compare']])
+    if options.shard:
+        shard = testcode2.shard.parse_shard(options.shard)
+        shard_history = None
+        if options.shard_history:
+            if not os.path.exists(options.shard_history):
+                err = ('Shard history file does not exist: %s.'
+                        % (options.shard_history,))
+                raise testcode2.exceptions.TestCodeError(err)
+            shard_history = testcode2.history.RuntimeHistory(
+                    options.shard_history)
+        tests = testcode2.shard.select_shard(tests, shard[0], shard[1],
+                                             shard_history)
+        if not results_file:
+            results_file = testcode2.shard.RESULTS_FILE % shard
+        if not tests:
+            print('No tests in shard %s/%s.' % shard)
+            if checking:
+                testcode2.shard.write_results(results_file, tests,
+                                              jobconfig_dir, shard)
+            return 0
+
+    cluster_queue = None
+    if options.queue_system:
+        cluster_queue = testcode2.queues.queue_system(options.queue_system,
+                                                      user_options)
 
     ret_val = 0
     if not (len(actions) == 1 and 'tidy' in actions):
         start_status(tests, 'run' in actions, verbose)
     if 'run' in actions:
-        run_tests(tests, verbose, options.queue_system, options.tot_nprocs)
+        run_tests(tests, verbose, cluster_queue, options.tot_nprocs,
+                  options.order, history, options.engine,
+                  options.verify_workers, options.bind_cores,
+                  capacities, options.max_failures, result_cache,
+                  options.array, options.pack, options.max_queued,
+                  options.hybrid, options.local_max_nprocs,
+                  options.local_max_time, options.mpmd_nprocs,
+                  options.moldable, options.jobs)
         ret_val = end_status(tests, 0, verbose)
     if 'recheck' in actions:
-        not_checked = recheck_tests(tests, verbose, options.queue_system,
-                                    options.tot_nprocs, options.first_run)
+        not_checked = recheck_tests(tests, verbose, cluster_queue,
+                                    options.tot_nprocs, options.first_run,
+                                    options.order, history, options.engine,
+                                    options.verify_workers,
+                                    options.bind_cores, capacities,
+                                    options.max_failures, result_cache,
+                                    options.array, options.pack,
+                                    options.max_queued, options.hybrid,
+                                    options.local_max_nprocs,
+                                    options.local_max_time,
+                                    options.mpmd_nprocs, options.moldable,
+                                    options.jobs)
         ret_val = end_status(tests, not_checked, verbose)
     if 'compare' in actions:
-        not_checked = compare_tests(tests, verbose)
+        not_checked = compare_tests(tests, verbose, options.jobs)
+        ret_val = end_status(tests, not_checked, verbose)
+    if results_file and checking:
+        testcode2.shard.write_results(results_file, tests, jobconfig_dir,
+                                      shard)
+    if 'merge' in actions:
+        not_checked = testcode2.shard.merge_results(tests,
+                                                    options.merge_files,
+                                                    jobconfig_dir)
         ret_val = end_status(tests, not_checked, verbose)
     if 'diff' in actions:
-        diff_tests(tests, user_options['diff'], verbose)
+        diff_tests(tests, user_options['diff'], verbose, options.jobs)
     if 'tidy' in actions:
         tidy_tests(tests, options.older_than)
     if 'make-benchmarks' in actions:
         make_benchmarks(test_programs, tests, userconfig, start_time,
                 options.insert)
 
+    if data_cache:
+        data_cache.prune()
+    if result_cache:
+        result_cache.prune()
+
     return ret_val
 
 if __name__ == '__main__':
@@ -8,12 +8,14 @@ A framework for regression testing numerical programs.
 :license: modified BSD; see LICENSE for more details.
 '''
 
-import glob
 import os
 import pipes
+import re
 import shutil
 import subprocess
 import sys
+import threading
+import time
 import warnings
 
 try:
@@ -28,14 +30,21 @@ try:
 except ImportError:
     _HAVE_IMPORTLIB_ = False
 
+import testcode2.affinity as affinity
+import testcode2.coprocess as coprocess
 import testcode2.dir_lock as dir_lock
 import testcode2.exceptions as exceptions
+import testcode2.process as process
 import testcode2.queues  as queues
+import testcode2.scheduler as scheduler
 import testcode2.compatibility as compat
 import testcode2.util as util
 import testcode2.validation as validation
 
-DIR_LOCK = dir_lock.DirLock()
+DIR_LOCKS = dir_lock.DirLocks()
+# Lock held whilst printing the status of a job, so the info line and status
+# of jobs which finish at the same time are not interleaved.
+OUTPUT_LOCK = threading.Lock()
 
 # Do not change!  Bad things will happen...
 _FILESTEM_TUPLE = (
@@ -50,6 +59,16 @@ _FILESTEM_DICT = dict( _FILESTEM_TUPLE )
 # Bad things will happen if tests are run without the default FILESTEM!
 FILESTEM = dict( _FILESTEM_TUPLE )
 
+def _import_extract_fn(extract_fn):
+    '''Import the data extraction function given in the format
+[path] module_name.function_name.'''
+    extract_fn = extract_fn.split()
+    if len(extract_fn) == 2 and extract_fn[0] not in sys.path:
+        sys.path.append(extract_fn[0])
+    (mod, fn) = extract_fn[-1].rsplit('.', 1)
+    mod = importlib.import_module(mod)
+    return mod.__getattribute__(fn)
+
 class TestProgram:
     '''Store and access information about the program being tested.'''
     def __init__(self, name, exe, test_id, benchmark, **kwargs):
@@ -77,6 +96,9 @@ class TestProgram:
         self.extract_program = None
         self.extract_args = ''
         self.extract_fmt = 'table'
+        # Run extract_program for each file (command) or once and send it
+        # requests (server; see testcode2.coprocess)?
+        self.extract_mode = 'command'
         self.skip_cmd_template = 'tc.skip tc.args tc.test'
         self.skip_program = None
         self.skip_args = ''
@@ -97,12 +119,8 @@ class TestProgram:
 
         if self.extract_fn:
             if _HAVE_IMPORTLIB_:
-                self.extract_fn = self.extract_fn.split()
-                if len(self.extract_fn) == 2:
-                    sys.path.append(self.extract_fn[0])
-                (mod, fn) = self.extract_fn[-1].rsplit('.', 1)
-                mod = importlib.import_module(mod)
-                self.extract_fn = mod.__getattribute__(fn)
+                self._extract_fn_spec = self.extract_fn
+                self.extract_fn = _import_extract_fn(self.extract_fn)
             elif self.extract_program:
                 warnings.warn('importlib not available.  Will attempt to '
                               'analyse data via an external script.')
@@ -111,13 +129,73 @@ class TestProgram:
                 raise exceptions.TestCodeError('importlib not available and '
                               'no data extraction program supplied.')
 
+        if self.extract_mode not in ('command', 'server'):
+            err = ('Unknown extract_mode: %s.  Allowed values: command, '
+                   'server.' % (self.extract_mode,))
+            raise exceptions.TestCodeError(err)
+
         # Can we actually extract the data?
         if self.extract_fmt == 'yaml' and not _HAVE_YAML:
             err = 'YAML data format cannot be used: PyYAML is not installed.'
             raise exceptions.TestCodeError(err)
 
-    def run_cmd(self, input_file, args, nprocs=0):
-        '''Create run command.'''
+    def __getstate__(self):
+        # Functions cannot be reliably pickled (the module might not be on the
+        # path), so store the extraction function by name and import it again
+        # when unpickled.
+        state = self.__dict__.copy()
+        if state['extract_fn']:
+            state['extract_fn'] = state['_extract_fn_spec']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.extract_fn:
+            self.extract_fn = _import_extract_fn(self.extract_fn)
+
+    def run_cmd(self, input_file, args, nprocs=0, cpus=None, nthreads=None):
+        '''Create run command.
+
+cpus is the list of CPU cores the job is bound to.  If None, all cores
+available to testcode are used.  nthreads is the number of threads used by
+each process (default: 1).'''
+        cmd = self.run_cmd_template
+        if nprocs > 0 and self.launch_parallel:
+            cmd = '%s %s' % (self.launch_parallel, cmd)
+        return self._fill_cmd_template(cmd, input_file, args, nprocs, cpus,
+                                       nthreads)
+
+    def mpmd_launcher(self):
+        '''Return the parallel launcher (e.g. mpirun) used to run the program
+or None if the program is not run using a launcher which testcode can co-launch
+jobs with.'''
+        if self.launch_parallel and 'tc.nprocs' in self.launch_parallel:
+            return self.launch_parallel.split()[0]
+        else:
+            return None
+
+    def mpmd_context(self, path, input_file, args, nprocs, cpus=None,
+                     nthreads=None):
+        '''Create the application context which runs a job in path as part of
+a multiple program, multiple data (MPMD) launch (see testcode2.mpmd).
+
+The context consists of the options in launch_parallel (i.e. without the
+launcher itself) followed by a shell which runs the program in path.  As every
+process in the job opens the output and error files, they are appended to
+rather than overwritten.'''
+        template = re.sub(r'(?<!>)>(\s*tc\.(output|error))', r'>>\1',
+                          self.run_cmd_template)
+        cmd = self._fill_cmd_template(template, input_file, args, nprocs,
+                                      cpus, nthreads)
+        cmd = 'cd %s && %s' % (pipes.quote(path), cmd)
+        options = ' '.join(self.launch_parallel.split(None, 1)[1:])
+        options = self._fill_cmd_template(options, input_file, args, nprocs,
+                                          cpus, nthreads)
+        return ('%s sh -c %s' % (options, pipes.quote(cmd))).strip()
+
+    def _fill_cmd_template(self, cmd, input_file, args, nprocs=0, cpus=None,
+                           nthreads=None):
+        '''Replace the placeholders in a run command template.'''
         output_file = util.testcode_filename(FILESTEM['test'], self.test_id,
                 input_file, args)
         error_file = util.testcode_filename(FILESTEM['error'], self.test_id,
@@ -128,7 +206,7 @@ class TestProgram:
         output_file = pipes.quote(output_file)
         error_file = pipes.quote(error_file)
 
-        cmd = self.run_cmd_template.replace('tc.program', exe)
+        cmd = cmd.replace('tc.program', exe)
         if type(input_file) is str:
             input_file = pipes.quote(input_file)
             cmd = cmd.replace('tc.input', input_file)
@@ -140,9 +218,12 @@ class TestProgram:
             cmd = cmd.replace('tc.args', '')
         cmd = cmd.replace('tc.output', output_file)
         cmd = cmd.replace('tc.error', error_file)
-        if nprocs > 0 and self.launch_parallel:
-            cmd = '%s %s' % (self.launch_parallel, cmd)
         cmd = cmd.replace('tc.nprocs', str(nprocs))
+        cmd = cmd.replace('tc.nthreads', str(nthreads or 1))
+        if 'tc.cpus' in cmd:
+            if not cpus:
+                cpus = affinity.available_cpus()
+            cmd = cmd.replace('tc.cpus', affinity.format_cpu_list(cpus))
         return cmd
 
     def extract_cmd(self, path, input_file, args):
@@ -165,6 +246,11 @@ class TestProgram:
             bench_cmd = cmd.replace('tc.file', pipes.quote(bench_file))
             return (bench_cmd, test_cmd)
 
+    def server_cmd(self):
+        '''Create command which starts extract_program in server mode.'''
+        return ('%s %s' % (pipes.quote(self.extract_program),
+                           self.extract_args)).strip()
+
     def skip_cmd(self, input_file, args):
         '''Create skip command.'''
         test_file = util.testcode_filename(FILESTEM['test'], self.test_id,
@@ -211,7 +297,34 @@ class Test:
         self.nprocs = 0
         self.min_nprocs = 0
         self.max_nprocs = compat.maxint
+        # Number of (e.g. OpenMP) threads used by each process.  If set,
+        # OMP_NUM_THREADS is set to it when running the test.
+        self.nthreads = None
         self.submit_template = None
+        # Maximum time (in seconds) a job may run for locally.
+        self.timeout = None
+        # CPU cores the test is bound to whilst running (set by the scheduler).
+        self.cpus = None
+        # Memory (in bytes) required by the test.
+        self.memory = None
+        # Limit (in bytes) on the address space of each process in a job run
+        # locally.
+        self.memory_limit = None
+        # Amount of each named consumable resource (e.g. licences) required
+        # by the test.
+        self.resources = {}
+        # Where the test is run in hybrid mode: local, queue or auto (chosen
+        # according to the number of processors and run time of the test).
+        self.execution = 'auto'
+        # Job in a queueing system already submitted to run all jobs in the
+        # test (e.g. as part of an array job).
+        self.queue_job = None
+        # Check jobs run via a queueing system against the benchmark on the
+        # compute node at the end of the job (see testcode2.node)?
+        self.verify_on_node = False
+        # Cache of the data extracted from output files (a
+        # testcode2.cache.DataCache object), if used.
+        self.data_cache = None
         # Run jobs in this concurrently rather than consecutively?
         # Only used when setting tests up in testcode2.config: if true then
         # each pair of input file and arguments are assigned to a different
@@ -230,20 +343,17 @@ class Test:
             self.inputs_args = [('', '')]
 
         self.status = dict( (inp_arg, None) for inp_arg in self.inputs_args )
-
-        # 'Decorate' functions which require a directory lock in order for file
-        # access to be thread-safe.
-        # As we use the in_dir decorator, which requires knowledge of the test
-        # directory (a per-instance property), we cannot use the @decorator
-        # syntactic sugar.  Fortunately we can still modify them at
-        # initialisation time.  Thank you python for closures!
-        self.start_job = DIR_LOCK.in_dir(self.path)(self._start_job)
-        self.move_output_to_test_output = DIR_LOCK.in_dir(self.path)(
-                                               self._move_output_to_test_output)
-        self.move_old_output_files = DIR_LOCK.in_dir(self.path)(
-                                               self._move_old_output_files)
-        self.verify_job = DIR_LOCK.in_dir(self.path)(self._verify_job)
-        self.skip_job = DIR_LOCK.in_dir(self.path)(self._skip_job)
+        # (wall time, return code) of each job run locally.
+        self.run_times = {}
+        # Set (e.g. once too many tests have failed) to stop the test from
+        # running any more jobs.
+        self.cancelled = False
+
+    def __getstate__(self):
+        # The job in the queueing system is only meaningful to this process.
+        state = self.__dict__.copy()
+        state['queue_job'] = None
+        return state
 
     def __hash__(self):
         return hash(self.path)
@@ -254,90 +364,253 @@ class Test:
         else:
             # Compare values we care about...
             cmp_vals = ['test_program', 'path', 'inputs_args', 'output',
-                        'nprocs', 'min_nprocs', 'max_nprocs', 'submit_template',
+                        'nprocs', 'min_nprocs', 'max_nprocs', 'nthreads',
+                        'submit_template',
                         'default_tolerance', 'tolerances', 'status']
             comparison = tuple(getattr(other, cmp_val) == getattr(self, cmp_val) for cmp_val in cmp_vals)
             return compat.compat_all(comparison)
 
-    def run_test(self, verbose=1, cluster_queue=None, rundir=None):
-        '''Run all jobs in test.'''
+    def run_test(self, verbose=1, cluster_queue=None, rundir=None,
+                 verify_pool=None, result_cache=None):
+        '''Run all jobs in test.
+
+If verify_pool (a testcode2.scheduler.VerificationPool object) is supplied,
+then checking jobs against the benchmark is handed over to the pool as soon as
+each job finishes, rather than being performed before the next
+job in the test is started.  Hence run_test may return before all jobs have
+been checked.
+
+If result_cache (a testcode2.cache.ResultCache object) is supplied, then jobs
+run locally whose output is in the cache are not run; instead the cached output
+is checked against the benchmark.  The output of jobs which pass is added to the
+cache.'''
 
         try:
             # Construct tests.
             test_cmds = []
             test_files = []
             for (test_input, test_arg) in self.inputs_args:
-                if (test_input and
-                        not os.path.exists(os.path.join(self.path,test_input))):
-                    err = 'Input file does not exist: %s' % (test_input,)
-                    raise exceptions.RunError(err)
-                test_cmds.append(self.test_program.run_cmd(test_input, test_arg,
-                                                           self.nprocs))
-                test_files.append(util.testcode_filename(FILESTEM['test'],
-                        self.test_program.test_id, test_input, test_arg))
-
-            # Move files matching output pattern out of the way.
-            self.move_old_output_files(verbose)
+                (cmd, test_file) = self.job_command(test_input, test_arg)
+                test_cmds.append(cmd)
+                test_files.append(test_file)
+
+            # Move files matching output pattern out of the way (unless the
+            # test has already been submitted).
+            if not (cluster_queue and self.queue_job):
+                self.move_old_output_files(verbose)
 
             # Run tests one-at-a-time locally or submit job in single submit
             # file to a queueing system.
             if cluster_queue:
-                if self.output:
-                    for (ind, test) in enumerate(test_cmds):
-                        # Don't quote self.output if it contains any wildcards
-                        # (assume the user set it up correctly!)
-                        out = self.output
-                        if not compat.compat_any(wild in self.output for wild in
-                                ['*', '?', '[', '{']):
-                            out = pipes.quote(self.output)
-                        test_cmds[ind] = '%s; mv %s %s' % (test_cmds[ind],
-                                out, pipes.quote(test_files[ind]))
-                test_cmds = ['\n'.join(test_cmds)]
+                test_cmds = [self.cluster_command(test_cmds, test_files,
+                                                  verbose)]
             for (ind, test) in enumerate(test_cmds):
+                if self.cancelled:
+                    break
+                cache_entry = None
+                if result_cache and not cluster_queue:
+                    (test_input, test_arg) = self.inputs_args[ind]
+                    cache_key = result_cache.job_key(self, test_input,
+                                                     test_arg)
+                    if cache_key and self.restore_cached_job(result_cache,
+                            cache_key, test_input, test_arg, test_files[ind],
+                            verbose):
+                        if verify_pool:
+                            verify_pool.verify(self, test_input, test_arg,
+                                               verbose, rundir)
+                        else:
+                            self.verify_job(test_input, test_arg, verbose,
+                                            rundir)
+                        continue
+                    elif cache_key:
+                        cache_entry = (result_cache, cache_key)
+                start_time = time.time()
                 job = self.start_job(test, cluster_queue, verbose)
-                job.wait()
                 # Analyse tests as they finish.
                 if cluster_queue:
+                    job.wait()
+                    if self.cancelled:
+                        break
                     # Did all of them at once.
+                    if self.verify_on_node:
+                        check_job = self.collect_node_job
+                    else:
+                        check_job = self.verify_job
                     for (test_input, test_arg) in self.inputs_args:
-                        self.verify_job(test_input, test_arg, verbose, rundir)
+                        if verify_pool and self.verify_on_node:
+                            verify_pool.submit(check_job, test_input,
+                                               test_arg, verbose, rundir)
+                        elif verify_pool:
+                            verify_pool.verify(self, test_input, test_arg,
+                                               verbose, rundir)
+                        else:
+                            check_job(test_input, test_arg, verbose, rundir)
                 else:
                     # Did one job at a time.
                     (test_input, test_arg) = self.inputs_args[ind]
-                    err = []
-                    if self.output:
-                        try:
-                            self.move_output_to_test_output(test_files[ind])
-                        except exceptions.RunError:
-                            err.append(sys.exc_info()[1])
-                    status = validation.Status()
-                    if job.returncode != 0:
-                        err.insert(0, 'Error running job.  Return code: %i'
-                                        % job.returncode)
-                        (status, msg) = self.skip_job(test_input, test_arg,
-                                                      verbose)
-                    if status.skipped():
-                        self._update_status(status, (test_input, test_arg))
-                        if verbose > 0 and verbose < 3:
-                            sys.stdout.write(
-                                    util.info_line(self.path,
-                                                   test_input, test_arg, rundir)
-                                            )
-                        status.print_status(msg, verbose)
-                    elif err:
-                        # re-raise first error we hit.
-                        raise exceptions.RunError(err[0])
-                    else:
-                        self.verify_job(test_input, test_arg, verbose, rundir)
+                    (returncode, timed_out) = process.wait_job(job,
+                                                               self.timeout)
+                    if self.cancelled:
+                        break
+                    # Time spent waiting in the queue is not meaningful, so
+                    # only record the time taken by local jobs.
+                    self.run_times[(test_input, test_arg)] = (
+                            time.time() - start_time, returncode)
+                    if timed_out:
+                        raise exceptions.RunError(self.timeout_message())
+                    if self.collect_job(test_input, test_arg, test_files[ind],
+                                        returncode, verbose, rundir):
+                        if verify_pool:
+                            verify_pool.verify(self, test_input, test_arg,
+                                               verbose, rundir, cache_entry)
+                        else:
+                            self.verify_job(test_input, test_arg, verbose,
+                                            rundir, cache_entry)
                 sys.stdout.flush()
+            if self.cancelled:
+                # Jobs killed or not run at all.
+                self.skip_remaining_jobs()
         except exceptions.RunError:
-            err = sys.exc_info()[1]
+            self.job_failed(test_input, test_arg, sys.exc_info()[1], verbose,
+                            rundir)
+
+    def cancel(self):
+        '''Stop running jobs in the test.
+
+Jobs in the test which have not yet started are not run and any job running
+when the test is cancelled is ignored (the caller is responsible for killing
+it).  Jobs which are not run are marked as skipped.'''
+        self.cancelled = True
+
+    def skip_remaining_jobs(self):
+        '''Mark all jobs in the test which have not been run as skipped.'''
+        status = validation.Status(name='skipped')
+        for inp_arg in self.inputs_args:
+            if not self.status[inp_arg]:
+                self._update_status(status, inp_arg)
+
+    def restore_cached_job(self, result_cache, cache_key, input_file, args,
+                           test_file, verbose=1):
+        '''Restore the output of a job from result_cache.
+
+Returns True if the job was in the cache.'''
+        error_file = util.testcode_filename(FILESTEM['error'],
+                self.test_program.test_id, input_file, args)
+        if result_cache.restore(cache_key, self.path, test_file, error_file):
             if verbose > 2:
-                err = 'Test(s) in %s failed.\n%s' % (self.path, err)
-            status = validation.Status([False])
-            self._update_status(status, (test_input, test_arg))
+                print('Using cached output for %s in %s\n'
+                        % (test_file, self.path))
+            return True
+        else:
+            return False
+
+    def environment(self):
+        '''Return the environment variables to set when running the test.'''
+        if self.nthreads:
+            return {'OMP_NUM_THREADS': str(self.nthreads)}
+        else:
+            return {}
+
+    def timeout_message(self):
+        '''Return the error message for a job which exceeded self.timeout.'''
+        return ('Job exceeded the time limit of %s seconds and was killed.'
+                    % (self.timeout,))
+
+    def job_command(self, input_file, args):
+        '''Return the command to run a job and the test output filename.
+
+Raises RunError if the input file does not exist.'''
+        if (input_file and
+                not os.path.exists(os.path.join(self.path, input_file))):
+            err = 'Input file does not exist: %s' % (input_file,)
+            raise exceptions.RunError(err)
+        cmd = self.test_program.run_cmd(input_file, args, self.nprocs,
+                                        self.cpus, self.nthreads)
+        test_file = util.testcode_filename(FILESTEM['test'],
+                self.test_program.test_id, input_file, args)
+        return (cmd, test_file)
+
+    def cluster_command(self, test_cmds, test_files, verbose=1):
+        '''Return the commands to run all jobs in a single submit file.
+
+test_cmds, test_files: lists of the command to run each job and of the test
+    output files (see job_command).
+
+If self.verify_on_node is true, the test is written out (see
+testcode2.node.write_payload) and the jobs are checked against the benchmark
+after they have all run.'''
+        if self.output:
+            test_cmds = list(test_cmds)
+            for (ind, test) in enumerate(test_cmds):
+                # Don't quote self.output if it contains any wildcards
+                # (assume the user set it up correctly!)
+                out = self.output
+                if not compat.compat_any(wild in self.output for wild in
+                        ['*', '?', '[', '{']):
+                    out = pipes.quote(self.output)
+                test_cmds[ind] = '%s; mv %s %s' % (test_cmds[ind],
+                        out, pipes.quote(test_files[ind]))
+        if self.nthreads:
+            test_cmds = (['export OMP_NUM_THREADS=%s' % (self.nthreads,)] +
+                         list(test_cmds))
+        if self.verify_on_node:
+            # Not imported at the top of the module, as testcode2.node is run
+            # as a script (python -m testcode2.node), which should not import
+            # itself via testcode2.
+            import testcode2.node as node
+            test_cmds = list(test_cmds) + [node.write_payload(self, verbose)]
+        return '\n'.join(test_cmds)
+
+    def collect_job(self, input_file, args, test_file, returncode, verbose=1,
+                    rundir=None):
+        '''Process a job which has been run locally.
+
+The output is moved to the test output file (if required) and, if the job
+failed, the skip program is run.
+
+Returns True if the job should be checked against the benchmark and False if
+it has been skipped.  Raises RunError if the job failed to run and was not
+skipped.'''
+        err = []
+        if self.output:
+            try:
+                self.move_output_to_test_output(test_file)
+            except exceptions.RunError:
+                err.append(sys.exc_info()[1])
+        status = validation.Status()
+        if returncode != 0:
+            err.insert(0, 'Error running job.  Return code: %i' % returncode)
+            (status, msg) = self.skip_job(input_file, args, verbose)
+        if status.skipped():
+            self._update_status(status, (input_file, args))
+            OUTPUT_LOCK.acquire()
+            try:
+                if verbose > 0 and verbose < 3:
+                    sys.stdout.write(
+                            util.info_line(self.path, input_file, args, rundir)
+                                    )
+                status.print_status(msg, verbose)
+                sys.stdout.flush()
+            finally:
+                OUTPUT_LOCK.release()
+            return False
+        elif err:
+            # re-raise first error we hit.
+            raise exceptions.RunError(err[0])
+        else:
+            return True
+
+    def job_failed(self, input_file, args, err, verbose=1, rundir=None):
+        '''Mark a job which failed to run as failed and all jobs in the test
+which have not yet run as skipped.'''
+        if verbose > 2:
+            err = 'Test(s) in %s failed.\n%s' % (self.path, err)
+        status = validation.Status([False])
+        self._update_status(status, (input_file, args))
+        OUTPUT_LOCK.acquire()
+        try:
             if verbose > 0 and verbose < 3:
-                info_line = util.info_line(self.path, test_input, test_arg, rundir)
+                info_line = util.info_line(self.path, input_file, args, rundir)
                 sys.stdout.write(info_line)
             status.print_status(err, verbose)
             # Shouldn't run remaining tests after such a catastrophic failure.
@@ -357,81 +630,78 @@ class Test:
                                                    test_arg, rundir)
                         sys.stdout.write(info_line)
                     status.print_status(err, verbose)
-                sys.stdout.flush()
-
-    def _start_job(self, cmd, cluster_queue=None, verbose=1):
-        '''Start test running.  Requires directory lock.
-
-IMPORTANT: use self.start_job rather than self._start_job if using multiple
-threads.
-
-Decorated to start_job, which acquires directory lock and enters self.path
-first, during initialisation.'''
-
-        if cluster_queue:
+            sys.stdout.flush()
+        finally:
+            OUTPUT_LOCK.release()
+
+    def start_job(self, cmd, cluster_queue=None, verbose=1):
+        '''Start test running in self.path.'''
+
+        if cluster_queue and self.queue_job:
+            # Already submitted.
+            job = self.queue_job
+            self.queue_job = None
+        elif cluster_queue:
             tp_ptr = self.test_program
             submit_file = '%s.%s' % (os.path.basename(self.submit_template),
                                                                 tp_ptr.test_id)
+            submit_file = os.path.join(self.path, submit_file)
             job = queues.ClusterQueueJob(submit_file, system=cluster_queue)
-            job.create_submit_file(tp_ptr.submit_pattern, cmd,
-                                   self.submit_template)
-            if verbose > 2:
-                print('Submitting tests using %s (template submit file) in %s'
-                           % (self.submit_template, self.path))
-            job.start_job()
+            # Tests in the same directory use the same submit file, so must
+            # not overwrite it before it has been submitted.
+            lock = DIR_LOCKS.get_lock(self.path)
+            lock.acquire()
+            try:
+                job.create_submit_file(tp_ptr.submit_pattern, cmd,
+                                       self.submit_template,
+                                       scheduler.test_nprocs(self))
+                if verbose > 2:
+                    print('Submitting tests using %s (template submit file) '
+                          'in %s' % (self.submit_template, self.path))
+                job.start_job()
+            finally:
+                lock.release()
         else:
-            # Run locally via subprocess.
+            # Run locally via subprocess in a new process group.
             if verbose > 2:
                 print('Running test using %s in %s\n' % (cmd, self.path))
-            try:
-                job = subprocess.Popen(cmd, shell=True)
-            except OSError:
-                # slightly odd syntax in order to be compatible with python 2.5
-                # and python 2.6/3
-                err = 'Execution of test failed: %s' % (sys.exc_info()[1],)
-                raise exceptions.RunError(err)
+            job = process.start_job(cmd, self.path, self.cpus,
+                                    self.memory_limit, self.environment())
 
         # Return either Popen object or ClusterQueueJob object.  Both have
-        # a wait method which returns only once job has finished.
+        # a wait method which returns only once job has finished.  Popen
+        # objects should be waited upon using testcode2.process.wait_job.
         return job
 
-    def _move_output_to_test_output(self, test_files_out):
-        '''Move output to the testcode output file.  Requires directory lock.
+    @DIR_LOCKS.with_path_lock
+    def move_output_to_test_output(self, test_files_out):
+        '''Move output to the testcode output file.  Acquires directory lock.
 
 This is used when a program writes to standard output rather than to STDOUT.
-
-IMPORTANT: use self.move_output_to_test_output rather than
-self._move_output_to_test_output if using multiple threads.
-
-Decorated to move_output_to_test_output, which acquires the directory lock and
-enters self.path.
 '''
         # self.output might be a glob which works with e.g.
         #   mv self.output test_files[ind]
         # if self.output matches only one file.  Reproduce that
         # here so that running tests through the queueing system
         # and running tests locally have the same behaviour.
-        out_files = glob.glob(self.output)
+        out_files = util.glob_in_dir(self.path, self.output)
         if len(out_files) == 1:
-            shutil.move(out_files[0], test_files_out)
+            shutil.move(os.path.join(self.path, out_files[0]),
+                        os.path.join(self.path, test_files_out))
         else:
             err = ('Output pattern (%s) matches %s files (%s).'
                      % (self.output, len(out_files), out_files))
             raise exceptions.RunError(err)
 
-    def _move_old_output_files(self, verbose=1):
-        '''Move output to the testcode output file.  Requires directory lock.
+    @DIR_LOCKS.with_path_lock
+    def move_old_output_files(self, verbose=1):
+        '''Move old files matching the output pattern out of the way.  Acquires
+directory lock.
 
 This is used when a program writes to standard output rather than to STDOUT.
-
-IMPORTANT: use self.move_oold_output_files rather than
-self._move_old_output_files if using multiple threads.
-
-Decorated to move_old_output_files, which acquires the directory lock and
-enters self.path.
 '''
         if self.output:
-            old_out_files = glob.glob(self.output)
+            old_out_files = util.glob_in_dir(self.path, self.output)
             if old_out_files:
                 out_dir = 'test.prev.output.%s' % (self.test_program.test_id)
                 if verbose > 2:
@@ -439,23 +709,32 @@ enters self.path.
                           'pattern: %s.' % self.output)
                     print('WARNING: moving existing output files (%s) to %s.\n'
                           % (', '.join(old_out_files), out_dir))
+                out_dir = os.path.join(self.path, out_dir)
                 if not os.path.exists(out_dir):
                     os.mkdir(out_dir)
                 for out_file in old_out_files:
-                    shutil.move(out_file, out_dir)
+                    shutil.move(os.path.join(self.path, out_file), out_dir)
 
-    def _verify_job(self, input_file, args, verbose=1, rundir=None):
+    def verify_job(self, input_file, args, verbose=1, rundir=None,
+                   cache_entry=None):
         '''Check job against benchmark.
 
-Assume function is executed in self.path.
+If cache_entry, a tuple of a testcode2.cache.ResultCache object and the key of
+the job in the cache, is supplied, then the output of the job is stored in the
+cache if the job passed.'''
+        (status, msg) = self.check_job(input_file, args, verbose)
+        self.record_job(input_file, args, status, msg, verbose, rundir,
+                        cache_entry)
+        return (status, msg)
+
+    def check_job(self, input_file, args, verbose=1):
+        '''Compare the output of a job to the benchmark.
 
-IMPORTANT: use self.verify_job rather than self._verify_job if using multiple
-threads.
+Unlike verify_job, the status of the job is not stored or printed.
 
-Decorated to verify_job, which acquires directory lock and enters self.path
-first, during initialisation.'''
-        # We already have DIR_LOCK, so use _skip_job instead of skip_job.
-        (status, msg) = self._skip_job(input_file, args, verbose)
+Returns (status, msg), where status is a testcode2.validation.Status object and
+msg describes any failure.'''
+        (status, msg) = self.skip_job(input_file, args, verbose)
         try:
             if self.test_program.verify and not status.skipped():
                 (status, msg) = self.verify_job_external(input_file, args,
@@ -492,22 +771,49 @@ first, during initialisation.'''
                 msg = sys.exc_info()[1]
             status = validation.Status([False])
 
-        self._update_status(status, (input_file, args))
-        if verbose > 0 and verbose < 3:
-            info_line = util.info_line(self.path, input_file, args, rundir)
-            sys.stdout.write(info_line)
-        status.print_status(msg, verbose)
-
         return (status, msg)
 
-    def _skip_job(self, input_file, args, verbose=1):
-        '''Run user-supplied command to check if test should be skipped.
+    def collect_node_job(self, input_file, args, verbose=1, rundir=None):
+        '''Record the status of a job checked on the compute node.
+
+The job is checked against the benchmark (see verify_job) if the compute node
+did not write its status (e.g. because the job was killed).'''
+        import testcode2.node as node
+        result = node.read_status(self, input_file, args)
+        if result:
+            (status, msg) = result
+            self.record_job(input_file, args, status, msg, verbose, rundir)
+            return (status, msg)
+        else:
+            return self.verify_job(input_file, args, verbose, rundir)
 
-IMPORTANT: use self.skip_job rather than self._skip_job if using multiple
-threads.
+    def record_job(self, input_file, args, status, msg, verbose=1,
+                   rundir=None, cache_entry=None):
+        '''Store and print the status of a job.
 
-Decorated to skip_job, which acquires directory lock and enters self.path
-first, during initialisation.'''
+If cache_entry is supplied (see verify_job), then the output of the job is
+stored in the cache if the job passed.'''
+        self._update_status(status, (input_file, args))
+        OUTPUT_LOCK.acquire()
+        try:
+            if verbose > 0 and verbose < 3:
+                info_line = util.info_line(self.path, input_file, args, rundir)
+                sys.stdout.write(info_line)
+            status.print_status(msg, verbose)
+            sys.stdout.flush()
+        finally:
+            OUTPUT_LOCK.release()
+
+        if cache_entry and status.passed():
+            (result_cache, cache_key) = cache_entry
+            result_cache.store(cache_key, self.path,
+                    util.testcode_filename(FILESTEM['test'],
+                            self.test_program.test_id, input_file, args),
+                    util.testcode_filename(FILESTEM['error'],
+                            self.test_program.test_id, input_file, args))
+
+    def skip_job(self, input_file, args, verbose=1):
+        '''Run user-supplied command to check if test should be skipped.'''
         status = validation.Status()
         if self.test_program.skip_program:
             cmd = self.test_program.skip_cmd(input_file, args)
@@ -515,7 +821,7 @@ first, during initialisation.'''
                 if verbose > 2:
                     print('Testing whether to skip test using %s in %s.' %
                             (cmd, self.path))
-                skip_popen = subprocess.Popen(cmd, shell=True,
+                skip_popen = subprocess.Popen(cmd, shell=True, cwd=self.path,
                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                 skip_popen.wait()
                 if skip_popen.returncode == 0:
@@ -529,27 +835,40 @@ first, during initialisation.'''
         return (status, '')
 
     def verify_job_external(self, input_file, args, verbose=1):
-        '''Run user-supplied verifier script.
-
-Assume function is executed in self.path.'''
-        verify_cmd, = self.test_program.extract_cmd(self.path, input_file, args)
-        try:
+        '''Run user-supplied verifier script in self.path.'''
+        tp_ptr = self.test_program
+        if tp_ptr.extract_mode == 'server':
+            files = [util.testcode_filename(FILESTEM['test'], tp_ptr.test_id,
+                             input_file, args),
+                     tp_ptr.select_benchmark_file(self.path, input_file, args)]
+            files = [os.path.abspath(os.path.join(self.path, vfile))
+                     for vfile in files]
             if verbose > 2:
-                print('Analysing test using %s in %s.' %
-                        (verify_cmd, self.path))
-            verify_popen = subprocess.Popen(verify_cmd, shell=True,
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            verify_popen.wait()
-        except OSError:
-            # slightly odd syntax in order to be compatible with python 2.5
-            # and python 2.6/3
-            err = 'Analysis of test failed: %s' % (sys.exc_info()[1],)
-            raise exceptions.AnalysisError(err)
-        output = verify_popen.communicate()[0].decode('utf-8')
+                print('Analysing test using %s (server) on files %s.' %
+                        (tp_ptr.server_cmd(), ' and '.join(files)))
+            (returncode, output) = coprocess.request(tp_ptr.server_cmd(),
+                                                     files)
+        else:
+            verify_cmd, = tp_ptr.extract_cmd(self.path, input_file, args)
+            try:
+                if verbose > 2:
+                    print('Analysing test using %s in %s.' %
+                            (verify_cmd, self.path))
+                verify_popen = subprocess.Popen(verify_cmd, shell=True,
+                        cwd=self.path, stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
+                verify_popen.wait()
+            except OSError:
+                # slightly odd syntax in order to be compatible with python 2.5
+                # and python 2.6/3
+                err = 'Analysis of test failed: %s' % (sys.exc_info()[1],)
+                raise exceptions.AnalysisError(err)
+            output = verify_popen.communicate()[0].decode('utf-8')
+            returncode = verify_popen.returncode
         if verbose < 2:
             # Suppress output.  (hackhack)
             output = ''
-        if verify_popen.returncode == 0:
+        if returncode == 0:
             return (validation.Status([True]), output)
         else:
             return (validation.Status([False]), output)
@@ -557,75 +876,145 @@ Assume function is executed in self.path.'''
     def extract_data(self, input_file, args, verbose=1):
         '''Extract data from output file.
 
-Assume function is executed in self.path.'''
+The data extracted from each file is taken from data_cache, if set and the file
+is unchanged since the data was stored.  If an external data extraction script
+is used, data is extracted from the benchmark and test outputs concurrently.'''
         tp_ptr = self.test_program
         data_files = [
                       tp_ptr.select_benchmark_file(self.path, input_file, args),
                       util.testcode_filename(FILESTEM['test'],
                       tp_ptr.test_id, input_file, args),
                      ]
-        if tp_ptr.data_tag:
-            # Using internal data extraction function.
-            if verbose > 2:
-                print('Analysing output using data_tag %s in %s on files %s.' %
-                        (tp_ptr.data_tag, self.path, ' and '.join(data_files)))
-            outputs = [util.extract_tagged_data(tp_ptr.data_tag, dfile)
-                    for dfile in data_files]
-        elif tp_ptr.extract_fn:
-            if verbose > 2:
-                print('Analysing output using function %s in %s on files %s.' %
-                        (tp_ptr.extract_fn.__name__, self.path,
-                         ' and '.join(data_files)))
-            outputs = [tp_ptr.extract_fn(dfile) for dfile in data_files]
-        else:
+
+        outputs = []
+        cache_keys = []
+        for dfile in data_files:
+            data = None
+            cache_key = None
+            if self.data_cache:
+                cache_key = self.data_cache.data_key(tp_ptr,
+                        os.path.join(self.path, dfile))
+            if cache_key:
+                data = self.data_cache.load(cache_key)
+                if data is not None:
+                    if verbose > 2:
+                        print('Using cached data from %s in %s.' %
+                                (dfile, self.path))
+                    # Already stored.
+                    cache_key = None
+            outputs.append(data)
+            cache_keys.append(cache_key)
+
+        extract = [ind for ind in range(len(data_files))
+                   if outputs[ind] is None]
+        if tp_ptr.data_tag or tp_ptr.extract_fn:
+            for ind in extract:
+                outputs[ind] = self._extract_internal(data_files[ind], verbose)
+        elif extract and tp_ptr.extract_mode == 'server':
+            # Using a long-lived external data extraction script.
+            for ind in extract:
+                outputs[ind] = self._extract_server(data_files[ind], verbose)
+        elif extract:
             # Using external data extraction script.
             # Get extraction commands.
             extract_cmds = tp_ptr.extract_cmd(self.path, input_file, args)
+            data = self._extract_external([extract_cmds[ind]
+                                           for ind in extract], verbose)
+            for (ind, ind_data) in zip(extract, data):
+                outputs[ind] = ind_data
 
-            # Extract data.
-            outputs = []
-            for cmd in extract_cmds:
-                try:
-                    if verbose > 2:
-                        print('Analysing output using %s in %s.' %
-                                (cmd, self.path))
-                    extract_popen = subprocess.Popen(cmd, shell=True,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    extract_popen.wait()
-                except OSError:
-                    # slightly odd syntax in order to be compatible with python
-                    # 2.5 and python 2.6/3
-                    err = 'Analysing output failed: %s' % (sys.exc_info()[1],)
-                    raise exceptions.AnalysisError(err)
-                # Convert data string from extract command to dictionary format.
-                if extract_popen.returncode != 0:
-                    err = extract_popen.communicate()[1].decode('utf-8')
-                    err = 'Analysing output failed: %s' % (err)
-                    raise exceptions.AnalysisError(err)
-                data_string = extract_popen.communicate()[0].decode('utf-8')
-                if self.test_program.extract_fmt == 'table':
-                    outputs.append(util.dict_table_string(data_string))
-                elif self.test_program.extract_fmt == 'yaml':
-                    outputs.append({})
-                    # convert values to be in a tuple so the format matches
-                    # that from dict_table_string.
-                    # ensure all keys are strings so they can be sorted
-                    # (different data types cause problems!)
-                    for (key, val) in yaml.safe_load(data_string).items():
-                        if isinstance(val, list):
-                            outputs[-1][str(key)] = tuple(val)
-                        else:
-                            outputs[-1][str(key)] = tuple((val,))
+        for (cache_key, data) in zip(cache_keys, outputs):
+            if cache_key:
+                self.data_cache.store(cache_key, data)
 
         return tuple(outputs)
 
+    def _extract_internal(self, data_file, verbose=1):
+        '''Extract data from data_file using data_tag or extract_fn.'''
+        tp_ptr = self.test_program
+        if tp_ptr.data_tag:
+            # Using internal data extraction function.
+            if verbose > 2:
+                print('Analysing output using data_tag %s in %s on file %s.' %
+                        (tp_ptr.data_tag, self.path, data_file))
+            return util.extract_tagged_data(tp_ptr.data_tag,
+                                            os.path.join(self.path, data_file))
+        else:
+            if verbose > 2:
+                print('Analysing output using function %s in %s on file %s.' %
+                        (tp_ptr.extract_fn.__name__, self.path, data_file))
+            return tp_ptr.extract_fn(os.path.join(self.path, data_file))
+
+    def _extract_external(self, extract_cmds, verbose=1):
+        '''Extract data using the external data extraction commands.
+
+The commands are run concurrently.  Returns a list of the data extracted by
+each command.'''
+        extract_popens = []
+        try:
+            for cmd in extract_cmds:
+                if verbose > 2:
+                    print('Analysing output using %s in %s.' %
+                            (cmd, self.path))
+                extract_popens.append(subprocess.Popen(cmd, shell=True,
+                        cwd=self.path, stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE))
+        except OSError:
+            # slightly odd syntax in order to be compatible with python
+            # 2.5 and python 2.6/3
+            err = 'Analysing output failed: %s' % (sys.exc_info()[1],)
+            for extract_popen in extract_popens:
+                extract_popen.communicate()
+            raise exceptions.AnalysisError(err)
+        # Wait for all commands to finish before reporting any failure.
+        results = [(extract_popen.communicate(), extract_popen.returncode)
+                   for extract_popen in extract_popens]
+
+        outputs = []
+        for ((data_string, err), returncode) in results:
+            if returncode != 0:
+                err = 'Analysing output failed: %s' % (err.decode('utf-8'))
+                raise exceptions.AnalysisError(err)
+            outputs.append(self._parse_extract_output(
+                    data_string.decode('utf-8')))
+        return outputs
+
+    def _extract_server(self, data_file, verbose=1):
+        '''Extract data from data_file by sending it to the external data
+extraction script running in server mode (see testcode2.coprocess).'''
+        tp_ptr = self.test_program
+        filename = os.path.abspath(os.path.join(self.path, data_file))
+        if verbose > 2:
+            print('Analysing output using %s (server) on file %s.' %
+                    (tp_ptr.server_cmd(), filename))
+        (returncode, data_string) = coprocess.request(tp_ptr.server_cmd(),
+                                                      [filename])
+        if returncode != 0:
+            err = 'Analysing output failed: %s' % (data_string,)
+            raise exceptions.AnalysisError(err)
+        return self._parse_extract_output(data_string)
+
+    def _parse_extract_output(self, data_string):
+        '''Convert data string from extract command to dictionary format.'''
+        if self.test_program.extract_fmt == 'table':
+            return util.dict_table_string(data_string)
+        elif self.test_program.extract_fmt == 'yaml':
+            output = {}
+            # convert values to be in a tuple so the format matches
+            # that from dict_table_string.
+            # ensure all keys are strings so they can be sorted
+            # (different data types cause problems!)
+            for (key, val) in yaml.safe_load(data_string).items():
+                if isinstance(val, list):
+                    output[str(key)] = tuple(val)
+                else:
+                    output[str(key)] = tuple((val,))
+            return output
+
     def create_new_benchmarks(self, benchmark, copy_files_since=None,
             copy_files_path='testcode_data'):
         '''Copy the test files to benchmark files.'''
 
-        oldcwd = os.getcwd()
-        os.chdir(self.path)
-
         test_files = []
         for (inp, arg) in self.inputs_args:
             test_file = util.testcode_filename(FILESTEM['test'],
@@ -635,15 +1024,18 @@ Assume function is executed in self.path.'''
             bench_file = util.testcode_filename(_FILESTEM_DICT['benchmark'],
                     benchmark, inp, arg)
             test_files.extend((test_file, err_file, bench_file))
-            shutil.copy(test_file, bench_file)
+            shutil.copy(os.path.join(self.path, test_file),
+                        os.path.join(self.path, bench_file))
 
         if copy_files_since:
+            copy_files_path = os.path.join(self.path, copy_files_path)
             if not os.path.isdir(copy_files_path):
                 os.mkdir(copy_files_path)
             if os.path.isdir(copy_files_path):
-                for data_file in glob.glob('*'):
-                    if (os.path.isfile(data_file) and
-                            os.stat(data_file)[-2] >= copy_files_since and
+                for data_file in os.listdir(self.path):
+                    data_path = os.path.join(self.path, data_file)
+                    if (os.path.isfile(data_path) and
+                            os.stat(data_path)[-2] >= copy_files_since and
                             data_file not in test_files):
                         bench_data_file = os.path.join(copy_files_path,
                                 data_file)
@@ -651,9 +1043,7 @@ Assume function is executed in self.path.'''
                         # with the same name.
                         if os.path.exists(bench_data_file):
                             os.unlink(bench_data_file)
-                        shutil.copy(data_file, bench_data_file)
-
-        os.chdir(oldcwd)
+                        shutil.copy(data_path, bench_data_file)
 
     def _update_status(self, status, inp_arg):
         '''Update self.status with success of a test.'''
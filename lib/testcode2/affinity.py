@@ -0,0 +1,140 @@
+'''
+testcode2.affinity
+------------------
+
+Assign disjoint sets of CPU cores to tests running concurrently on the local
+machine.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import glob
+import os
+
+import testcode2.exceptions as exceptions
+
+HAVE_AFFINITY = (hasattr(os, 'sched_getaffinity') and
+                 hasattr(os, 'sched_setaffinity'))
+
+NODE_DIR = '/sys/devices/system/node'
+
+def parse_cpu_list(cpu_list):
+    '''Parse a list of CPUs in the Linux cpulist format (e.g. 0-3,8,10-11).
+
+Returns a sorted list of CPU indices.'''
+    cpus = []
+    for item in cpu_list.strip().split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '-' in item:
+            (first, last) = item.split('-')
+            cpus.extend(range(int(first), int(last)+1))
+        else:
+            cpus.append(int(item))
+    return sorted(cpus)
+
+def format_cpu_list(cpus):
+    '''Return the comma-separated list of CPU indices.'''
+    return ','.join(str(cpu) for cpu in sorted(cpus))
+
+def available_cpus():
+    '''Return the sorted list of CPUs this process is allowed to run on.'''
+    if HAVE_AFFINITY:
+        return sorted(os.sched_getaffinity(0))
+    else:
+        ncpus = 1
+        try:
+            import multiprocessing
+            ncpus = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            pass
+        return list(range(ncpus))
+
+def numa_nodes(cpus=None):
+    '''Return the CPUs in each NUMA node of the local machine.
+
+cpus: list of CPUs to include.  If None, all CPUs available to this process
+    are used.
+
+Returns a list of sorted lists of CPUs.  If the NUMA topology is not available,
+all CPUs are treated as being in a single node.'''
+    if cpus is None:
+        cpus = available_cpus()
+    cpus = set(cpus)
+    nodes = []
+    for node_dir in sorted(glob.glob(os.path.join(NODE_DIR, 'node[0-9]*'))):
+        try:
+            cpu_list = open(os.path.join(node_dir, 'cpulist')).read()
+        except IOError:
+            continue
+        node = [cpu for cpu in parse_cpu_list(cpu_list) if cpu in cpus]
+        if node:
+            nodes.append(node)
+    # CPUs not reported in any node (including when the topology is not
+    # available).
+    in_nodes = set(cpu for node in nodes for cpu in node)
+    remainder = sorted(cpus - in_nodes)
+    if remainder:
+        nodes.append(remainder)
+    return nodes
+
+class CorePool:
+    '''Pool of CPU cores from which tests are given exclusive sets of cores.
+
+Cores are allocated to keep each test within as few NUMA nodes as possible: if
+a test fits into the free cores of a single node, it is placed into the node
+with the fewest free cores which is large enough (so larger nodes remain free
+for larger tests); otherwise it is spread over the nodes with the most free
+cores.
+
+cpus: list of CPUs in the pool.  Default: all CPUs available to this process.
+nodes: list of lists of CPUs in each NUMA node.  Default: read from the local
+    machine.
+'''
+    def __init__(self, cpus=None, nodes=None):
+        if nodes is None:
+            nodes = numa_nodes(cpus)
+        elif cpus is not None:
+            cpus = set(cpus)
+            nodes = [[cpu for cpu in node if cpu in cpus] for node in nodes]
+        self.nodes = [sorted(node) for node in nodes if node]
+        # Node containing each core.
+        self.node_of = dict((cpu, ind) for (ind, node) in enumerate(self.nodes)
+                                           for cpu in node)
+        # Free cores in each node.
+        self.free = [list(node) for node in self.nodes]
+        self.ncpus = len(self.node_of)
+
+    def nfree(self):
+        '''Return the number of free cores.'''
+        return sum(len(node) for node in self.free)
+
+    def acquire(self, ncpus):
+        '''Remove ncpus cores from the pool and return them as a sorted list.'''
+        if ncpus > self.nfree():
+            err = ('Cannot bind test to %s cores: only %s cores are free.'
+                    % (ncpus, self.nfree()))
+            raise exceptions.TestCodeError(err)
+        fits = [node for node in self.free if len(node) >= ncpus]
+        if fits:
+            node = min(fits, key=len)
+            cpus = node[:ncpus]
+        else:
+            cpus = []
+            for node in sorted(self.free, key=len, reverse=True):
+                cpus.extend(node[:ncpus-len(cpus)])
+                if len(cpus) == ncpus:
+                    break
+        taken = set(cpus)
+        self.free = [[cpu for cpu in node if cpu not in taken]
+                        for node in self.free]
+        return sorted(cpus)
+
+    def release(self, cpus):
+        '''Return cores obtained from acquire to the pool.'''
+        for cpu in cpus:
+            node = self.free[self.node_of[cpu]]
+            node.append(cpu)
+            node.sort()
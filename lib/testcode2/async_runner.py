@@ -0,0 +1,203 @@
+'''
+testcode2.async_runner
+----------------------
+
+Run tests locally using asyncio rather than a thread per test.
+
+Each job is run via asyncio.create_subprocess_shell and the event loop is
+notified when a job finishes, so there is no polling and only a single thread
+is required to manage any number of concurrent tests.  Checking the output of
+a job against the benchmark is handed over to a pool of worker threads so it
+does not block the event loop or hold on to the processors used by the test.
+
+Requires python 3.5 or later.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import asyncio
+import signal
+import sys
+import time
+
+import testcode2.exceptions as exceptions
+import testcode2.process as process
+import testcode2.scheduler as scheduler
+
+async def wait_job(job, timeout=None):
+    '''Wait for a job to finish, killing its process group after timeout seconds.
+
+Asynchronous equivalent of testcode2.process.wait_job.'''
+    timed_out = False
+    if timeout:
+        try:
+            await asyncio.wait_for(asyncio.shield(job.wait()), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+    if timed_out and process.HAVE_PROCESS_GROUPS:
+        process.signal_group(job.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.shield(job.wait()),
+                                   process.KILL_GRACE)
+        except asyncio.TimeoutError:
+            pass
+        if process.group_running(job.pid):
+            process.signal_group(job.pid, signal.SIGKILL)
+    elif timed_out:
+        job.kill()
+    returncode = await job.wait()
+    return (returncode, timed_out)
+
+async def run_test(test, verify_pool, verbose=1, rundir=None,
+                   result_cache=None):
+    '''Run all jobs in a test.
+
+Asynchronous equivalent of testcode2.Test.run_test for local runs.  Returns
+once all jobs have finished running; checking each job against the benchmark
+is submitted to verify_pool (a testcode2.scheduler.VerificationPool object).
+Jobs in result_cache (a testcode2.cache.ResultCache object) are not run.'''
+    loop = asyncio.get_event_loop()
+    try:
+        jobs = []
+        for (test_input, test_arg) in test.inputs_args:
+            jobs.append(((test_input, test_arg),
+                         test.job_command(test_input, test_arg)))
+        # Move files matching output pattern out of the way.
+        test.move_old_output_files(verbose)
+        for ((test_input, test_arg), (cmd, test_file)) in jobs:
+            if test.cancelled:
+                break
+            cache_entry = None
+            if result_cache:
+                # Hashing the executable and input might take a while.
+                cache_key = await loop.run_in_executor(None,
+                        result_cache.job_key, test, test_input, test_arg)
+                if cache_key and test.restore_cached_job(result_cache,
+                        cache_key, test_input, test_arg, test_file, verbose):
+                    verify_pool.verify(test, test_input, test_arg, verbose,
+                                       rundir)
+                    continue
+                elif cache_key:
+                    cache_entry = (result_cache, cache_key)
+            if verbose > 2:
+                print('Running test using %s in %s\n' % (cmd, test.path))
+            start_time = time.time()
+            try:
+                # Run in a new process group so the job can be killed.
+                job = await asyncio.create_subprocess_shell(cmd,
+                        cwd=test.path,
+                        env=process.job_environment(test.environment()),
+                        **process.popen_options(test.cpus, test.memory_limit))
+            except OSError:
+                err = 'Execution of test failed: %s' % (sys.exc_info()[1],)
+                raise exceptions.RunError(err)
+            process.register(job.pid)
+            try:
+                (returncode, timed_out) = await wait_job(job, test.timeout)
+            finally:
+                process.unregister(job.pid)
+            if test.cancelled:
+                break
+            test.run_times[(test_input, test_arg)] = (time.time() - start_time,
+                                                      returncode)
+            if timed_out:
+                raise exceptions.RunError(test.timeout_message())
+            # Collecting the output might involve running the skip program, so
+            # don't block the event loop.
+            verify = await loop.run_in_executor(None, test.collect_job,
+                    test_input, test_arg, test_file, returncode, verbose,
+                    rundir)
+            if verify:
+                verify_pool.verify(test, test_input, test_arg, verbose,
+                                   rundir, cache_entry)
+            sys.stdout.flush()
+        if test.cancelled:
+            # Jobs killed or not run at all.
+            test.skip_remaining_jobs()
+    except exceptions.RunError:
+        test.job_failed(test_input, test_arg, sys.exc_info()[1], verbose,
+                        rundir)
+
+async def _run_tests(groups, tot_nprocs, verify_pool, order='config',
+                     history=None, verbose=1, rundir=None, core_pool=None,
+                     capacities=None, max_failures=0, result_cache=None,
+                     moldable=False):
+    '''Run groups of tests within tot_nprocs processors.  See run_tests.'''
+    loop = asyncio.get_event_loop()
+    sched = scheduler.Scheduler(groups, tot_nprocs, order, history, core_pool,
+                                capacities, max_failures, moldable=moldable)
+    running = {}
+    while not sched.finished():
+        if not sched.cancelled and sched.failure_limit_reached():
+            not_started = sched.cancel()
+            if verbose > 0:
+                print('\nMaximum number of failed jobs (%s) reached: %s tests '
+                      'not started and running tests killed.\n'
+                      % (max_failures, not_started))
+            # Waits for the jobs to exit, so don't block the event loop.
+            await loop.run_in_executor(None, process.kill_all)
+        for test in sched.dispatch():
+            task = asyncio.ensure_future(run_test(test, verify_pool, verbose,
+                                                  rundir, result_cache))
+            running[task] = test
+        if not running:
+            # All tests which had not been started were skipped by cancel.
+            continue
+        # Jobs are checked in the verification pool, so failures can be
+        # recorded whilst no test finishes: wake up periodically to check the
+        # number of failures.
+        timeout = None
+        if max_failures > 0 and not sched.cancelled:
+            timeout = 0.5
+        (done, pending) = await asyncio.wait(list(running.keys()),
+                                timeout=timeout,
+                                return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            test = running.pop(task)
+            sched.release(test)
+            if history:
+                history.record_test(test)
+            # Re-raise any unexpected error from running the test.
+            task.result()
+
+def run_tests(groups, tot_nprocs, verify_pool, order='config', history=None,
+              verbose=1, rundir=None, core_pool=None, capacities=None,
+              max_failures=0, result_cache=None, moldable=False):
+    '''Run groups of tests locally within tot_nprocs processors.
+
+Returns once all tests have been run; the caller must wait for verify_pool to
+finish checking the tests.
+
+groups: list of lists of tests.  Tests within a group are run consecutively.
+tot_nprocs: total number of processors available to run tests on.
+verify_pool: testcode2.scheduler.VerificationPool object used to check jobs
+    against the benchmark.
+order: order in which tests are started.  See testcode2.scheduler.Scheduler.
+history: testcode2.history.RuntimeHistory object.  If supplied, the wall time
+    of each job is recorded in the history.
+verbose: level of verbosity in output.
+rundir: directory relative to which test paths are printed.
+core_pool: testcode2.affinity.CorePool object.  If supplied, each test is bound
+    to its own set of cores.
+capacities: total amount of memory and other resources available.  See
+    testcode2.scheduler.Scheduler.
+max_failures: if greater than 0, stop once max_failures jobs have failed: no
+    more tests are started and running jobs are killed.
+result_cache: testcode2.cache.ResultCache object.  If supplied, jobs whose
+    output is in the cache are not run.
+moldable: choose the number of processors each test is run on.  See
+    testcode2.scheduler.Scheduler.
+'''
+    loop = asyncio.new_event_loop()
+    # Subprocesses are monitored using the current event loop.
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_run_tests(groups, tot_nprocs, verify_pool,
+                                           order, history, verbose, rundir,
+                                           core_pool, capacities,
+                                           max_failures, result_cache,
+                                           moldable))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
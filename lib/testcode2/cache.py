@@ -0,0 +1,308 @@
+'''
+testcode2.cache
+---------------
+
+Caches of the output of jobs which passed, so that jobs which would produce
+the same output need not be run again, and of the data extracted from output
+files, so that unchanged files (e.g. benchmarks) need not be analysed again.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import threading
+
+import testcode2.compatibility as compat
+
+# Name of the cache directory, which is placed in the same directory as the
+# userconfig file.
+CACHE_DIR = '.testcode_cache'
+# Name of the subdirectory of CACHE_DIR in which extracted data is stored.
+DATA_CACHE_DIR = 'data'
+
+class ResultCache:
+    '''Content-addressed store of the output of jobs.
+
+A job is identified by a hash of the contents of the executable and of the
+input file and of all the settings which affect how the job is run.  Only the
+executable and the input file are inspected: changes to any other files read
+by the program are not detected.
+
+directory: directory in which the cached output is stored.
+root: directory relative to which test paths are included in the hash.
+    Default: the parent of directory.
+max_size: maximum size (in bytes) of the cache.  The least recently used
+    entries are removed by prune once the cache exceeds this size.  If less
+    than 1, there is no limit.
+'''
+    def __init__(self, directory, root=None, max_size=0):
+        self.directory = directory
+        self.max_size = max_size
+        if root is None:
+            root = os.path.dirname(os.path.abspath(directory))
+        self.root = root
+        # Hashes of files, indexed by (path, size, mtime), so each file is
+        # only read once.
+        self._hashes = {}
+        self.lock = threading.Lock()
+
+    def file_hash(self, filename):
+        '''Return the hash of the contents of filename.'''
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+        self.lock.acquire()
+        try:
+            if key in self._hashes:
+                return self._hashes[key]
+        finally:
+            self.lock.release()
+        sha = hashlib.sha256()
+        hash_file = open(filename, 'rb')
+        try:
+            block = hash_file.read(1024*1024)
+            while block:
+                sha.update(block)
+                block = hash_file.read(1024*1024)
+        finally:
+            hash_file.close()
+        self.lock.acquire()
+        try:
+            self._hashes[key] = sha.hexdigest()
+        finally:
+            self.lock.release()
+        return self._hashes[key]
+
+    def job_key(self, test, input_file, args):
+        '''Return the key identifying a job in the cache.
+
+Returns None if the job cannot be cached (i.e. the executable is not a file).'''
+        test_program = test.test_program
+        if not os.path.isfile(test_program.exe):
+            return None
+        input_hash = None
+        if input_file:
+            input_hash = self.file_hash(os.path.join(test.path, input_file))
+        settings = dict(
+                exe=self.file_hash(test_program.exe),
+                input=input_hash,
+                input_file=input_file or '',
+                args=args or '',
+                nprocs=test.nprocs,
+                nthreads=test.nthreads,
+                run_cmd_template=test_program.run_cmd_template,
+                launch_parallel=test_program.launch_parallel,
+                benchmark=test_program.benchmark,
+                output=test.output,
+                path=compat.relpath(test.path, self.root),
+                )
+        settings = json.dumps(settings, sort_keys=True)
+        return hashlib.sha256(settings.encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        '''Return the directory containing the files stored under key.'''
+        return os.path.join(self.directory, key[:2], key)
+
+    def restore(self, key, path, test_file, error_file):
+        '''Copy the output stored under key to test_file and error_file in path.
+
+Returns True if the job was in the cache.'''
+        entry = self._entry(key)
+        if not os.path.exists(os.path.join(entry, 'output')):
+            return False
+        shutil.copyfile(os.path.join(entry, 'output'),
+                        os.path.join(path, test_file))
+        if os.path.exists(os.path.join(entry, 'error')):
+            shutil.copyfile(os.path.join(entry, 'error'),
+                            os.path.join(path, error_file))
+        try:
+            # Mark the entry as recently used (see prune).
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return True
+
+    def store(self, key, path, test_file, error_file):
+        '''Store test_file and (if it exists) error_file in path under key.'''
+        entry = self._entry(key)
+        if os.path.exists(os.path.join(entry, 'output')):
+            return
+        # Copy into a temporary directory and rename it so that other
+        # processes never see a partially written entry.
+        tmp_entry = '%s.tmp.%s.%s' % (entry, os.getpid(),
+                                      threading.current_thread().ident)
+        try:
+            os.makedirs(tmp_entry)
+            shutil.copyfile(os.path.join(path, test_file),
+                            os.path.join(tmp_entry, 'output'))
+            if os.path.exists(os.path.join(path, error_file)):
+                shutil.copyfile(os.path.join(path, error_file),
+                                os.path.join(tmp_entry, 'error'))
+            os.rename(tmp_entry, entry)
+        except (IOError, OSError):
+            # Entry already stored by another process or the cache is not
+            # writable: either way the test is not affected.
+            shutil.rmtree(tmp_entry, True)
+
+    def prune(self):
+        '''Remove the least recently used entries until the cache is no larger
+than max_size.'''
+        if self.max_size < 1 or not os.path.isdir(self.directory):
+            return
+        entries = []
+        # Entries are stored in subdirectories named by the first two
+        # characters of the key.  Other directories (e.g. the data cache)
+        # are not part of this cache.
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                if '.tmp.' in key:
+                    # Still being written by another process.
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, filename))
+                               for filename in os.listdir(entry))
+                    mtime = os.stat(entry).st_mtime
+                except OSError:
+                    continue
+                entries.append((mtime, size, entry))
+        _remove_least_recent(entries, self.max_size,
+                             lambda entry: shutil.rmtree(entry, True))
+
+def _remove_least_recent(entries, max_size, remove):
+    '''Remove the least recently used entries until the total size of entries
+is no larger than max_size.
+
+entries: list of (modification time, size, entry) tuples.
+remove: function which removes an entry.  OSErrors are ignored.'''
+    total_size = sum(size for (mtime, size, entry) in entries)
+    entries.sort()
+    for (mtime, size, entry) in entries:
+        if total_size <= max_size:
+            break
+        try:
+            remove(entry)
+            total_size -= size
+        except OSError:
+            pass
+
+def _file_stamp(filename):
+    '''Return (absolute path, size, modification time) of filename or None if
+filename does not exist.'''
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+
+class DataCache:
+    '''Store of the data extracted from output files.
+
+An output file is identified by its path, size and modification time and by
+all the settings of the test program which affect how data is extracted from
+it.  The data is stored as a pickled dictionary, as returned by
+testcode2.Test.extract_data.
+
+directory: directory in which the extracted data is stored.
+max_size: maximum size (in bytes) of the cache.  The least recently used
+    entries are removed by prune once the cache exceeds this size.
+'''
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def data_key(self, test_program, filename):
+        '''Return the key identifying the data extracted from filename using
+test_program.
+
+Returns None if the data cannot be cached (i.e. filename does not exist).'''
+        stamp = _file_stamp(filename)
+        if stamp is None:
+            return None
+        if test_program.data_tag:
+            settings = dict(data_tag=test_program.data_tag)
+        elif test_program.extract_fn:
+            # Include the module containing the function, so that changes to
+            # the function are detected.
+            module = sys.modules.get(test_program.extract_fn.__module__)
+            settings = dict(
+                    extract_fn=test_program._extract_fn_spec,
+                    module=_file_stamp(getattr(module, '__file__', '')),
+                    )
+        else:
+            settings = dict(
+                    extract_program=test_program.extract_program,
+                    program=_file_stamp(test_program.extract_program or ''),
+                    extract_args=test_program.extract_args,
+                    extract_cmd_template=test_program.extract_cmd_template,
+                    extract_fmt=test_program.extract_fmt,
+                    )
+        settings['file'] = stamp
+        settings = json.dumps(settings, sort_keys=True)
+        return hashlib.sha256(settings.encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        '''Return the file containing the data stored under key.'''
+        return os.path.join(self.directory, key[:2], key)
+
+    def load(self, key):
+        '''Return the data stored under key or None if it is not in the cache.'''
+        entry = self._entry(key)
+        try:
+            data_file = open(entry, 'rb')
+            try:
+                data = pickle.load(data_file)
+            finally:
+                data_file.close()
+            # Mark the entry as recently used (see prune).
+            os.utime(entry, None)
+        except Exception:
+            # Missing, unreadable or partially written entries are all simply
+            # not in the cache.
+            return None
+        return data
+
+    def store(self, key, data):
+        '''Store data under key.'''
+        entry = self._entry(key)
+        # Write to a temporary file and rename it so that other processes
+        # never see a partially written entry.
+        tmp_entry = '%s.tmp.%s.%s' % (entry, os.getpid(),
+                                      threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(entry)):
+                os.makedirs(os.path.dirname(entry))
+            data_file = open(tmp_entry, 'wb')
+            try:
+                # Protocol 2 can be read by all supported versions of python.
+                pickle.dump(data, data_file, 2)
+            finally:
+                data_file.close()
+            os.rename(tmp_entry, entry)
+        except (IOError, OSError, pickle.PicklingError):
+            # The cache is not writable or the data cannot be pickled: either
+            # way the test is not affected.
+            if os.path.exists(tmp_entry):
+                os.remove(tmp_entry)
+
+    def prune(self):
+        '''Remove the least recently used entries until the cache is no larger
+than max_size.'''
+        entries = []
+        for (dirpath, dirnames, filenames) in os.walk(self.directory):
+            for filename in filenames:
+                entry = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(entry)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry))
+        _remove_least_recent(entries, self.max_size, os.remove)
@@ -0,0 +1,93 @@
+'''
+testcode2.compare
+-----------------
+
+Check jobs against their benchmarks using a pool of processes.
+
+Extracting and comparing data is largely done in python and so is limited by
+the global interpreter lock if jobs are checked by threads.  Instead, each job
+is checked in a separate process and only the status of the job and the
+message describing it are returned.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import multiprocessing
+
+import testcode2
+import testcode2.compatibility as compat
+import testcode2.validation as validation
+
+def process_pool(nworkers):
+    '''Return a concurrent.futures.ProcessPoolExecutor with nworkers processes.
+
+Where possible, the workers are started by a fork server rather than by forking
+this process, which might be starting jobs in other threads at the same time:
+forked workers would inherit, and hold open, the pipes subprocess uses to start
+the jobs, so starting the jobs would never finish.'''
+    try:
+        context = multiprocessing.get_context('forkserver')
+        return compat.futures.ProcessPoolExecutor(nworkers,
+                                                  mp_context=context)
+    except (AttributeError, ValueError, TypeError):
+        # python < 3.7 or no fork server available (e.g. on Windows).
+        return compat.futures.ProcessPoolExecutor(nworkers)
+
+def _check_jobs(jobs, verbose, filestem):
+    '''Check jobs in a worker process.
+
+jobs: list of (test, input_file, args) tuples.
+verbose: level of verbosity in output.
+filestem: testcode2.FILESTEM of the parent process.
+
+Returns a list of (status name, msg) tuples.'''
+    testcode2.FILESTEM.update(filestem)
+    results = []
+    for (test, input_file, args) in jobs:
+        (status, msg) = test.check_job(input_file, args, verbose)
+        results.append((status.name(), str(msg)))
+    return results
+
+def check_job(executor, test, input_file, args, verbose=1):
+    '''Check a job against its benchmark in a worker process of executor (a
+concurrent.futures.ProcessPoolExecutor object) and wait for the result.
+
+Returns (status, msg) (see testcode2.Test.check_job).  The status of the test
+is not changed.'''
+    future = executor.submit(_check_jobs, [(test, input_file, args)], verbose,
+                             testcode2.FILESTEM)
+    (status, msg) = future.result()[0]
+    return (validation.Status(name=status), msg)
+
+def check_jobs(jobs, nworkers, verbose=1):
+    '''Check jobs against their benchmarks.
+
+jobs: list of (test, input_file, args) tuples.
+nworkers: number of processes used to check jobs.  If less than 2 (or
+    concurrent.futures is not available), jobs are checked in this process.
+verbose: level of verbosity in output.
+
+Yields (status, msg) for each job (see testcode2.Test.check_job) in the same
+order as jobs, so the results can be recorded and printed in a deterministic
+order whilst later jobs are still being checked.  The status of the tests is
+not changed.  Note that any output printed whilst checking a job (i.e. with
+verbose > 2) is printed by the worker as the job is checked.'''
+    if nworkers < 2 or not compat.futures or len(jobs) < 2:
+        for (test, input_file, args) in jobs:
+            yield test.check_job(input_file, args, verbose)
+        return
+    # Send jobs to the workers in chunks to reduce the communication overhead
+    # (tests with several jobs are only pickled once per chunk) whilst still
+    # sharing the work evenly between the workers.
+    chunk_size = max(1, min(16, len(jobs) // (4*nworkers)))
+    executor = process_pool(nworkers)
+    try:
+        futures = [executor.submit(_check_jobs, jobs[ind:ind+chunk_size],
+                                   verbose, testcode2.FILESTEM)
+                   for ind in range(0, len(jobs), chunk_size)]
+        for future in futures:
+            for (status, msg) in future.result():
+                yield (validation.Status(name=status), msg)
+    finally:
+        executor.shutdown(True)
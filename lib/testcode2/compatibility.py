@@ -148,6 +148,17 @@ try:
 except ImportError:
     import ConfigParser as configparser
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import concurrent.futures as futures
+except ImportError:
+    # python 2 without the futures backport.
+    futures = None
+
 try:
     compat_input = raw_input
 except NameError:
@@ -19,6 +19,7 @@ import warnings
 import testcode2
 import testcode2.compatibility as compat
 import testcode2.exceptions as exceptions
+import testcode2.scheduler as scheduler
 import testcode2.util as util
 import testcode2.validation as validation
 import testcode2.vcs as vcs
@@ -52,6 +53,58 @@ def parse_tolerance_tuple(val):
         abs_tol = None
     return (name, validation.Tolerance(name, abs_tol, rel_tol, strict))
 
+def parse_memory(val):
+    '''Parse an amount of memory (e.g. 512M or 8G) into a number of bytes.
+
+The K, M, G and T suffixes denote powers of 1024; a number without a suffix is
+taken to be in bytes.'''
+    units = dict(K=1024, M=1024**2, G=1024**3, T=1024**4)
+    mem = val.strip().upper()
+    for suffix in ('IB', 'B'):
+        if mem.endswith(suffix) and len(mem) > len(suffix):
+            mem = mem[:-len(suffix)]
+            break
+    scale = 1
+    if mem and mem[-1] in units:
+        scale = units[mem[-1]]
+        mem = mem[:-1]
+    try:
+        return int(float(mem)*scale)
+    except ValueError:
+        err = 'Cannot parse amount of memory: %s.' % (val,)
+        raise exceptions.TestCodeError(err)
+
+def parse_resources(val):
+    '''Parse name:amount pairs (e.g. license:1 scratch:2) into a dictionary.
+
+The amount is optional and defaults to 1.'''
+    resources = {}
+    for item in val.replace(',', ' ').split():
+        if ':' in item:
+            (name, amount) = item.split(':', 1)
+        else:
+            (name, amount) = (item, 1)
+        try:
+            amount = int(amount)
+        except ValueError:
+            err = 'Cannot parse amount of resource %s: %s.' % (name, amount)
+            raise exceptions.TestCodeError(err)
+        if name == 'memory':
+            err = 'Set the amount of memory using the memory option.'
+            raise exceptions.TestCodeError(err)
+        resources[name] = amount
+    return resources
+
+def parse_execution(val):
+    '''Check the setting of where a test is run in hybrid mode.
+
+Returns val if it is one of testcode2.scheduler.EXECUTION_MODES.'''
+    if val not in scheduler.EXECUTION_MODES:
+        err = ('Invalid execution setting: %s.  Allowed values: %s.'
+                % (val, ', '.join(scheduler.EXECUTION_MODES)))
+        raise exceptions.TestCodeError(err)
+    return val
+
 def parse_userconfig(config_file, executables=None, test_id=None,
         settings=None):
     '''Parse the user options and job types from the userconfig file.
@@ -105,9 +158,11 @@ config_file: location of the userconfig file, either relative or absolute.'''
     test_program_options = ('run_cmd_template',
         'launch_parallel', 'ignore_fields', 'data_tag', 'extract_cmd_template',
         'extract_fn', 'extract_program', 'extract_args', 'extract_fmt',
-        'verify', 'vcs', 'skip_program', 'skip_args', 'skip_cmd_template')
+        'extract_mode', 'verify', 'vcs', 'skip_program', 'skip_args',
+        'skip_cmd_template')
     default_test_options = ('inputs_args', 'output', 'nprocs',
-        'min_nprocs', 'max_nprocs', 'submit_template',)
+        'min_nprocs', 'max_nprocs', 'nthreads', 'submit_template', 'timeout',
+        'memory', 'resources', 'execution')
     test_programs = {}
     for section in userconfig.sections():
         tp_dict = {}
@@ -158,9 +213,17 @@ config_file: location of the userconfig file, either relative or absolute.'''
         if 'submit_template' in test_dict:
             test_dict['submit_template'] = os.path.join(config_directory,
                                                    test_dict['submit_template'])
-        for key in ('nprocs', 'max_nprocs', 'min_nprocs'):
+        for key in ('nprocs', 'max_nprocs', 'min_nprocs', 'nthreads'):
             if key in test_dict:
                 test_dict[key] = int(test_dict[key])
+        if 'timeout' in test_dict:
+            test_dict['timeout'] = float(test_dict['timeout'])
+        if 'memory' in test_dict:
+            test_dict['memory'] = parse_memory(test_dict['memory'])
+        if 'resources' in test_dict:
+            test_dict['resources'] = parse_resources(test_dict['resources'])
+        if 'execution' in test_dict:
+            test_dict['execution'] = parse_execution(test_dict['execution'])
         if 'inputs_args' in test_dict:
             # format: (input, arg), (input, arg)'
             test_dict['inputs_args'] = (
@@ -268,9 +331,17 @@ config_file: location of the jobconfig file, either relative or absolute.'''
         # Other options.
         for option in jobconfig.options(section):
             test_dict[option] = jobconfig.get(section, option)
-        for key in ('nprocs', 'max_nprocs', 'min_nprocs'):
+        for key in ('nprocs', 'max_nprocs', 'min_nprocs', 'nthreads'):
             if key in test_dict:
                 test_dict[key] = int(test_dict[key])
+        if 'timeout' in test_dict:
+            test_dict['timeout'] = float(test_dict['timeout'])
+        if 'memory' in test_dict:
+            test_dict['memory'] = parse_memory(test_dict['memory'])
+        if 'resources' in test_dict:
+            test_dict['resources'] = parse_resources(test_dict['resources'])
+        if 'execution' in test_dict:
+            test_dict['execution'] = parse_execution(test_dict['execution'])
         if 'submit_template' in test_dict:
             test_dict['submit_template'] = os.path.join(config_directory,
                                                    test_dict['submit_template'])
@@ -303,8 +374,13 @@ config_file: location of the jobconfig file, either relative or absolute.'''
                         nprocs=default_test.nprocs,
                         min_nprocs=default_test.min_nprocs,
                         max_nprocs=default_test.max_nprocs,
+                        nthreads=default_test.nthreads,
                         run_concurrent=default_test.run_concurrent,
                         submit_template=default_test.submit_template,
+                        timeout=default_test.timeout,
+                        memory=default_test.memory,
+                        resources=copy.deepcopy(default_test.resources),
+                        execution=default_test.execution,
                     )
                 if  'tolerances' in test_dict:
                     test['tolerances'].update(test_dict['tolerances'])
@@ -318,8 +394,6 @@ config_file: location of the jobconfig file, either relative or absolute.'''
     # Now create the tests (after finding out what the input files are).
     tests = []
     for ((name, path), (test_program, test_dict)) in test_info.items():
-        old_dir = os.getcwd()
-        os.chdir(path)
         # Expand any globs in the input files.
         inputs_args = []
         for input_arg in test_dict['inputs_args']:
@@ -340,7 +414,7 @@ config_file: location of the jobconfig file, either relative or absolute.'''
             if inp:
                 # the test, error and benchmark filenames contain the input
                 # filename, so we need to filter them out.
-                inp_files = sorted(glob.glob(inp))
+                inp_files = sorted(util.glob_in_dir(path, inp))
                 if not inp_files:
                     err = 'Cannot find input file %s in %s.' % (inp, path)
                     warnings.warn(err)
@@ -357,14 +431,13 @@ config_file: location of the jobconfig file, either relative or absolute.'''
                              ]
                 testcode_files = []
                 for tc_file in test_files:
-                    testcode_files.extend(glob.glob(tc_file))
+                    testcode_files.extend(util.glob_in_dir(path, tc_file))
                 for inp_file in inp_files:
                     if inp_file not in testcode_files:
                         inputs_args.append((inp_file, arg))
             else:
                 inputs_args.append((inp, arg))
         test_dict['inputs_args'] = tuple(inputs_args)
-        os.chdir(old_dir)
         # Create test.
         if test_dict['run_concurrent']:
             for input_arg in test_dict['inputs_args']:
@@ -0,0 +1,124 @@
+'''
+testcode2.coprocess
+-------------------
+
+Long-lived external data extraction and verification programs.
+
+Rather than running the program for each output file, the program is started
+once (per thread and process) and sent requests over standard input.  Each
+message (in either direction) is framed by a header line giving the size of
+the payload in bytes:
+
+    request:  <size>\\n<payload>
+    response: <status> <size>\\n<payload>
+
+The payload of a request is the absolute path(s) of the output file(s), one per
+line.  The payload of a response is the output the program would otherwise
+print and status is the exit status the program would otherwise return.  The
+program should exit when it reaches the end of standard input.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import atexit
+import os
+import subprocess
+import sys
+import threading
+
+import testcode2.exceptions as exceptions
+
+# Coprocesses used by each thread, indexed by command.
+_LOCAL = threading.local()
+# All coprocesses started by this process, so they can be closed at exit.
+_COPROCESSES = []
+_COPROCESSES_LOCK = threading.Lock()
+
+class Coprocess:
+    '''External program which handles a series of requests.
+
+cmd: shell command which starts the program.
+'''
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.pid = os.getpid()
+        try:
+            self.popen = subprocess.Popen(cmd, shell=True,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError:
+            err = 'Starting %s failed: %s' % (cmd, sys.exc_info()[1])
+            raise exceptions.AnalysisError(err)
+
+    def request(self, paths):
+        '''Send paths to the program.
+
+Returns (status, output), where status is the exit status of the request and
+output the output of the program.'''
+        payload = '\n'.join(paths).encode('utf-8')
+        try:
+            self.popen.stdin.write(('%s\n' % (len(payload),)).encode('ascii'))
+            self.popen.stdin.write(payload)
+            self.popen.stdin.flush()
+            header = self.popen.stdout.readline()
+            if not header:
+                raise ValueError('program exited')
+            header = header.decode('ascii').split()
+            (status, size) = (int(header[0]), int(header[1]))
+            output = self.popen.stdout.read(size)
+            if len(output) != size:
+                raise ValueError('truncated response')
+        except (IOError, OSError, ValueError, IndexError):
+            # The program has exited or does not follow the protocol.
+            self.close()
+            err = 'Communicating with %s failed: %s' % (self.cmd,
+                                                        sys.exc_info()[1])
+            raise exceptions.AnalysisError(err)
+        return (status, output.decode('utf-8'))
+
+    def close(self):
+        '''Close standard input of the program and wait for it to exit.'''
+        try:
+            self.popen.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.popen.stdout.close()
+        self.popen.wait()
+
+def request(cmd, paths):
+    '''Send paths to the coprocess running cmd in this thread.
+
+The coprocess is started if it is not already running.  See Coprocess.request.
+'''
+    # Coprocesses inherited from the parent of a forked process cannot be
+    # used as their pipes are shared with the parent.
+    if getattr(_LOCAL, 'pid', None) != os.getpid():
+        _LOCAL.pid = os.getpid()
+        _LOCAL.coprocesses = {}
+    if cmd not in _LOCAL.coprocesses:
+        coprocess = Coprocess(cmd)
+        _LOCAL.coprocesses[cmd] = coprocess
+        _COPROCESSES_LOCK.acquire()
+        try:
+            _COPROCESSES.append(coprocess)
+        finally:
+            _COPROCESSES_LOCK.release()
+    try:
+        return _LOCAL.coprocesses[cmd].request(paths)
+    except exceptions.AnalysisError:
+        # Start a new coprocess for the next request.
+        del _LOCAL.coprocesses[cmd]
+        raise
+
+def close_all():
+    '''Close all coprocesses started by this process.'''
+    _COPROCESSES_LOCK.acquire()
+    try:
+        for coprocess in _COPROCESSES:
+            if coprocess.pid == os.getpid():
+                coprocess.close()
+        _COPROCESSES[:] = []
+    finally:
+        _COPROCESSES_LOCK.release()
+
+atexit.register(close_all)
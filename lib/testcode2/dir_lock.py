@@ -2,7 +2,7 @@
 testcode2.dir_lock
 ------------------
 
-Threading lock initialisation and helper.
+Per-directory threading locks and helpers.
 
 :copyright: (c) 2012 James Spencer.
 :license: modified BSD; see LICENSE for more details.
@@ -12,58 +12,45 @@ import os
 import threading
 import testcode2.compatibility as compat
 
-class DirLock:
-    '''Helper class for working with threading locks.'''
+class DirLocks:
+    '''Helper class for working with a threading lock for each directory.
+
+Files and programs are always accessed using absolute paths (or by running
+a subprocess in the desired directory) rather than by changing the working
+directory of the process, so a lock is only needed for actions which must not
+be interleaved with other actions in the same directory, such as moving files
+which match a given pattern.  Actions in different directories never block
+each other.
+'''
     def __init__(self):
+        # Lock to protect access to the dictionary of locks.
         self.lock = threading.Lock()
-    def with_lock(self, func):
-        '''Decorate function to be executed whilst holding the lock.
-        
-:param function func: arbitary function.
+        self.dir_locks = {}
+    def get_lock(self, ddir):
+        '''Return the lock for the given directory.
+
+:param string ddir: directory.
+'''
+        ddir = os.path.abspath(ddir)
+        self.lock.acquire()
+        try:
+            if ddir not in self.dir_locks:
+                self.dir_locks[ddir] = threading.Lock()
+            return self.dir_locks[ddir]
+        finally:
+            self.lock.release()
+    def with_path_lock(self, func):
+        '''Decorate method to be executed whilst holding the lock for self.path.
+
+:param function func: arbitrary method of an object with a path attribute.
 '''
         @compat.functools.wraps(func)
-        def decorated_func(*args, **kwargs):
-            '''Function decorated by Lock.with_lock.'''
-            self.lock.acquire()
+        def decorated_func(obj, *args, **kwargs):
+            '''Function decorated by DirLocks.with_path_lock.'''
+            lock = self.get_lock(obj.path)
+            lock.acquire()
             try:
-                return func(*args, **kwargs)
+                return func(obj, *args, **kwargs)
             finally:
-                self.lock.release()
+                lock.release()
         return decorated_func
-    def in_dir(self, ddir):
-        '''Decorate function so it is executed in the given directory ddir.
-
-The thread executing the function holds the lock whilst entering ddir and
-executing the function.  This makes such actions thread-safe with respect to
-the directory location but is not appropriate for computationally-demanding
-functions.
-        
-:param string ddir: directory in which the decorated function is executed.
-'''
-        # Because we wish to use this as a decorator with arguments passed to
-        # the decorator, we must return a wrapper function which in turn
-        # returns the decorated function.  See the excellent explanation of
-        # decorators at: http://stackoverflow.com/a/1594484
-        def wrapper(func):
-            '''Wrap func to hold lock whilst being executed in ddir.
-            
-:param string func: arbitrary function.
-'''
-            @compat.functools.wraps(func)
-            @self.with_lock
-            def decorated_func(*args, **kwargs):
-                '''Function decorated by Lock.in_dir.'''
-                cwd = os.getcwd()
-                os.chdir(ddir)
-                try:
-                    val = func(*args, **kwargs)
-                except Exception:
-                    # func has raised an error.  Return to the original
-                    # directory and then re-raise the error to allow the caller
-                    # to handle it.
-                    os.chdir(cwd)
-                    raise
-                os.chdir(cwd)
-                return val
-            return decorated_func
-        return wrapper
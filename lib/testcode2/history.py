@@ -0,0 +1,189 @@
+'''
+testcode2.history
+-----------------
+
+Persistent record of the time taken to run each test.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import json
+import os
+import sys
+import threading
+import time
+import warnings
+
+import testcode2.compatibility as compat
+
+# Name of the history file, which is placed in the same directory as the
+# userconfig file.
+HISTORY_FILE = '.testcode_history'
+
+# Estimated wall time (in seconds) for a job which has never been run if there
+# are no previous runs of any job to estimate it from.
+DEFAULT_WALL_TIME = 60.0
+
+class RuntimeHistory:
+    '''Store the wall time and exit status of each job run by testcode.
+
+Jobs are identified by the test path, input file, arguments, number of
+processors and number of threads per process.  Test paths are stored relative to the directory containing the
+history file so that the history remains valid if the tests are moved.
+
+filename: file in which the history is stored.  It is created by save if it
+    does not exist.  If it cannot be read, a warning is issued and the history
+    starts empty.
+'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self.records = {}
+        self.lock = threading.Lock()
+        if os.path.exists(filename):
+            try:
+                history_file = open(filename)
+                try:
+                    records = json.load(history_file)
+                finally:
+                    history_file.close()
+                for record in records:
+                    # Files written before the number of threads was recorded
+                    # only contain jobs run with one thread per process.
+                    record.setdefault('nthreads', 1)
+                    key = (record['path'], record['input'], record['args'],
+                           record['nprocs'], record['nthreads'])
+                    self.records[key] = record
+            except (IOError, ValueError, TypeError, KeyError):
+                warnings.warn('Cannot read runtime history file %s: %s.  '
+                              'Starting with an empty history.'
+                              % (filename, sys.exc_info()[1]))
+                self.records = {}
+
+    def _key(self, path, input_file, args, nprocs, nthreads=None):
+        '''Return the key under which a job is stored.'''
+        return (compat.relpath(path, self.directory), input_file or '',
+                args or '', nprocs, max(1, nthreads or 1))
+
+    def _same_job(self, key, other_key):
+        '''Return True if the keys refer to the same job run with the same
+number of threads per process (but possibly a different number of processors).'''
+        return other_key[:3] == key[:3] and other_key[4] == key[4]
+
+    def record(self, path, input_file, args, nprocs, wall_time, returncode,
+               nthreads=None):
+        '''Record the wall time (in seconds) and exit status of a job.'''
+        key = self._key(path, input_file, args, nprocs, nthreads)
+        self.lock.acquire()
+        try:
+            self.records[key] = dict(path=key[0], input=key[1], args=key[2],
+                    nprocs=key[3], nthreads=key[4], wall_time=wall_time,
+                    returncode=returncode, timestamp=time.time())
+        finally:
+            self.lock.release()
+
+    def record_test(self, test):
+        '''Record the wall times of all jobs run by a test.'''
+        for ((input_file, args), (wall_time, returncode)) in \
+                test.run_times.items():
+            self.record(test.path, input_file, args, test.nprocs, wall_time,
+                        returncode, test.nthreads)
+
+    def wall_time(self, path, input_file, args, nprocs, nthreads=None):
+        '''Return the recorded wall time of a job or None if it has not run.
+
+If the job has only been run on a different number of processors (with the
+same number of threads), then the wall time of the closest number of processors
+is returned.'''
+        key = self._key(path, input_file, args, nprocs, nthreads)
+        if key in self.records:
+            return self.records[key]['wall_time']
+        others = [record for (other_key, record) in self.records.items()
+                    if self._same_job(key, other_key)]
+        if others:
+            others.sort(key=lambda record: abs(record['nprocs'] - nprocs))
+            return others[0]['wall_time']
+        return None
+
+    def scaled_wall_time(self, path, input_file, args, nprocs, nthreads=None):
+        '''Return the wall time of a job on nprocs processors, estimated from
+the wall times recorded on any number of processors, or None if the job has
+not been run.  Only runs with the same number of threads per process are used.
+
+If the job has been run on at least two different numbers of processors, the
+wall time is modelled using Amdahl's law, t(n) = serial + parallel/n, fitted
+to the recorded wall times by least squares.  Otherwise the job is assumed to
+scale perfectly from the recorded wall time.'''
+        key = self._key(path, input_file, args, nprocs, nthreads)
+        if key in self.records:
+            return self.records[key]['wall_time']
+        points = [(max(1, record['nprocs']), record['wall_time'])
+                    for (other_key, record) in self.records.items()
+                    if self._same_job(key, other_key)]
+        if not points:
+            return None
+        nprocs = max(1, nprocs)
+        if len(compat.compat_set(point[0] for point in points)) > 1:
+            inv_nprocs = [1.0/point[0] for point in points]
+            mean_inv = sum(inv_nprocs)/len(points)
+            mean_time = sum(point[1] for point in points)/len(points)
+            parallel = (sum((inv - mean_inv)*(point[1] - mean_time)
+                            for (inv, point) in zip(inv_nprocs, points)) /
+                        sum((inv - mean_inv)**2 for inv in inv_nprocs))
+            parallel = max(0.0, parallel)
+            serial = max(0.0, mean_time - parallel*mean_inv)
+            return serial + parallel/nprocs
+        else:
+            points.sort(key=lambda point: abs(point[0] - nprocs))
+            return points[0][1]*points[0][0]/nprocs
+
+    def default_wall_time(self):
+        '''Return the estimated wall time of a job which has never been run.'''
+        if self.records:
+            return (sum(record['wall_time']
+                        for record in self.records.values()) /
+                    len(self.records))
+        else:
+            return DEFAULT_WALL_TIME
+
+    def estimate(self, test):
+        '''Return the estimated wall time of running all the jobs in a test.'''
+        default = None
+        total = 0.0
+        for (input_file, args) in test.inputs_args:
+            wall_time = self.wall_time(test.path, input_file, args,
+                                       test.nprocs, test.nthreads)
+            if wall_time is None:
+                if default is None:
+                    default = self.default_wall_time()
+                wall_time = default
+            total += wall_time
+        return total
+
+    def save(self):
+        '''Write the history to disk.
+
+The history is written to a temporary file which then replaces the history
+file, so the history file is never left incomplete if testcode is interrupted
+or several instances of testcode save the history at the same time.'''
+        self.lock.acquire()
+        try:
+            records = sorted(self.records.values(),
+                    key=lambda record: (record['path'], record['input'],
+                                        record['args'], record['nprocs'],
+                                        record['nthreads']))
+            tmp_filename = '%s.tmp.%s' % (self.filename, os.getpid())
+            try:
+                history_file = open(tmp_filename, 'w')
+                try:
+                    json.dump(records, history_file, indent=1, sort_keys=True)
+                finally:
+                    history_file.close()
+                os.rename(tmp_filename, self.filename)
+            finally:
+                # Only left behind if writing or renaming failed.
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+        finally:
+            self.lock.release()
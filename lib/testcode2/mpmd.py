@@ -0,0 +1,231 @@
+'''
+testcode2.mpmd
+--------------
+
+Co-launch small parallel tests using a single invocation of the parallel
+launcher in multiple program, multiple data (MPMD) mode, e.g.:
+
+    mpirun -np 2 sh -c 'cd t1 && ...' : -np 2 sh -c 'cd t2 && ...'
+
+This avoids paying the start-up cost of the launcher for each test.  All tests
+in a launch share MPI_COMM_WORLD, so the program being tested must split it
+(e.g. using MPI_Comm_split with the MPI_APPNUM attribute of MPI_COMM_WORLD)
+before doing any communication.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import os
+import pipes
+import sys
+
+import testcode2
+import testcode2.exceptions as exceptions
+import testcode2.pack as pack
+import testcode2.process as process
+import testcode2.scheduler as scheduler
+import testcode2.util as util
+
+def can_colaunch(test):
+    '''Return true if test can be co-launched with other tests.
+
+Only tests which run a single job in parallel using a launcher which takes the
+number of processors (tc.nprocs in launch_parallel) can be co-launched.  Only
+tests using the same launcher and number of threads are co-launched
+together.'''
+    return (test.nprocs > 0 and len(test.inputs_args) == 1 and
+            test.test_program.mpmd_launcher() is not None)
+
+def launch_groups(groups, nprocs):
+    '''Combine tests into launches which each use at most nprocs processors.
+
+groups: list of lists of tests, as passed to testcode2.scheduler.Scheduler.
+    Only tests which are in a group on their own and can be co-launched (see
+    can_colaunch) are combined.
+
+Tests using the same launcher and number of threads are packed together (see
+testcode2.pack.pack_tests).  Returns groups, with each set of tests which are
+co-launched replaced by a LaunchGroup object.'''
+    new_groups = []
+    launches = {}
+    for group in groups:
+        if len(group) == 1 and can_colaunch(group[0]):
+            key = (group[0].test_program.mpmd_launcher(),
+                   scheduler.test_nthreads(group[0]))
+            if key not in launches:
+                launches[key] = []
+            launches[key].append(group[0])
+        else:
+            new_groups.append(group)
+    for key in sorted(launches):
+        for tests in pack.pack_tests(launches[key], nprocs):
+            if len(tests) > 1:
+                new_groups.append([LaunchGroup(tests)])
+            else:
+                new_groups.append(tests)
+    return new_groups
+
+def mpmd_command(jobs, cpus=None):
+    '''Return the command which co-launches jobs.
+
+jobs: list of (test, input_file, args) tuples.
+cpus: list of CPU cores the jobs are bound to.
+
+The output and error files of each job are emptied before the jobs are
+launched, as the processes in each job append to them.'''
+    files = []
+    contexts = []
+    for (test, input_file, args) in jobs:
+        tp_ptr = test.test_program
+        for stem in ('test', 'error'):
+            files.append(os.path.join(test.path, util.testcode_filename(
+                    testcode2.FILESTEM[stem], tp_ptr.test_id, input_file,
+                    args)))
+        contexts.append(tp_ptr.mpmd_context(test.path, input_file, args,
+                                            test.nprocs, cpus, test.nthreads))
+    launcher = jobs[0][0].test_program.mpmd_launcher()
+    return '%s\n%s %s' % ('\n'.join(': > %s' % (pipes.quote(filename),)
+                                     for filename in files),
+                          launcher, ' : '.join(contexts))
+
+def _max_or_none(values):
+    '''Return the maximum of values or None if any value is not set.'''
+    if None in values:
+        return None
+    else:
+        return max(values)
+
+class LaunchGroup:
+    '''Tests which are co-launched using a single invocation of the parallel
+launcher.
+
+A LaunchGroup is scheduled in place of its tests (see
+testcode2.scheduler.Scheduler): it occupies the processors, memory and
+resources used by all the tests and is run using run_test.  Each test is still
+checked individually.
+
+tests: list of tests, each of which can be co-launched (see can_colaunch).
+'''
+    def __init__(self, tests):
+        self.tests = tests
+        self.name = ' '.join(test.name for test in tests)
+        self.path = tests[0].path
+        self.nprocs = sum(scheduler.test_nprocs(test) for test in tests)
+        # The number of processors used by each test is fixed by the launch
+        # and self.nprocs already includes the cores used by threads.
+        self.min_nprocs = self.max_nprocs = self.nprocs
+        self.nthreads = None
+        # All tests use the same number of threads (see launch_groups).
+        self.env = tests[0].environment()
+        self.inputs_args = [('', '')]
+        self.execution = 'local'
+        memory = [test.memory for test in tests if test.memory]
+        if memory:
+            self.memory = sum(memory)
+        else:
+            self.memory = None
+        self.resources = {}
+        for test in tests:
+            for (name, amount) in test.resources.items():
+                self.resources[name] = self.resources.get(name, 0) + amount
+        # Limits apply to the launch as a whole, so use the most generous.
+        self.timeout = _max_or_none([test.timeout for test in tests])
+        self.memory_limit = _max_or_none([test.memory_limit
+                                          for test in tests])
+        self.cpus = None
+        # Run times of co-launched tests are not meaningful for the tests run
+        # on their own, so are not recorded.
+        self.run_times = {}
+        self.cancelled = False
+
+    def run_test(self, verbose=1, cluster_queue=None, rundir=None,
+                 verify_pool=None, result_cache=None):
+        '''Co-launch the tests and check each of them.
+
+Arguments are as for testcode2.Test.run_test.  Tests whose output is in
+result_cache are not run.  cluster_queue must not be set: tests submitted to
+a queueing system cannot be co-launched.'''
+        jobs = []
+        cache_entries = {}
+        for test in self.tests:
+            (input_file, args) = test.inputs_args[0]
+            try:
+                (cmd, test_file) = test.job_command(input_file, args)
+            except exceptions.RunError:
+                test.job_failed(input_file, args, sys.exc_info()[1], verbose,
+                                rundir)
+                continue
+            test.move_old_output_files(verbose)
+            if result_cache:
+                cache_key = result_cache.job_key(test, input_file, args)
+                if cache_key and test.restore_cached_job(result_cache,
+                        cache_key, input_file, args, test_file, verbose):
+                    self._check(test, input_file, args, verbose, rundir,
+                                verify_pool)
+                    continue
+                elif cache_key:
+                    cache_entries[id(test)] = (result_cache, cache_key)
+            jobs.append((test, input_file, args, test_file))
+
+        if jobs and not self.cancelled:
+            cmd = mpmd_command([job[:3] for job in jobs], self.cpus)
+            if verbose > 2:
+                print('Co-launching %s tests using %s\n' % (len(jobs), cmd))
+            try:
+                job = process.start_job(cmd, self.path, self.cpus,
+                                        self.memory_limit, self.env)
+                (returncode, timed_out) = process.wait_job(job, self.timeout)
+            except exceptions.RunError:
+                for (test, input_file, args, test_file) in jobs:
+                    test.job_failed(input_file, args, sys.exc_info()[1],
+                                    verbose, rundir)
+                return
+            if not self.cancelled:
+                for (test, input_file, args, test_file) in jobs:
+                    try:
+                        if timed_out:
+                            err = ('Co-launched job exceeded the time limit '
+                                   'of %s seconds and was killed.'
+                                   % (self.timeout,))
+                            raise exceptions.RunError(err)
+                        if test.collect_job(input_file, args, test_file,
+                                            returncode, verbose, rundir):
+                            self._check(test, input_file, args, verbose,
+                                        rundir, verify_pool,
+                                        cache_entries.get(id(test)))
+                    except exceptions.RunError:
+                        test.job_failed(input_file, args, sys.exc_info()[1],
+                                        verbose, rundir)
+                    sys.stdout.flush()
+        if self.cancelled:
+            self.skip_remaining_jobs()
+
+    def _check(self, test, input_file, args, verbose, rundir, verify_pool,
+               cache_entry=None):
+        '''Check a job against the benchmark (using verify_pool if supplied).'''
+        if verify_pool:
+            verify_pool.verify(test, input_file, args, verbose, rundir,
+                               cache_entry)
+        else:
+            test.verify_job(input_file, args, verbose, rundir, cache_entry)
+
+    def cancel(self):
+        '''Stop running the tests.  See testcode2.Test.cancel.'''
+        self.cancelled = True
+        for test in self.tests:
+            test.cancel()
+
+    def skip_remaining_jobs(self):
+        '''Mark all jobs which have not been run as skipped.'''
+        for test in self.tests:
+            test.skip_remaining_jobs()
+
+    def get_status(self):
+        '''Get the number of passed and run jobs (etc) summed over the tests.
+See testcode2.Test.get_status.'''
+        status = {}
+        for test in self.tests:
+            for (key, count) in test.get_status().items():
+                status[key] = status.get(key, 0) + count
+        return status
@@ -0,0 +1,107 @@
+'''
+testcode2.node
+--------------
+
+Check tests against their benchmarks on the compute node which ran them.
+
+The test is pickled when the submit file is created and checked at the end of
+the job by running this module on the compute node:
+
+    python -m testcode2.node payload
+
+The status of each job in the test is written to a small JSON file in the test
+directory, which is all the submitting machine needs to read once the job has
+finished.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import json
+import os
+import pickle
+import sys
+
+import testcode2
+import testcode2.util as util
+import testcode2.validation as validation
+
+# Stems of the files containing the pickled test and the status of each job.
+PAYLOAD_FILESTEM = 'test.verify'
+STATUS_FILESTEM = 'test.status'
+
+def status_file(test, input_file, args):
+    '''Return the path to the file containing the status of a job in test.'''
+    return os.path.join(test.path, util.testcode_filename(STATUS_FILESTEM,
+            test.test_program.test_id, input_file, args))
+
+def write_payload(test, verbose=1):
+    '''Pickle test so it can be checked on the compute node.
+
+Any status files left over from a previous run of the test are removed.
+
+Returns the shell command which checks the test and writes the status files.'''
+    (input_file, args) = test.inputs_args[0]
+    payload = os.path.join(test.path, util.testcode_filename(PAYLOAD_FILESTEM,
+            test.test_program.test_id, input_file, args))
+    payload_file = open(payload, 'wb')
+    try:
+        pickle.dump(dict(test=test, filestem=testcode2.FILESTEM,
+                         verbose=verbose), payload_file)
+    finally:
+        payload_file.close()
+    for (input_file, args) in test.inputs_args:
+        if os.path.exists(status_file(test, input_file, args)):
+            os.remove(status_file(test, input_file, args))
+    return util.module_command('testcode2.node', payload)
+
+def write_status(test, input_file, args, status, msg):
+    '''Write the status of a job in test (and the message describing it).'''
+    filename = status_file(test, input_file, args)
+    # Write to a temporary file first so a partially-written status file is
+    # never read.
+    tmp_filename = '%s.tmp' % (filename,)
+    fstatus = open(tmp_filename, 'w')
+    try:
+        json.dump(dict(status=status.name(), message=str(msg)), fstatus)
+    finally:
+        fstatus.close()
+    os.rename(tmp_filename, filename)
+
+def read_status(test, input_file, args):
+    '''Read the status of a job in test written on the compute node.
+
+Returns (status, msg), where status is a testcode2.validation.Status object, or
+None if the status file does not exist or cannot be read.'''
+    try:
+        fstatus = open(status_file(test, input_file, args))
+        try:
+            result = json.load(fstatus)
+        finally:
+            fstatus.close()
+        return (validation.Status(name=result['status']), result['message'])
+    except (IOError, OSError, ValueError, KeyError, AttributeError):
+        return None
+
+def main(args):
+    '''Check a pickled test and write the status of each job.
+
+args: command-line arguments: the filename of the pickled test.
+'''
+    if len(args) != 1:
+        print('Usage: python -m testcode2.node payload')
+        return 1
+    payload_file = open(args[0], 'rb')
+    try:
+        payload = pickle.load(payload_file)
+    finally:
+        payload_file.close()
+    testcode2.FILESTEM.update(payload['filestem'])
+    test = payload['test']
+    for (input_file, args) in test.inputs_args:
+        (status, msg) = test.check_job(input_file, args, payload['verbose'])
+        write_status(test, input_file, args, status, msg)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
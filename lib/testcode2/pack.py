@@ -0,0 +1,139 @@
+'''
+testcode2.pack
+--------------
+
+Pack small tests into a single job submitted to a queueing system and run them
+concurrently within the processors allocated to the job.
+
+The tests in each job are run by running this module on the compute node:
+
+    python -m testcode2.pack manifest nprocs
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import os
+import pipes
+import signal
+import sys
+import time
+
+import testcode2.process as process
+import testcode2.scheduler as scheduler
+import testcode2.util as util
+
+def pack_tests(tests, nprocs):
+    '''Pack tests into groups which each use at most nprocs processors.
+
+Tests are placed in order of decreasing number of processors into the first
+group with enough processors left (first-fit decreasing).  Tests which use more
+than nprocs processors are placed into a group on their own.
+
+Returns a list of lists of tests.'''
+    order = sorted(range(len(tests)),
+                   key=lambda ind: (-scheduler.test_nprocs(tests[ind]), ind))
+    packs = []
+    free = []
+    for ind in order:
+        test_nprocs = scheduler.test_nprocs(tests[ind])
+        for (ipack, pack) in enumerate(packs):
+            if test_nprocs <= free[ipack]:
+                pack.append(tests[ind])
+                free[ipack] -= test_nprocs
+                break
+        else:
+            packs.append([tests[ind]])
+            free.append(nprocs - test_nprocs)
+    return packs
+
+def write_pack(manifest, tasks):
+    '''Write the script run by each task and the manifest listing them.
+
+manifest: filename of the manifest.  The script for task i is written to
+    manifest.task.i.
+tasks: list of (directory, nprocs, commands) tuples.  Each task runs the
+    commands in the directory using nprocs processors.
+'''
+    lines = []
+    for (ind, (path, nprocs, cmds)) in enumerate(tasks):
+        task_file = os.path.abspath('%s.task.%s' % (manifest, ind))
+        ftask = open(task_file, 'w')
+        ftask.write('cd %s\n%s\n' % (pipes.quote(path), cmds))
+        ftask.close()
+        lines.append('%s %s' % (max(1, nprocs), task_file))
+    fmanifest = open(manifest, 'w')
+    fmanifest.write('\n'.join(lines) + '\n')
+    fmanifest.close()
+
+def runner_command(manifest, nprocs):
+    '''Return the shell command which runs the tasks in manifest using nprocs
+processors.'''
+    return util.module_command('testcode2.pack', os.path.abspath(manifest),
+                               nprocs)
+
+class Task:
+    '''Task listed in a manifest.
+
+nprocs: number of processors used by the task.
+script: filename of the shell script run by the task.
+'''
+    def __init__(self, nprocs, script):
+        self.nprocs = nprocs
+        self.script = script
+        self.path = os.path.dirname(script)
+        self.nthreads = None
+        self.memory = None
+        self.resources = {}
+        self.cpus = None
+
+def read_manifest(manifest):
+    '''Return the list of Task objects in manifest.'''
+    tasks = []
+    fmanifest = open(manifest)
+    try:
+        for line in fmanifest:
+            if line.strip():
+                (nprocs, script) = line.strip().split(None, 1)
+                tasks.append(Task(int(nprocs), script))
+    finally:
+        fmanifest.close()
+    return tasks
+
+def run_tasks(tasks, nprocs):
+    '''Run tasks concurrently using at most nprocs processors at once.
+
+Tasks using the most processors are started first and smaller tasks are
+started in any idle processors (see testcode2.scheduler.Scheduler).'''
+    # A task larger than the allocation is run on its own.
+    nprocs = max([nprocs] + [task.nprocs for task in tasks])
+    task_scheduler = scheduler.Scheduler([[task] for task in tasks], nprocs,
+                                         'largest-first')
+    running = []
+    while not task_scheduler.finished():
+        for task in task_scheduler.dispatch():
+            cmd = 'sh %s' % (pipes.quote(task.script),)
+            running.append((task, process.start_job(cmd, task.path)))
+        time.sleep(0.1)
+        for (task, job) in list(running):
+            if job.poll() is not None:
+                process.unregister(job.pid)
+                running.remove((task, job))
+                task_scheduler.release(task)
+
+def main(args):
+    '''Run the tasks in a manifest.
+
+args: command-line arguments: the manifest filename and number of processors.
+'''
+    if len(args) != 2:
+        print('Usage: python -m testcode2.pack manifest nprocs')
+        return 1
+    # Exit (and so kill running tasks; see testcode2.process) if the job is
+    # removed from the queue.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    run_tasks(read_manifest(args[0]), int(args[1]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
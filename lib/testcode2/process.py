@@ -0,0 +1,228 @@
+'''
+testcode2.process
+-----------------
+
+Start, wait for and kill jobs run on the local machine.
+
+Each job is started in its own process group so that the job and any
+processes it starts (e.g. mpirun and the MPI ranks) can be killed together.
+All process groups which are still running when testcode exits (including on
+Ctrl-C) are killed.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import atexit
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import resource
+    _HAVE_RESOURCE = True
+except ImportError:
+    _HAVE_RESOURCE = False
+
+import testcode2.affinity as affinity
+import testcode2.exceptions as exceptions
+
+# Time (in seconds) to allow a process group to exit after being sent SIGTERM
+# before it is sent SIGKILL.
+KILL_GRACE = 5
+
+HAVE_PROCESS_GROUPS = hasattr(os, 'setsid') and hasattr(os, 'killpg')
+
+# Process group ids of running jobs.
+_RUNNING = set()
+_RUNNING_LOCK = threading.Lock()
+
+def register(pid):
+    '''Record that a job is running in the process group pid.'''
+    _RUNNING_LOCK.acquire()
+    try:
+        _RUNNING.add(pid)
+    finally:
+        _RUNNING_LOCK.release()
+
+def unregister(pid):
+    '''Record that the job in the process group pid has finished.'''
+    _RUNNING_LOCK.acquire()
+    try:
+        _RUNNING.discard(pid)
+    finally:
+        _RUNNING_LOCK.release()
+
+# Popen can place the child in a new session (and hence process group) without
+# running python code in the child (python 3.2+).  preexec_fn is not safe to
+# use in threaded programs, so is only used when there is no alternative.
+_HAVE_NEW_SESSION = sys.version_info >= (3, 2)
+
+def child_setup(cpus=None, memory_limit=None):
+    '''Return the function to be called in the child process before a job is run.
+
+If cpus is given, the child is bound to the list of CPU cores cpus.  If
+memory_limit is given, the address space of the child (and hence of each
+process it starts) is limited to memory_limit bytes.  The child is also placed
+in a new process group if Popen cannot do so itself (see popen_options).
+Returns None if there is nothing to set up (e.g. on Windows).'''
+    if not cpus or not affinity.HAVE_AFFINITY:
+        cpus = None
+    if not memory_limit or not _HAVE_RESOURCE:
+        memory_limit = None
+    setsid = HAVE_PROCESS_GROUPS and not _HAVE_NEW_SESSION
+    if not (setsid or cpus or memory_limit):
+        return None
+    def setup():
+        '''Set up the job's process.'''
+        if setsid:
+            os.setsid()
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        if memory_limit:
+            (soft, hard) = resource.getrlimit(resource.RLIMIT_AS)
+            if hard != resource.RLIM_INFINITY:
+                soft = min(memory_limit, hard)
+            else:
+                soft = memory_limit
+            resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+    return setup
+
+def popen_options(cpus=None, memory_limit=None):
+    '''Return the keyword arguments to pass to Popen to start a job in a new
+process group, bound to cpus and with the address space limited to
+memory_limit bytes.  See child_setup.'''
+    options = {}
+    if HAVE_PROCESS_GROUPS and _HAVE_NEW_SESSION:
+        options['start_new_session'] = True
+    setup = child_setup(cpus, memory_limit)
+    if setup:
+        options['preexec_fn'] = setup
+    return options
+
+def job_environment(env=None):
+    '''Return the environment of a job: the environment of testcode updated
+with the variables in the dictionary env, or None if env is empty.'''
+    if env:
+        job_env = dict(os.environ)
+        job_env.update(env)
+        return job_env
+    else:
+        return None
+
+def start_job(cmd, cwd, cpus=None, memory_limit=None, env=None):
+    '''Run cmd in the shell in directory cwd in a new process group.
+
+cpus: list of CPU cores to bind the job to.  Default: no binding.
+memory_limit: limit (in bytes) on the address space of each process in the
+    job.  Default: no limit.
+env: dictionary of environment variables to set for the job.  Default:
+    inherit the environment of testcode unchanged.
+
+Returns the subprocess.Popen object.'''
+    try:
+        job = subprocess.Popen(cmd, shell=True, cwd=cwd,
+                               env=job_environment(env),
+                               **popen_options(cpus, memory_limit))
+    except OSError:
+        # slightly odd syntax in order to be compatible with python 2.5
+        # and python 2.6/3
+        err = 'Execution of test failed: %s' % (sys.exc_info()[1],)
+        raise exceptions.RunError(err)
+    register(job.pid)
+    return job
+
+def _wait_until(job, deadline):
+    '''Wait until job has finished or deadline (in seconds since the epoch).
+
+Returns True if the job has finished.'''
+    if hasattr(subprocess, 'TimeoutExpired'):
+        # python 3.3+
+        try:
+            job.wait(max(0, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            pass
+    else:
+        delay = 0.01
+        while job.poll() is None and time.time() < deadline:
+            time.sleep(min(delay, max(0, deadline - time.time())))
+            # Increase polling interval to avoid using resources needed by
+            # the job whilst still responding quickly to short jobs.
+            delay = min(2*delay, 0.5)
+    return job.poll() is not None
+
+def wait_job(job, timeout=None):
+    '''Wait for a job started by start_job to finish.
+
+If the job has not finished within timeout seconds, then the job's process
+group is killed.
+
+Returns (returncode, timed_out).'''
+    timed_out = False
+    if timeout:
+        timed_out = not _wait_until(job, time.time() + timeout)
+        if timed_out and HAVE_PROCESS_GROUPS:
+            signal_group(job.pid, signal.SIGTERM)
+            deadline = time.time() + KILL_GRACE
+            # Reap the job so it is not counted as still running.
+            _wait_until(job, deadline)
+            kill_group(job.pid, max(0, deadline - time.time()))
+        elif timed_out:
+            job.kill()
+    returncode = job.wait()
+    unregister(job.pid)
+    return (returncode, timed_out)
+
+def signal_group(pid, sig):
+    '''Send signal sig to all processes in process group pid.'''
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        # Process group has already exited.
+        pass
+
+def group_running(pid):
+    '''Return True if any process in the process group pid is running.'''
+    try:
+        os.killpg(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def kill_groups(pids, grace=KILL_GRACE):
+    '''Kill the process groups pids.
+
+Each group is sent SIGTERM and then SIGKILL if it is still running after grace
+seconds.'''
+    if not HAVE_PROCESS_GROUPS:
+        return
+    for pid in pids:
+        signal_group(pid, signal.SIGTERM)
+    deadline = time.time() + grace
+    running = [pid for pid in pids if group_running(pid)]
+    while running and time.time() < deadline:
+        time.sleep(0.1)
+        running = [pid for pid in running if group_running(pid)]
+    for pid in running:
+        signal_group(pid, signal.SIGKILL)
+
+def kill_group(pid, grace=KILL_GRACE):
+    '''Kill the process group pid.  See kill_groups.'''
+    kill_groups([pid], grace)
+
+def kill_all(grace=KILL_GRACE):
+    '''Kill the process groups of all running jobs.'''
+    _RUNNING_LOCK.acquire()
+    try:
+        pids = list(_RUNNING)
+        _RUNNING.clear()
+    finally:
+        _RUNNING_LOCK.release()
+    kill_groups(pids, grace)
+
+# Don't leave jobs running (and using processors) after testcode has exited,
+# e.g. due to Ctrl-C.
+atexit.register(kill_all, 1)
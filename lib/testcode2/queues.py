@@ -9,34 +9,371 @@ Access to external queueing systems.
 '''
 
 import os.path
+import pipes
+import re
+import shlex
 import subprocess
 import sys
+import threading
 import time
 
 import testcode2.exceptions as exceptions
 
+# Jobs which have been submitted and have not yet finished.
+_SUBMITTED = set()
+_SUBMITTED_LOCK = threading.Lock()
+
+# Time (in seconds) between querying the queueing system for the status of
+# jobs.  The interval starts at POLL_MIN_INTERVAL and is multiplied by
+# POLL_BACKOFF after each query, up to POLL_MAX_INTERVAL, so that short jobs
+# are noticed quickly without querying the queueing system frequently whilst
+# waiting for long jobs.
+POLL_MIN_INTERVAL = 1.0
+POLL_MAX_INTERVAL = 30.0
+POLL_BACKOFF = 1.5
+# Number of consecutive failed queries of the queueing system (e.g. if it is
+# temporarily unavailable) after which all jobs being waited for are failed.
+POLL_MAX_FAILURES = 5
+
+# Maximum number of jobs submitted at the same time, so that the submit
+# command of the queueing system is not overwhelmed when many tests are
+# submitted concurrently.
+MAX_CONCURRENT_SUBMISSIONS = 8
+_SUBMIT_SEMAPHORE = threading.BoundedSemaphore(MAX_CONCURRENT_SUBMISSIONS)
+
+# Number of times a submission which failed due to a transient error (e.g. if
+# the queueing system is temporarily unavailable; see
+# QueueSystem.transient_errors) is retried and the time (in seconds) before the
+# first retry, which is doubled before each subsequent retry.
+SUBMIT_RETRIES = 4
+SUBMIT_RETRY_DELAY = 2.0
+
+# String in submit templates replaced with the number of processors used by
+# the job.
+NPROCS_PATTERN = 'testcode.nprocs'
+
+# QueuePoller objects, indexed by the command used to query the queue.
+_POLLERS = {}
+_POLLERS_LOCK = threading.Lock()
+
+def queue_system(name, user_options=None):
+    '''Return the QueueSystem object for the queueing system called name.
+
+user_options: dictionary of settings from the [user] section of the userconfig
+    file.  The submit_cmd, queue_cmd and cancel_cmd settings, if present,
+    override the commands used by the queueing system.
+'''
+    systems = dict((system.name.lower(), system)
+                    for system in (PBSQueueSystem, SlurmQueueSystem))
+    if name.lower() not in systems:
+        err = ('Queueing system not implemented: %s.  Available queueing '
+               'systems: %s.' % (name, ', '.join(sorted(systems))))
+        raise exceptions.TestCodeError(err)
+    commands = {}
+    if user_options:
+        for cmd in ('submit_cmd', 'queue_cmd', 'cancel_cmd'):
+            if user_options.get(cmd):
+                commands[cmd] = user_options[cmd]
+    return systems[name.lower()](**commands)
+
+class QueueSystem:
+    '''Interface to an external queueing system.
+
+Subclasses set the commands and the format of the output of the queue command
+for a specific queueing system.  The commands can be replaced (e.g. by local
+scripts for testing).
+
+:param string submit_cmd: command used to submit a job script.
+:param string queue_cmd: command which lists the status of all jobs.
+:param string cancel_cmd: command used to remove a job from the queue.
+'''
+    name = None
+    submit_cmd = []
+    queue_cmd = []
+    cancel_cmd = []
+    # Columns in the output of queue_cmd containing the job id and the status
+    # of each job and the status of jobs which have finished.  Jobs not listed
+    # in the output of queue_cmd are also assumed to have finished.
+    job_id_column = 0
+    status_column = 1
+    finished_status = None
+    # Option to submit_cmd to submit an array of jobs and the environment
+    # variable containing the index of each job in the array.
+    array_option = None
+    array_index_var = None
+    # Messages printed by submit_cmd (case insensitive regular expressions)
+    # which indicate a transient failure, after which the submission is
+    # retried.  Other failures (e.g. an invalid submit script, queue or
+    # account) are not retried.
+    transient_errors = [
+            'timed? ?out',
+            'connection (refused|reset|timed out)',
+            'cannot connect',
+            'unable to (contact|connect|communicate)',
+            'temporarily unavailable',
+            'try again',
+            ]
+    def __init__(self, submit_cmd=None, queue_cmd=None, cancel_cmd=None):
+        if submit_cmd:
+            self.submit_cmd = shlex.split(submit_cmd)
+        if queue_cmd:
+            self.queue_cmd = shlex.split(queue_cmd)
+        if cancel_cmd:
+            self.cancel_cmd = shlex.split(cancel_cmd)
+    def __str__(self):
+        return self.name
+    def submit_args(self, submit_file, ntasks=None):
+        '''Return the command to submit submit_file.
+
+If ntasks is given, the job is submitted as an array of ntasks jobs, indexed
+from 0.'''
+        cmd = list(self.submit_cmd)
+        if ntasks:
+            cmd.extend([self.array_option, '0-%s' % (ntasks-1)])
+        cmd.append(submit_file)
+        return cmd
+    def parse_job_id(self, output):
+        '''Return the job id from the output of submit_cmd.'''
+        return output.strip()
+    def transient_failure(self, output):
+        '''Return true if output from a failed submit_cmd indicates that the
+submission might succeed if retried.'''
+        for pattern in self.transient_errors:
+            if re.search(pattern, output, re.IGNORECASE):
+                return True
+        return False
+    def task_id(self, job_id, index):
+        '''Return the id of job index in the array job with id job_id.'''
+        raise NotImplementedError
+
+class PBSQueueSystem(QueueSystem):
+    '''Interface to PBS (Torque).'''
+    name = 'PBS'
+    submit_cmd = ['qsub']
+    # List each job in array jobs separately.
+    queue_cmd = ['qstat', '-t']
+    cancel_cmd = ['qdel']
+    job_id_column = 0
+    status_column = 4
+    finished_status = 'C'
+    array_option = '-t'
+    array_index_var = 'PBS_ARRAYID'
+    transient_errors = QueueSystem.transient_errors + [
+            'server (is )?busy',
+            'pbs_iff',
+            ]
+    def task_id(self, job_id, index):
+        '''Return the id of job index in the array job with id job_id.
+
+Array jobs have ids of the form 1234[].server and the job at index 3 has the id
+1234[3].server.'''
+        if '[]' in job_id:
+            return job_id.replace('[]', '[%s]' % (index,), 1)
+        else:
+            return '%s[%s]' % (job_id, index)
+
+class SlurmQueueSystem(QueueSystem):
+    '''Interface to SLURM.'''
+    name = 'SLURM'
+    submit_cmd = ['sbatch', '--parsable']
+    # List each job in array jobs separately and only print the job id and
+    # status.
+    queue_cmd = ['squeue', '--noheader', '--array', '--format=%i %t']
+    cancel_cmd = ['scancel']
+    job_id_column = 0
+    status_column = 1
+    finished_status = 'CD'
+    array_option = '--array'
+    array_index_var = 'SLURM_ARRAY_TASK_ID'
+    transient_errors = QueueSystem.transient_errors + [
+            'temporarily unable to accept job',
+            'slurm controller',
+            ]
+    def parse_job_id(self, output):
+        '''Return the job id from the output of submit_cmd.
+
+sbatch --parsable prints the job id, followed by the cluster name if running on
+a federated system.'''
+        return output.strip().split(';')[0]
+    def task_id(self, job_id, index):
+        '''Return the id of job index in the array job with id job_id.'''
+        return '%s_%s' % (job_id, index)
+
+def cancel_all():
+    '''Remove all jobs submitted by testcode which have not finished from the
+queue.'''
+    _SUBMITTED_LOCK.acquire()
+    try:
+        jobs = list(_SUBMITTED)
+        _SUBMITTED.clear()
+    finally:
+        _SUBMITTED_LOCK.release()
+    for job in jobs:
+        job.cancel()
+
+def get_poller(job):
+    '''Return the QueuePoller object used to wait for job to finish.
+
+A single poller is used for all jobs in the same queueing system.'''
+    system = job.system
+    key = (tuple(system.queue_cmd), system.job_id_column, system.status_column,
+           system.finished_status)
+    _POLLERS_LOCK.acquire()
+    try:
+        if key not in _POLLERS:
+            _POLLERS[key] = QueuePoller(*key)
+        return _POLLERS[key]
+    finally:
+        _POLLERS_LOCK.release()
+
+class QueuePoller:
+    '''Wait for jobs in a queueing system to finish.
+
+A single background thread queries the queueing system for the status of all
+jobs (rather than each waiting thread querying the queueing system) and wakes
+the threads waiting for jobs which have finished.  The thread only runs whilst
+there are jobs being waited for.
+
+:param list queue_cmd: command (and arguments) which lists the status of all
+    jobs.
+:param integer job_id_column: column in the output of queue_cmd containing the
+    job id.
+:param integer status_column: column in the output of queue_cmd containing the
+    status of the job.
+:param string finished_status: status of jobs which have finished.  Jobs not
+    listed in the output of queue_cmd are also assumed to have finished.
+'''
+    def __init__(self, queue_cmd, job_id_column, status_column,
+                 finished_status):
+        self.queue_cmd = list(queue_cmd)
+        self.job_id_column = job_id_column
+        self.status_column = status_column
+        self.finished_status = finished_status
+        self.interval = POLL_MIN_INTERVAL
+        self.lock = threading.Lock()
+        # Events of the threads waiting for each job, indexed by job id.
+        self.jobs = {}
+        # Errors encountered whilst waiting for jobs, indexed by job id.
+        self.errors = {}
+        # Number of consecutive failed queries of the queueing system.
+        self.failures = 0
+        self.thread = None
+    def wait(self, job_id):
+        '''Returns when the job with the given id has finished running.'''
+        event = threading.Event()
+        self.lock.acquire()
+        try:
+            # Several threads may wait for the same job (e.g. tests packed
+            # into a single job).
+            self.jobs.setdefault(job_id, []).append(event)
+            if self.thread is None:
+                self.interval = POLL_MIN_INTERVAL
+                self.thread = threading.Thread(target=self._run)
+                # daemonise so thread terminates when master dies
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
+        # Use a timeout rather than blocking indefinitely so that we remain
+        # responsive to TERM.
+        while not event.is_set():
+            event.wait(1)
+        self.lock.acquire()
+        try:
+            err = self.errors.get(job_id, None)
+        finally:
+            self.lock.release()
+        if err:
+            raise exceptions.RunError(err)
+    def running_jobs(self):
+        '''Return the set of ids of jobs which have not finished.
+
+Raises RunError if the queueing system cannot be queried.'''
+        # Don't ask the queueing system for the job itself but rather parse
+        # the output from all current jobs and look for the jobs in question.
+        # This works around the problem where the job_id is not a sufficient
+        # handle to query the system directly (e.g. on the CMTH cluster).
+        try:
+            qstat_popen = subprocess.Popen(self.queue_cmd,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE)
+            (qstat_out, qstat_err) = qstat_popen.communicate()
+        except OSError:
+            err = 'Error inspecting queue system: %s' % (sys.exc_info()[1],)
+            raise exceptions.RunError(err)
+        if qstat_popen.returncode != 0:
+            err = ('Error inspecting queue system: %s'
+                    % (qstat_err.decode('utf-8', 'replace'),))
+            raise exceptions.RunError(err)
+        running = set()
+        ncolumns = max(self.job_id_column, self.status_column) + 1
+        for line in qstat_out.decode('utf-8', 'replace').splitlines():
+            words = line.split()
+            if (len(words) >= ncolumns and
+                    words[self.status_column] != self.finished_status):
+                running.add(words[self.job_id_column])
+        return running
+    def poll(self):
+        '''Query the queueing system and wake threads waiting for jobs which
+have finished.
+
+If the query fails, the jobs remain registered until the next poll.  Only
+after POLL_MAX_FAILURES consecutive failed queries are all jobs being waited
+for marked as failed.'''
+        err = None
+        try:
+            running = self.running_jobs()
+            self.failures = 0
+        except exceptions.RunError:
+            self.failures += 1
+            if self.failures < POLL_MAX_FAILURES:
+                return
+            err = str(sys.exc_info()[1])
+            self.failures = 0
+        self.lock.acquire()
+        try:
+            for (job_id, events) in list(self.jobs.items()):
+                if err or job_id not in running:
+                    if err:
+                        self.errors[job_id] = err
+                    del self.jobs[job_id]
+                    for event in events:
+                        event.set()
+        finally:
+            self.lock.release()
+    def _run(self):
+        '''Poll the queueing system until no jobs are being waited for.'''
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+            self.lock.acquire()
+            try:
+                if not self.jobs:
+                    self.thread = None
+                    return
+                self.interval = min(POLL_MAX_INTERVAL,
+                                    self.interval*POLL_BACKOFF)
+            finally:
+                self.lock.release()
+
 class ClusterQueueJob:
     '''Interface to external queueing system.
 
 :param string submit_file: filename of submit script to be submitted to the
     queueing system.
-:param string system: name of queueing system.  Currently only an interface to
-    PBS is implemented.
+:param system: queueing system, either a QueueSystem object or the name of
+    a queueing system (see queue_system).
 '''
     def __init__(self, submit_file, system='PBS'):
         self.job_id = None
         self.submit_file = submit_file
+        if not isinstance(system, QueueSystem):
+            try:
+                system = queue_system(system)
+            except exceptions.TestCodeError:
+                raise exceptions.RunError(sys.exc_info()[1])
         self.system = system
-        if self.system == 'PBS':
-            self.submit_cmd = 'qsub'
-            self.queue_cmd = 'qstat'
-            self.job_id_column = 0
-            self.status_column = 4
-            self.finished_status = 'C'
-        else:
-            err = 'Queueing system not implemented: %s' % self.system
-            raise exceptions.RunError(err)
-    def create_submit_file(self, pattern, string, template):
+    def create_submit_file(self, pattern, string, template, nprocs=None):
         '''Create a submit file.
         
 Replace pattern in the template file with string and place the result in
@@ -45,6 +382,8 @@ self.submit_file.
 :param string pattern: string in template to be replaced.
 :param string string: string to replace pattern in template.
 :param string template: filename of file containing the template submit script.
+:param integer nprocs: if given, NPROCS_PATTERN in template is replaced with
+    nprocs.
 '''
         # get template
         if not os.path.exists(template):
@@ -55,44 +394,140 @@ self.submit_file.
         ftemplate.close()
         # replace marker with our commands
         submit = submit.replace(pattern, string)
+        if nprocs is not None:
+            submit = submit.replace(NPROCS_PATTERN, str(nprocs))
         # write to submit script
         fsubmit = open(self.submit_file, 'w')
         fsubmit.write(submit)
         fsubmit.close()
-    def start_job(self):
-        '''Submit job to cluster queue.'''
-        submit_cmd = [self.submit_cmd, self.submit_file]
+    def start_job(self, ntasks=None):
+        '''Submit job to cluster queue.
+
+:param integer ntasks: if given, submit the job as an array of ntasks jobs.  The
+    jobs in the array are waited for individually using task_job.
+'''
+        submit_cmd = self.system.submit_args(self.submit_file, ntasks)
+        # Submit from the directory containing the submit file, which the
+        # queueing system uses as the working directory of the job.
+        submit_dir = os.path.dirname(os.path.abspath(self.submit_file))
+        delay = SUBMIT_RETRY_DELAY
+        for attempt in range(SUBMIT_RETRIES+1):
+            _SUBMIT_SEMAPHORE.acquire()
+            try:
+                submit_popen = subprocess.Popen(submit_cmd, cwd=submit_dir,
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.STDOUT)
+                submit_out = submit_popen.communicate()[0].decode('utf-8')
+            except OSError:
+                # 'odd' syntax so exceptions work with python 2.5 and python
+                # 2.6/3.
+                err = 'Error submitting job: %s' % (sys.exc_info()[1],)
+                raise exceptions.RunError(err)
+            finally:
+                _SUBMIT_SEMAPHORE.release()
+            if submit_popen.returncode == 0:
+                break
+            elif not self.system.transient_failure(submit_out):
+                err = ('Error submitting job (exit status %s): %s'
+                       % (submit_popen.returncode, submit_out.strip()))
+                raise exceptions.RunError(err)
+            elif attempt < SUBMIT_RETRIES:
+                time.sleep(delay)
+                delay *= 2
+            else:
+                err = ('Error submitting job (exit status %s after %s '
+                       'attempts): %s' % (submit_popen.returncode,
+                                          SUBMIT_RETRIES+1, submit_out.strip()))
+                raise exceptions.RunError(err)
+        self.job_id = self.system.parse_job_id(submit_out)
+        if not ntasks:
+            _register(self)
+    def task_job(self, index):
+        '''Return a ClusterQueueJob object for job index in an array job.'''
+        job = ClusterQueueJob(self.submit_file, self.system)
+        job.job_id = self.system.task_id(self.job_id, index)
+        _register(job)
+        return job
+    def cancel(self):
+        '''Remove job from the cluster queue, killing it if it is running.'''
+        if not self.job_id:
+            return
         try:
-            submit_popen = subprocess.Popen(submit_cmd, stdout=subprocess.PIPE,
+            cancel_popen = subprocess.Popen(self.system.cancel_cmd +
+                                                [self.job_id],
+                                            stdout=subprocess.PIPE,
                                             stderr=subprocess.STDOUT)
-            submit_popen.wait()
-            self.job_id = submit_popen.communicate()[0].strip().decode('utf-8')
+            cancel_popen.communicate()
         except OSError:
-            # 'odd' syntax so exceptions work with python 2.5 and python 2.6/3.
-            err = 'Error submitting job: %s' % (sys.exc_info()[1],)
-            raise exceptions.RunError(err)
+            # Job will be left to run to completion; nothing more can be done.
+            pass
     def wait(self):
         '''Returns when job has finished running on the cluster.'''
-        running = True
-        # Don't ask the queueing system for the job itself but rather parse the
-        # output from all current jobs and look  gor the job in question. 
-        # This works around the problem where the job_id is not a sufficient
-        # handle to query the system directly (e.g. on the CMTH cluster).
-        qstat_cmd = [self.queue_cmd]
-        while running:
-            time.sleep(15)
-            qstat_popen = subprocess.Popen(qstat_cmd, stdout=subprocess.PIPE,
-                                           stderr=subprocess.PIPE)
-            qstat_popen.wait()
-            if qstat_popen.returncode != 0:
-                err = ('Error inspecting queue system: %s' %
-                                                      qstat_popen.communicate())
-                raise exceptions.RunError(err)
-            qstat_out = qstat_popen.communicate()[0]
-            # Assume job has finished unless it appears in the qstat output.
-            running = False
-            for line in qstat_out.splitlines():
-                words = line.split()
-                if words[self.job_id_column] == self.job_id:
-                    running = words[self.status_column] != self.finished_status
-                    break
+        try:
+            get_poller(self).wait(self.job_id)
+        finally:
+            _SUBMITTED_LOCK.acquire()
+            try:
+                _SUBMITTED.discard(self)
+            finally:
+                _SUBMITTED_LOCK.release()
+
+class ClusterArrayJob(ClusterQueueJob):
+    '''Array job running many tasks in a single submission to the queueing
+system.
+
+Each task is a shell script.  The submit file runs the task listed in
+a manifest file at the index of the job in the array.
+
+:param string directory: directory in which the submit file, manifest and task
+    scripts are placed.
+:param system: queueing system (see ClusterQueueJob).
+'''
+    def __init__(self, directory, system='PBS'):
+        ClusterQueueJob.__init__(self, os.path.join(directory, 'submit'),
+                                 system)
+        self.directory = directory
+        self.manifest = os.path.join(directory, 'manifest')
+        self.ntasks = 0
+    def create_submit_file(self, pattern, tasks, template, nprocs=None):
+        '''Create the submit file, manifest and task scripts.
+
+:param string pattern: string in template to be replaced.
+:param list tasks: list of (directory, commands) tuples.  Each task runs the
+    commands in the directory.
+:param string template: filename of file containing the template submit script.
+:param integer nprocs: number of processors used by each job in the array (see
+    ClusterQueueJob.create_submit_file).
+'''
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        task_files = []
+        for (ind, (path, cmds)) in enumerate(tasks):
+            task_file = os.path.join(self.directory, 'task.%s' % (ind,))
+            ftask = open(task_file, 'w')
+            ftask.write('cd %s\n%s\n' % (pipes.quote(path), cmds))
+            ftask.close()
+            task_files.append(os.path.abspath(task_file))
+        fmanifest = open(self.manifest, 'w')
+        fmanifest.write('\n'.join(task_files) + '\n')
+        fmanifest.close()
+        self.ntasks = len(tasks)
+        run_task = ('testcode_task=`sed -n "$((${%s}+1))p" %s`\n'
+                    'sh "$testcode_task"'
+                    % (self.system.array_index_var,
+                       pipes.quote(os.path.abspath(self.manifest))))
+        ClusterQueueJob.create_submit_file(self, pattern, run_task, template,
+                                           nprocs)
+    def start_job(self, ntasks=None):
+        '''Submit the array job to cluster queue.'''
+        if ntasks is None:
+            ntasks = self.ntasks
+        ClusterQueueJob.start_job(self, ntasks)
+
+def _register(job):
+    '''Record that job has been submitted and has not yet finished.'''
+    _SUBMITTED_LOCK.acquire()
+    try:
+        _SUBMITTED.add(job)
+    finally:
+        _SUBMITTED_LOCK.release()
@@ -0,0 +1,443 @@
+'''
+testcode2.scheduler
+-------------------
+
+Schedule tests to run concurrently within a fixed number of processors.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import time
+
+import testcode2.compatibility as compat
+import testcode2.exceptions as exceptions
+import testcode2.history as history
+
+# Policies for choosing which of the tests ready to run should be started
+# first.
+ORDERS = ('config', 'largest-first', 'smallest-first', 'history')
+
+# Settings of where a test is run in hybrid mode (see run_locally).
+EXECUTION_MODES = ('auto', 'local', 'queue')
+
+def test_nprocs(test):
+    '''Return the number of processors (cores) a test occupies whilst running.
+
+Each process of the test occupies a core for each thread it runs.'''
+    # test.nprocs is <1 when program is run in serial.
+    return max(1, test.nprocs)*test_nthreads(test)
+
+def test_nthreads(test):
+    '''Return the number of threads used by each process of a test.'''
+    return max(1, test.nthreads or 1)
+
+def nprocs_range(test):
+    '''Return the (minimum, maximum) number of processors a test can be run on
+if it is moldable and None otherwise.
+
+Only tests run in parallel (i.e. with nprocs > 0) whose min_nprocs and
+max_nprocs settings allow more than one number of processors are moldable.'''
+    if test.nprocs <= 0:
+        return None
+    lower = max(1, test.min_nprocs)
+    if lower >= test.max_nprocs:
+        return None
+    return (lower, test.max_nprocs)
+
+def test_resources(test):
+    '''Return the amount of each resource other than processors a test uses.
+
+Returns a dictionary of resource names and amounts.  The memory used by the
+test is included under the name memory.'''
+    resources = dict(test.resources)
+    if test.memory:
+        resources['memory'] = test.memory
+    return resources
+
+def run_locally(test, max_nprocs, max_time=None, history=None):
+    '''Return true if a test should be run locally rather than submitted to
+a queueing system in hybrid mode.
+
+Tests with execution set to local or queue are run accordingly.  Otherwise
+a test is run locally if it uses at most max_nprocs processors and, if max_time
+is given and run times of the test are recorded in history, it is expected to
+take at most max_time seconds.'''
+    if test.execution == 'local':
+        return True
+    elif test.execution == 'queue':
+        return False
+    if test_nprocs(test) > max_nprocs:
+        return False
+    if max_time is not None and history is not None:
+        recorded = [history.wall_time(test.path, input_file, args,
+                                      test.nprocs, test.nthreads)
+                    for (input_file, args) in test.inputs_args]
+        if None not in recorded and sum(recorded) > max_time:
+            return False
+    return True
+
+def count_failures(tests):
+    '''Return the number of jobs in tests which have failed.'''
+    return sum(test.get_status()['failed'] for test in tests)
+
+class Scheduler:
+    '''Backfilling scheduler for running tests within a budget of processors.
+
+The scheduler does not run tests itself.  Instead, dispatch returns the tests
+which can be started given the processors (and other resources) currently
+free and reserves them for the tests, and release returns the resources used
+by a test once it has finished.
+
+groups: list of lists of tests.  Tests within a group are run consecutively in
+    the given order (e.g. tests which write to the same output file); tests in
+    different groups may run concurrently.
+tot_nprocs: total number of processors available to run tests on.
+order: policy used to select between the tests which are ready to run.  One
+    of:
+        config: order in which the groups are supplied.
+        largest-first: tests using the most processors first.
+        smallest-first: tests using the fewest processors first.
+        history: tests expected to take the longest time first, based upon
+            the wall times recorded in history.
+    Whatever the policy, if a test cannot be started because not enough
+    processors or resources are free, smaller tests behind it are started
+    (backfilled) if they fit into the free processors and resources.
+history: testcode2.history.RuntimeHistory object.  Required if order is
+    history.
+core_pool: testcode2.affinity.CorePool object.  If supplied, each test is
+    given its own set of cores (test.cpus) from the pool when it is dispatched,
+    which are returned to the pool when it is released.
+capacities: dictionary of the total amount of each resource (memory, in bytes,
+    and named consumable resources) available.  Only resources given a
+    capacity limit which tests can run together; the amount of other resources
+    used by tests is not restricted.
+max_failures: number of failed jobs after which failure_limit_reached returns
+    true.  If less than 1, there is no limit.
+max_running: maximum number of tests which can run at the same time (e.g. the
+    number of jobs a user may have in a queueing system).  If less than 1,
+    there is no limit.
+moldable: if true, the number of processors each moldable test (see
+    nprocs_range) is run on is chosen when it is dispatched, within the
+    test's min_nprocs and max_nprocs, to reduce the time taken to run all
+    tests.  A test which does not fit into the free processors is started on
+    fewer processors if it is then expected to finish before it would if it
+    waited for enough processors to become free.  Once no tests are waiting,
+    the tests started are widened to use the processors which would otherwise
+    be idle, for as long as they are expected to run faster.  The wall time
+    of a test on a given number of processors is estimated from history (see
+    testcode2.history.RuntimeHistory.scaled_wall_time); tests with no history
+    are assumed to scale perfectly.  test.nprocs is set to the number of
+    processors chosen.
+'''
+    def __init__(self, groups, tot_nprocs, order='config', history=None,
+                 core_pool=None, capacities=None, max_failures=0,
+                 max_running=0, moldable=False):
+        if order not in ORDERS:
+            err = ('Unknown scheduling order: %s.  Allowed values: %s.'
+                    % (order, ', '.join(ORDERS)))
+            raise exceptions.TestCodeError(err)
+        if order == 'history' and history is None:
+            err = 'Runtime history is required to order tests by history.'
+            raise exceptions.TestCodeError(err)
+        self.order = order
+        self.history = history
+        self.core_pool = core_pool
+        self.tests = [test for group in groups for test in group]
+        self.max_failures = max_failures
+        self.max_running = max_running
+        self.moldable = moldable
+        self.cancelled = False
+        # Tests which have been started.  Only these can have failed.
+        self._started = []
+        # Estimated wall time of each test, indexed by id(test).
+        self._estimates = {}
+        # Number of processors each test would use if it were not moldable
+        # and the time each running moldable test was started and is expected
+        # to finish, indexed by id(test).
+        self._baseline = dict((id(test), test.nprocs) for test in self.tests)
+        self._expected_end = {}
+        self.tot_nprocs = tot_nprocs
+        self.free_nprocs = tot_nprocs
+        self.capacities = dict(capacities or {})
+        self.free = dict(self.capacities)
+        for group in groups:
+            for test in group:
+                for (name, amount) in test_resources(test).items():
+                    if amount > self.capacities.get(name, amount):
+                        err = ('Test in %s requires %s of resource %s but '
+                               'only %s is available.'
+                               % (test.path, amount, name,
+                                  self.capacities[name]))
+                        raise exceptions.TestCodeError(err)
+        # Groups of tests waiting to be run, each stored with the position of
+        # the group in the original list so the configuration order can be
+        # restored.
+        self._pending = [(ind, list(group))
+                            for (ind, group) in enumerate(groups) if group]
+        # Tests currently running, indexed by id(test) as tests which run in
+        # the same directory compare (and hash) equal.
+        self._running = {}
+
+    def _sort_key(self, item):
+        '''Sort key of a pending group, based upon the next test in the group.'''
+        (ind, group) = item
+        if self.order == 'largest-first':
+            return (-test_nprocs(group[0]), ind)
+        elif self.order == 'smallest-first':
+            return (test_nprocs(group[0]), ind)
+        elif self.order == 'history':
+            # Longest processing time first.  Tests in a group are run
+            # consecutively, so use the time remaining for the whole group.
+            return (-sum(self.estimate(test) for test in group), ind)
+        else:
+            return ind
+
+    def estimate(self, test):
+        '''Return the estimated wall time of a test.'''
+        if id(test) not in self._estimates:
+            self._estimates[id(test)] = self.history.estimate(test)
+        return self._estimates[id(test)]
+
+    def estimate_at(self, test, nprocs):
+        '''Return the estimated wall time of a test run on nprocs processors.'''
+        baseline = max(1, self._baseline.get(id(test), test.nprocs))
+        default = None
+        total = 0.0
+        for (input_file, args) in test.inputs_args:
+            wall_time = None
+            if self.history is not None:
+                wall_time = self.history.scaled_wall_time(test.path,
+                        input_file, args, nprocs, test.nthreads)
+            if wall_time is None:
+                if default is None:
+                    if self.history is not None:
+                        default = self.history.default_wall_time()
+                    else:
+                        default = history.DEFAULT_WALL_TIME
+                wall_time = default*baseline/max(1, nprocs)
+            total += wall_time
+        return total
+
+    def _wait_for(self, nprocs):
+        '''Return the estimated time until nprocs processors are free.'''
+        free_nprocs = self.free_nprocs
+        if free_nprocs >= nprocs:
+            return 0.0
+        now = time.time()
+        running = sorted((self._expected_end.get(key, now),
+                          test_nprocs(group[0]))
+                         for (key, (ind, group)) in self._running.items())
+        for (end, nprocs_used) in running:
+            free_nprocs += nprocs_used
+            if free_nprocs >= nprocs:
+                return max(0.0, end - now)
+        return 0.0
+
+    def _shrink(self, test):
+        '''Set the number of processors a moldable test is run on, reducing it
+below the number of processors requested if that gets the test finished
+sooner.'''
+        test.nprocs = self._baseline.get(id(test), test.nprocs)
+        nprocs_limits = nprocs_range(test)
+        if nprocs_limits is None or test_nprocs(test) <= self.free_nprocs:
+            return
+        (lower, upper) = nprocs_limits
+        upper = min(upper, self.free_nprocs//test_nthreads(test))
+        if upper < lower:
+            return
+        best = min(range(lower, upper+1),
+                   key=lambda nprocs: (self.estimate_at(test, nprocs), -nprocs))
+        baseline = test.nprocs
+        if (self.estimate_at(test, best) < self._wait_for(test_nprocs(test)) +
+                self.estimate_at(test, baseline)):
+            test.nprocs = best
+
+    def _widen(self, tests):
+        '''Increase the number of processors moldable tests are run on to use
+the free processors.
+
+A processor is repeatedly given to the test expected to take the longest until
+there are no free processors or no test would run faster.'''
+        widening = [test for test in tests if nprocs_range(test)]
+        while self.free_nprocs > 0 and widening:
+            test = max(widening,
+                       key=lambda other: self.estimate_at(other, other.nprocs))
+            if (test.nprocs >= nprocs_range(test)[1] or
+                    test_nthreads(test) > self.free_nprocs or
+                    self.estimate_at(test, test.nprocs + 1) >=
+                    self.estimate_at(test, test.nprocs)):
+                widening.remove(test)
+            else:
+                test.nprocs += 1
+                self.free_nprocs -= test_nthreads(test)
+
+    def _fits(self, test):
+        '''Return true if there are enough free resources to start test.'''
+        if self.max_running > 0 and len(self._running) >= self.max_running:
+            return False
+        if test_nprocs(test) > self.free_nprocs:
+            return False
+        for (name, amount) in test_resources(test).items():
+            if name in self.free and amount > self.free[name]:
+                return False
+        return True
+
+    def dispatch(self):
+        '''Reserve resources for and return the tests which can be started now.'''
+        started = []
+        self._pending.sort(key=self._sort_key)
+        waiting = []
+        for (ind, group) in self._pending:
+            test = group[0]
+            if self.moldable:
+                self._shrink(test)
+            nprocs = test_nprocs(test)
+            if self._fits(test):
+                self.free_nprocs -= nprocs
+                for (name, amount) in test_resources(test).items():
+                    if name in self.free:
+                        self.free[name] -= amount
+                self._running[id(test)] = (ind, group)
+                self._started.append(test)
+                started.append(test)
+                if self.moldable:
+                    # Needed by _shrink for the tests still to be dispatched;
+                    # updated below if the test is widened.
+                    self._expected_end[id(test)] = (time.time() +
+                            self.estimate_at(test, test.nprocs))
+            else:
+                waiting.append((ind, group))
+        self._pending = waiting
+        if (self.moldable and not waiting and
+                compat.compat_all(len(group) == 1 for (ind, group) in
+                                  self._running.values())):
+            # Nothing else left to run: use any idle processors.
+            self._widen(started)
+        for test in started:
+            if self.core_pool:
+                test.cpus = self.core_pool.acquire(test_nprocs(test))
+            if self.moldable:
+                self._expected_end[id(test)] = (time.time() +
+                        self.estimate_at(test, test.nprocs))
+        return started
+
+    def release(self, test):
+        '''Return the resources used by a test which has finished running.'''
+        (ind, group) = self._running.pop(id(test))
+        self._expected_end.pop(id(test), None)
+        self.free_nprocs += test_nprocs(test)
+        for (name, amount) in test_resources(test).items():
+            if name in self.free:
+                self.free[name] += amount
+        if self.core_pool and test.cpus:
+            self.core_pool.release(test.cpus)
+            test.cpus = None
+        if len(group) > 1:
+            # Next test in the group can now be run.
+            self._pending.append((ind, group[1:]))
+
+    def failures(self):
+        '''Return the number of jobs which have failed.'''
+        return count_failures(self._started)
+
+    def failure_limit_reached(self, others=()):
+        '''Return true if at least max_failures jobs have failed.
+
+others: other schedulers whose failed jobs also count towards the limit.'''
+        if self.max_failures < 1:
+            return False
+        nfailed = self.failures() + sum(other.failures() for other in others)
+        return nfailed >= self.max_failures
+
+    def cancel(self):
+        '''Stop starting tests.
+
+Running tests are cancelled (see testcode2.Test.cancel) but the caller is
+responsible for killing any jobs they are running.  Tests which have not been
+started are marked as skipped.  Returns the number of tests which were not
+started.'''
+        self.cancelled = True
+        not_started = [test for (ind, group) in self._pending
+                            for test in group]
+        self._pending = []
+        for (key, (ind, group)) in list(self._running.items()):
+            group[0].cancel()
+            not_started.extend(group[1:])
+            self._running[key] = (ind, group[:1])
+        for test in not_started:
+            test.skip_remaining_jobs()
+        return len(not_started)
+
+    def finished(self):
+        '''Return true if all tests have been run.'''
+        return not self._pending and not self._running
+
+def _compare():
+    '''Return the testcode2.compare module.
+
+Not imported at the top of the module, as testcode2.compare imports testcode2,
+which imports this module.'''
+    import testcode2.compare as compare
+    return compare
+
+class VerificationPool:
+    '''Bounded pool of threads for checking jobs against their benchmarks.
+
+This allows the processors used by a test to be released as soon as its jobs
+have finished running, rather than being held whilst data is extracted from
+the outputs and compared.  If concurrent.futures is not available, submitted
+functions are executed immediately instead.
+
+nworkers: maximum number of jobs to check concurrently.
+nprocesses: if greater than 1, jobs submitted using verify are checked in
+    a pool of nprocesses processes (see testcode2.compare), as extracting and
+    comparing data in threads is limited by the global interpreter lock.  The
+    status of each job is still recorded and printed by this process.
+'''
+    def __init__(self, nworkers, nprocesses=0):
+        if compat.futures:
+            self.executor = compat.futures.ThreadPoolExecutor(max(1, nworkers))
+        else:
+            self.executor = None
+        self.process_executor = None
+        if nprocesses > 1 and compat.futures:
+            self.process_executor = _compare().process_pool(nprocesses)
+        self.futures = []
+
+    def submit(self, func, *args):
+        '''Execute func(*args) in the pool.'''
+        if self.executor:
+            self.futures.append(self.executor.submit(func, *args))
+        else:
+            func(*args)
+
+    def verify(self, test, input_file, args, verbose=1, rundir=None,
+               cache_entry=None):
+        '''Check a job against its benchmark and record the result in the pool.
+See testcode2.Test.verify_job.'''
+        if self.process_executor:
+            self.submit(self._verify_in_process, test, input_file, args,
+                        verbose, rundir, cache_entry)
+        else:
+            self.submit(test.verify_job, input_file, args, verbose, rundir,
+                        cache_entry)
+
+    def _verify_in_process(self, test, input_file, args, verbose, rundir,
+                           cache_entry):
+        '''Check a job in the process pool and record the result.'''
+        (status, msg) = _compare().check_job(self.process_executor, test,
+                                          input_file, args, verbose)
+        test.record_job(input_file, args, status, msg, verbose, rundir,
+                        cache_entry)
+
+    def join(self):
+        '''Wait for all submitted functions to finish.
+
+Any exception raised by a submitted function is re-raised.'''
+        if self.executor:
+            self.executor.shutdown(True)
+            for future in self.futures:
+                future.result()
+        if self.process_executor:
+            self.process_executor.shutdown(True)
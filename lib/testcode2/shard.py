@@ -0,0 +1,135 @@
+'''
+testcode2.shard
+---------------
+
+Split tests into shards to be run on separate machines and combine the results.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import glob
+import json
+
+import testcode2.compatibility as compat
+import testcode2.exceptions as exceptions
+import testcode2.scheduler as scheduler
+import testcode2.validation as validation
+
+# Format of the default name of the results file written by each shard.
+# Hidden so that it is not matched by wildcards in jobconfig section names.
+RESULTS_FILE = '.testcode_results.shard-%s-of-%s.json'
+
+def parse_shard(spec):
+    '''Parse a shard specification in the format i/n.
+
+Returns (i, n), where shards are numbered from 1 to n.'''
+    try:
+        (index, nshards) = [int(val) for val in spec.split('/')]
+    except ValueError:
+        index = nshards = 0
+    if nshards < 1 or index < 1 or index > nshards:
+        err = ('Invalid shard: %s.  Format: i/n, where 1 <= i <= n.'
+                % (spec,))
+        raise exceptions.TestCodeError(err)
+    return (index, nshards)
+
+def test_cost(test, history=None):
+    '''Return the expected cost of running a test, in arbitrary units.
+
+The cost is the number of processors used by the test multiplied by the
+expected wall time of the test if any run times are recorded in history and by
+the number of jobs in the test otherwise.'''
+    if history is not None and history.records:
+        return scheduler.test_nprocs(test) * history.estimate(test)
+    else:
+        return scheduler.test_nprocs(test) * len(test.inputs_args)
+
+def select_shard(tests, index, nshards, history=None):
+    '''Return the tests in shard index (numbered from 1) of nshards.
+
+Tests are assigned to shards to balance the expected cost (see test_cost) of
+each shard, by assigning the most expensive remaining test to the shard with
+the lowest total cost.  The assignment depends only upon the tests and the
+history, so each shard selects a disjoint set of tests provided all shards use
+the same configuration files and history.  The runtime history recorded by
+each machine differs, so history should be a copy shared by all shards rather
+than the local history.  Tests in the shard are returned in their original
+order.'''
+    costs = [test_cost(test, history) for test in tests]
+    order = sorted(range(len(tests)),
+                   key=lambda ind: (-costs[ind], tests[ind].path,
+                                    tests[ind].name,
+                                    repr(tests[ind].inputs_args)))
+    loads = [0]*nshards
+    selected = []
+    for ind in order:
+        shard = loads.index(min(loads))
+        loads[shard] += costs[ind]
+        if shard == index-1:
+            selected.append(ind)
+    return [tests[ind] for ind in sorted(selected)]
+
+def _job_key(path, input_file, args, root):
+    '''Return the key identifying a job in a results file.'''
+    return (compat.relpath(path, root), input_file or '', args or '')
+
+def write_results(filename, tests, root, shard=None):
+    '''Write the status of each job in tests to filename (in JSON format).
+
+root: directory relative to which the test paths are stored, so results
+    produced on different machines can be combined.
+shard: (i, n) tuple identifying the shard the tests were run as part of.
+'''
+    jobs = []
+    for test in tests:
+        for (input_file, args) in test.inputs_args:
+            status = test.status[(input_file, args)]
+            if status:
+                (path, input_file, args) = _job_key(test.path, input_file,
+                                                    args, root)
+                jobs.append(dict(path=path, input=input_file, args=args,
+                                 status=status.name()))
+    results = dict(shard=shard, jobs=jobs)
+    results_file = open(filename, 'w')
+    try:
+        json.dump(results, results_file, indent=1, sort_keys=True)
+    finally:
+        results_file.close()
+
+def merge_results(tests, filenames, root):
+    '''Set the status of each job in tests from results files.
+
+filenames: list of results files (or glob patterns) written by write_results.
+root: directory relative to which the test paths are stored.
+
+Returns the number of jobs in tests which are not in any of the results files.'''
+    results = {}
+    nfiles = 0
+    for pattern in filenames:
+        for filename in sorted(glob.glob(pattern)):
+            nfiles += 1
+            try:
+                results_file = open(filename)
+                try:
+                    jobs = json.load(results_file)['jobs']
+                finally:
+                    results_file.close()
+            except (IOError, ValueError, KeyError):
+                err = 'Cannot read results file %s.' % (filename,)
+                raise exceptions.TestCodeError(err)
+            for job in jobs:
+                key = (job['path'], job['input'], job['args'])
+                results[key] = validation.Status(name=job['status'])
+    if not nfiles:
+        err = 'No results files found: %s.' % (', '.join(filenames),)
+        raise exceptions.TestCodeError(err)
+    not_checked = 0
+    for test in tests:
+        for (input_file, args) in test.inputs_args:
+            key = _job_key(test.path, input_file, args, root)
+            if key in results:
+                test._update_status(results[key], (input_file, args))
+            else:
+                not_checked += 1
+    return not_checked
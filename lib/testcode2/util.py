@@ -8,7 +8,11 @@ Utility functions.
 :license: modified BSD; see LICENSE for more details.
 '''
 
+import glob
+import locale
+import mmap
 import os.path
+import pipes
 import re
 import sys
 
@@ -34,6 +38,15 @@ def testcode_file_id(filename, stem):
     file_id = re.sub(r'\.args=.*', '', file_id)
     return file_id
 
+def glob_in_dir(ddir, pattern):
+    '''Return the files in ddir matching the glob pattern.
+
+The filenames are returned relative to ddir, as if the glob was performed in
+ddir.'''
+    # Escape any special characters in ddir so that only pattern is expanded.
+    escaped_dir = re.sub(r'([*?[])', r'[\1]', ddir)
+    return [compat.relpath(match, ddir)
+            for match in glob.glob(os.path.join(escaped_dir, pattern))]
 
 def try_floatify(val):
     '''Convert val to a float if possible.'''
@@ -42,42 +55,84 @@ def try_floatify(val):
     except ValueError:
         return val
 
-def extract_tagged_data(data_tag, filename):
-    '''Extract data from lines marked by the data_tag in filename.'''
+def _tagged_lines(data, tag):
+    '''Iterate over the lines in data which start with tag.
+
+data: raw (encoded) contents of a file, e.g. a bytes or mmap object.
+tag: encoded data tag.
+
+Spaces before the tag are ignored.  As when reading a file with universal
+newlines, lines may end in a line feed, a carriage return or both.  Each line is
+yielded from the tag onwards, without the line ending.'''
+    # ^ only matches after a line feed in multiline mode, so also allow lines
+    # to start after a carriage return.
+    tagged_line = re.compile(br'(?:^|(?<=\r)) *(%s[^\r\n]*)' % re.escape(tag),
+                             re.M)
+    for match in tagged_line.finditer(data):
+        yield match.group(1)
+
+def _parse_tagged_line(line):
+    '''Return the (key, value) pair of data in a line marked by a data tag.'''
+    words = line.split()
+    key = []
+    # name of data is string after the data_tag and preceeding the
+    # (numerical) data.  only use the first number in the line, with
+    # the key taken from all proceeding information.
+    for word in words[1:]:
+        val = try_floatify(word)
+        if val != word:
+            break
+        else:
+            key.append(word)
+    if key[-1] in ("=",':'):
+        key.pop()
+    key = '_'.join(key)
+    if key[-1] in ("=",':'):
+        key = key[:-1]
+    if not key:
+        key = 'data'
+    return (key, val)
+
+def iter_tagged_data(data_tag, filename):
+    '''Iterate over the data in lines marked by the data_tag in filename.
+
+Yields (key, value) pairs in the order they appear in the file.  The file is
+memory-mapped and searched for tagged lines in a single pass, so only the
+tagged lines are decoded and the memory used does not depend upon the size of
+the file.'''
     if not os.path.exists(filename):
         err = 'Cannot extract data: file %s does not exist.' % (filename)
         raise exceptions.AnalysisError(err)
-    data_file = open(filename)
-    # Data tag is the first non-space character in the line.
-    # e.g. extract data from lines:
-    # data_tag      Energy:    1.256743 a.u.
-    data_tag_regex = re.compile('^ *%s' % (re.escape(data_tag)))
+    # Decode tagged lines as open(filename) would.
+    encoding = locale.getpreferredencoding(False)
+    data_file = open(filename, 'rb')
+    try:
+        if os.fstat(data_file.fileno()).st_size == 0:
+            # Empty files cannot be memory-mapped.
+            return
+        data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Data tag is the first non-space character in the line.
+            # e.g. extract data from lines:
+            # data_tag      Energy:    1.256743 a.u.
+            for line in _tagged_lines(data, data_tag.encode(encoding)):
+                yield _parse_tagged_line(line.decode(encoding))
+        finally:
+            data.close()
+    finally:
+        data_file.close()
+
+def extract_tagged_data(data_tag, filename):
+    '''Extract data from lines marked by the data_tag in filename.
+
+Returns a dictionary of the data, where each value is a tuple of the data with
+that key, in the order it appears in the file.  See iter_tagged_data.'''
     data = {}
-    for line in data_file.readlines():
-        if data_tag_regex.match(line):
-            # This is a line containing info to be tested.
-            words = line.split()
-            key = []
-            # name of data is string after the data_tag and preceeding the
-            # (numerical) data.  only use the first number in the line, with
-            # the key taken from all proceeding information.
-            for word in words[1:]:
-                val = try_floatify(word)
-                if val != word:
-                    break
-                else:
-                    key.append(word)
-            if key[-1] in ("=",':'):
-                key.pop()
-            key = '_'.join(key)
-            if key[-1] in ("=",':'):
-                key = key[:-1]
-            if not key:
-                key = 'data'
-            if key in data:
-                data[key].append(val)
-            else:
-                data[key] = [val]
+    for (key, val) in iter_tagged_data(data_tag, filename):
+        if key in data:
+            data[key].append(val)
+        else:
+            data[key] = [val]
     # We shouldn't change the data from this point: convert entries to tuples.
     for (key, val) in data.items():
         data[key] = tuple(val)
@@ -235,3 +290,14 @@ def info_line(path, input_file, args, rundir):
         info_line += ' (arg(s): %s)' % (args)
     info_line += ': '
     return info_line
+
+def module_command(module, *args):
+    '''Return the shell command which runs a testcode2 module as a script.
+
+The command uses the same python interpreter and testcode2 library as the
+current process, so can be placed in a submit script run on a compute node.
+args are quoted and appended to the command.'''
+    lib_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cmd = ('PYTHONPATH=%s${PYTHONPATH:+:$PYTHONPATH} %s -m %s'
+            % (pipes.quote(lib_dir), pipes.quote(sys.executable), module))
+    return ' '.join([cmd] + [pipes.quote(str(arg)) for arg in args])
@@ -12,10 +12,40 @@ import re
 import sys
 import warnings
 
+try:
+    import numpy
+    _HAVE_NUMPY = True
+except ImportError:
+    _HAVE_NUMPY = False
+
 import testcode2.ansi as ansi
 import testcode2.compatibility as compat
 import testcode2.exceptions as exceptions
 
+# Minimum number of values of a parameter for the values to be compared using
+# numpy (if available) rather than one at a time.
+VECTORISE_MIN = 32
+# Integers no larger (in magnitude) than this, and the difference between two
+# such integers, are represented exactly by floats.
+_EXACT_INT_MAX = 2**52
+
+def _float_array(values):
+    '''Return values as a numpy array of floats.
+
+Returns None if any value is not a float or an integer which is exactly
+represented by a float, in which case the values must be compared one at a
+time.'''
+    for val in values:
+        if isinstance(val, bool):
+            return None
+        elif isinstance(val, float):
+            continue
+        elif isinstance(val, int) and abs(val) <= _EXACT_INT_MAX:
+            continue
+        else:
+            return None
+    return numpy.array(values, dtype=float)
+
 class Status:
     '''Enum-esque object for storing whether an object passed a comparison.
 
@@ -42,6 +72,13 @@ name: name of status (unknown, skipped, passed, partial, failed) to use.
                 self.status = self._failed
         else:
             self.status = self._unknown
+    def name(self):
+        '''Return the name of the stored status.
+
+The status can be recreated using Status(name=name).'''
+        for name in ('unknown', 'skipped', 'passed', 'partial', 'failed'):
+            if self.status == getattr(self, '_'+name):
+                return name
     def unknown(self):
         '''Return true if stored status is unknown.'''
         return self.status == self._unknown
@@ -209,6 +246,38 @@ strict: if true, then require numbers to be within both thresholds.
             msg = 'No relative tolerance set.  Passing without checking.'
         return (Status([passed]), msg)
 
+    def passed_mask(self, test_vals, benchmark_vals):
+        '''Compare arrays of test and benchmark values to within the tolerances.
+
+Requires numpy.  Returns a boolean numpy array which is true for each pair of
+values which passes (i.e. validate would return a passed status) or None if
+the values cannot be compared using numpy.  Values which do not pass must be
+compared using validate to find whether they failed or are only a warning.'''
+        test_arr = _float_array(test_vals)
+        bench_arr = _float_array(benchmark_vals)
+        if test_arr is None or bench_arr is None:
+            return None
+        # NaNs are compared as in validate, i.e. never pass.
+        old_settings = numpy.seterr(invalid='ignore', divide='ignore',
+                                    over='ignore')
+        try:
+            passed = ~(numpy.isnan(test_arr) | numpy.isnan(bench_arr))
+            diff = test_arr - bench_arr
+            if self.absolute:
+                passed &= numpy.abs(diff) < self.absolute
+            if self.relative:
+                bench_zero = bench_arr == 0
+                err = numpy.abs(diff / numpy.where(bench_zero, 1, bench_arr))
+                err[bench_zero & (diff == 0)] = 0
+                err[bench_zero & (diff != 0)] = float('Inf')
+                passed &= err < self.relative
+        finally:
+            numpy.seterr(**old_settings)
+        # A value only passes if it meets all tolerances which are set,
+        # regardless of strictness, so strictness only affects values which do
+        # not pass.
+        return passed
+
 
 def compare_data(benchmark, test, default_tolerance, tolerances,
         ignore_fields=None):
@@ -261,8 +330,22 @@ def compare_data(benchmark, test, default_tolerance, tolerances,
                 if len(tol_matches) > 1:
                     warnings.warn('Multiple tolerance regexes match.  '
                                   'Using %s.' % (param_tol.name))
-        for bench_value, test_value in zip(benchmark[param], test[param]):
-            key_status, err = param_tol.validate(test_value, bench_value, param)
+        nvals = min(len(benchmark[param]), len(test[param]))
+        passed = None
+        if _HAVE_NUMPY and nvals >= VECTORISE_MIN:
+            passed = param_tol.passed_mask(test[param][:nvals],
+                                           benchmark[param][:nvals])
+        if passed is None:
+            indices = range(nvals)
+        else:
+            # Only values which did not pass need to be compared individually
+            # to get their status and error message.
+            if passed.any():
+                status += Status([True])
+            indices = numpy.flatnonzero(~passed)
+        for ind in indices:
+            key_status, err = param_tol.validate(test[param][ind],
+                                                 benchmark[param][ind], param)
             status += key_status
             if not key_status.passed() and err:
                 msg.append(err)
@@ -0,0 +1,148 @@
+'''Tests of the caches of job output and extracted data.'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import testutil
+
+import testcode2.cache as cache
+import testcode2.compatibility as compat
+
+class DummyProgram:
+    '''Settings of a test program used by ResultCache.job_key.'''
+    def __init__(self, exe):
+        self.exe = exe
+        self.run_cmd_template = 'tc.program tc.args tc.input > tc.output'
+        self.launch_parallel = 'mpirun -np tc.nprocs'
+        self.benchmark = ['bench']
+
+class DummyTest:
+    '''Settings of a test used by ResultCache.job_key.'''
+    def __init__(self, path, exe, nprocs=0):
+        self.path = path
+        self.test_program = DummyProgram(exe)
+        self.nprocs = nprocs
+        self.nthreads = None
+        self.output = None
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='testcode2-tests-')
+        self.cache = cache.ResultCache(os.path.join(self.directory, 'cache'))
+        self.exe = self.write('exe', 'program')
+        self.write('in.inp', 'input')
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+    def write(self, filename, contents):
+        '''Write contents to filename in the test directory.'''
+        path = os.path.join(self.directory, filename)
+        out = open(path, 'w')
+        try:
+            out.write(contents)
+        finally:
+            out.close()
+        return path
+    def key(self, nprocs=0, args=''):
+        '''Return the key of the job in the test directory.'''
+        return self.cache.job_key(DummyTest(self.directory, self.exe, nprocs),
+                                  'in.inp', args)
+    def test_key_unchanged(self):
+        self.assertEqual(self.key(), self.key())
+    def test_key_settings(self):
+        keys = [self.key(), self.key(nprocs=2), self.key(args='-v')]
+        self.assertEqual(len(compat.compat_set(keys)), 3)
+    def test_key_input(self):
+        key = self.key()
+        # Ensure the modification time changes as well as the contents.
+        time.sleep(0.01)
+        self.write('in.inp', 'new input')
+        self.assertNotEqual(key, self.key())
+    def test_key_exe(self):
+        key = self.key()
+        time.sleep(0.01)
+        self.write('exe', 'new program')
+        self.assertNotEqual(key, self.key())
+    def test_no_exe(self):
+        self.exe = os.path.join(self.directory, 'missing')
+        self.assertEqual(self.key(), None)
+    def test_store_restore(self):
+        self.write('test.out', 'output')
+        self.assertFalse(self.cache.restore('abcd', self.directory,
+                                            'restored.out', 'restored.err'))
+        self.cache.store('abcd', self.directory, 'test.out', 'test.err')
+        self.assertTrue(self.cache.restore('abcd', self.directory,
+                                           'restored.out', 'restored.err'))
+        self.assertEqual(open(os.path.join(self.directory,
+                                           'restored.out')).read(), 'output')
+        self.assertFalse(os.path.exists(os.path.join(self.directory,
+                                                     'restored.err')))
+    def test_prune(self):
+        self.write('test.out', 'x'*100)
+        data = os.path.join(self.cache.directory, cache.DATA_CACHE_DIR, 'ab')
+        os.makedirs(data)
+        self.write(os.path.join(data, 'abcd'), 'x'*1000)
+        for key in ('aa01', 'bb02', 'cc03'):
+            self.cache.store(key, self.directory, 'test.out', 'test.err')
+            time.sleep(0.01)
+        # Using an entry makes it the most recently used.
+        self.cache.restore('aa01', self.directory, 'restored.out',
+                           'restored.err')
+        self.cache.max_size = 250
+        self.cache.prune()
+        for (key, kept) in (('aa01', True), ('bb02', False), ('cc03', True)):
+            self.assertEqual(kept, self.cache.restore(key, self.directory,
+                                    'restored.out', 'restored.err'))
+        # Entries in the data cache are not part of the result cache.
+        self.assertTrue(os.path.exists(os.path.join(data, 'abcd')))
+
+class DataCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='testcode2-tests-')
+        self.cache = cache.DataCache(self.directory, 1024)
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+    def test_store_load(self):
+        self.assertEqual(self.cache.load('abcd'), None)
+        self.cache.store('abcd', {'val': (1.0,)})
+        self.assertEqual(self.cache.load('abcd'), {'val': (1.0,)})
+    def test_prune(self):
+        for key in ('aa01', 'bb02', 'cc03'):
+            self.cache.store(key, 'x'*500)
+            time.sleep(0.01)
+        self.cache.load('aa01')
+        self.cache.prune()
+        self.assertEqual(self.cache.load('bb02'), None)
+        self.assertEqual(self.cache.load('aa01'), 'x'*500)
+
+class CacheOptionTest(unittest.TestCase):
+    '''Jobs are only reused if --cache is given when running tests.'''
+    def setUp(self):
+        self.project = testutil.Project(['1'])
+    def tearDown(self):
+        self.project.remove()
+    def test_default(self):
+        for ind in range(2):
+            (ret_val, output) = self.project.run('run')
+            self.assertEqual(ret_val, 0)
+        self.assertEqual(self.project.nruns('t1'), 2)
+    def test_cache(self):
+        for ind in range(2):
+            (ret_val, output) = self.project.run('run', '--cache')
+            self.assertEqual(ret_val, 0)
+        self.assertEqual(self.project.nruns('t1'), 1)
+    def test_make_benchmarks(self):
+        (ret_val, output) = self.project.run('run', '--cache')
+        script = testutil.testcode_script()
+        compat_input = script.testcode2.compatibility.compat_input
+        script.testcode2.compatibility.compat_input = lambda prompt: 'new'
+        try:
+            self.project.run('make-benchmarks', '--cache')
+        finally:
+            script.testcode2.compatibility.compat_input = compat_input
+        self.assertEqual(self.project.nruns('t1'), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+'''Tests of stopping runs once the maximum number of failures is reached.'''
+
+import unittest
+
+import testutil
+
+class FailFastTest(unittest.TestCase):
+    '''The first of four tests fails immediately; the others pass slowly.'''
+    def setUp(self):
+        self.project = testutil.Project(['2', '1 0.5', '1 0.5', '1 0.5'])
+    def tearDown(self):
+        self.project.remove()
+    def check_fail_fast(self, *args):
+        '''Run the tests with --fail-fast and check the remaining tests are
+skipped.'''
+        (ret_val, output) = self.project.run('run', '--fail-fast',
+                                             '--total-processors=1', *args)
+        # The first test is checked after its processor is released, so the
+        # second test may already have been started (and then killed).
+        (passed, ran, skipped) = self.project.summary(output)
+        self.assertEqual(ret_val, 1)
+        self.assertEqual(passed, 0)
+        self.assertEqual(ran + skipped, 4)
+        self.assertTrue(skipped >= 2, output)
+    def test_threads(self):
+        self.check_fail_fast('--engine=threads')
+    def test_asyncio(self):
+        self.check_fail_fast('--engine=asyncio')
+    def test_serial(self):
+        (ret_val, output) = self.project.run('run', '--fail-fast')
+        self.assertEqual(ret_val, 1)
+        self.assertEqual(self.project.summary(output), (0, 1, 3))
+
+if __name__ == '__main__':
+    unittest.main()
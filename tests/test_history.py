@@ -0,0 +1,101 @@
+'''Tests of the runtime history.'''
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import testutil
+
+import testcode2.history as history
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='testcode2-tests-')
+        self.filename = os.path.join(self.directory, history.HISTORY_FILE)
+        self.history = history.RuntimeHistory(self.filename)
+        self.path = os.path.join(self.directory, 't1')
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+    def record(self, nprocs, wall_time, nthreads=None):
+        '''Record a run of the job in.inp in the test directory.'''
+        self.history.record(self.path, 'in.inp', '', nprocs, wall_time, 0,
+                            nthreads)
+    def test_wall_time(self):
+        self.assertEqual(self.history.wall_time(self.path, 'in.inp', '', 2),
+                         None)
+        self.record(2, 10.0)
+        self.record(8, 4.0)
+        self.assertEqual(self.history.wall_time(self.path, 'in.inp', '', 2),
+                         10.0)
+        # Closest number of processors.
+        self.assertEqual(self.history.wall_time(self.path, 'in.inp', '', 3),
+                         10.0)
+    def test_scaled_wall_time(self):
+        # t(n) = 2 + 8/n
+        self.record(1, 10.0)
+        self.record(2, 6.0)
+        self.record(4, 4.0)
+        self.assertAlmostEqual(
+                self.history.scaled_wall_time(self.path, 'in.inp', '', 8), 3.0)
+    def test_nthreads(self):
+        self.record(1, 10.0)
+        self.record(2, 6.0)
+        self.record(1, 1.0, nthreads=4)
+        self.record(2, 0.5, nthreads=4)
+        self.assertEqual(self.history.wall_time(self.path, 'in.inp', '', 1, 4),
+                         1.0)
+        self.assertAlmostEqual(
+                self.history.scaled_wall_time(self.path, 'in.inp', '', 4), 4.0)
+        self.assertAlmostEqual(
+                self.history.scaled_wall_time(self.path, 'in.inp', '', 4, 4),
+                0.25)
+        # No runs with this number of threads.
+        self.assertEqual(
+                self.history.scaled_wall_time(self.path, 'in.inp', '', 4, 2),
+                None)
+        # A single thread is the same as not setting the number of threads.
+        self.assertEqual(self.history.wall_time(self.path, 'in.inp', '', 1, 1),
+                         10.0)
+    def test_save(self):
+        self.record(1, 10.0)
+        self.record(1, 1.0, nthreads=4)
+        self.history.save()
+        self.assertEqual(os.listdir(self.directory), [history.HISTORY_FILE])
+        loaded = history.RuntimeHistory(self.filename)
+        self.assertEqual(loaded.records, self.history.records)
+    def test_save_replaces(self):
+        # Another instance of testcode holding the history file open still
+        # reads the complete previous history.
+        self.record(1, 10.0)
+        self.history.save()
+        old_file = open(self.filename)
+        try:
+            self.record(2, 6.0)
+            self.history.save()
+            self.assertEqual(len(json.load(old_file)), 1)
+        finally:
+            old_file.close()
+        self.assertEqual(len(history.RuntimeHistory(self.filename).records), 2)
+    def test_load_without_nthreads(self):
+        history_file = open(self.filename, 'w')
+        try:
+            json.dump([dict(path='t1', input='in.inp', args='', nprocs=2,
+                            wall_time=5.0, returncode=0, timestamp=0)],
+                      history_file)
+        finally:
+            history_file.close()
+        loaded = history.RuntimeHistory(self.filename)
+        self.assertEqual(loaded.wall_time(self.path, 'in.inp', '', 2), 5.0)
+        loaded.save()
+    def test_corrupt(self):
+        history_file = open(self.filename, 'w')
+        try:
+            history_file.write('[{"path": ')
+        finally:
+            history_file.close()
+        self.assertWarns(UserWarning, history.RuntimeHistory, self.filename)
+
+if __name__ == '__main__':
+    unittest.main()
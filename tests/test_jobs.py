@@ -0,0 +1,33 @@
+'''Tests of checking jobs in a pool of processes (--jobs).'''
+
+import unittest
+
+import testutil
+
+class JobsTest(unittest.TestCase):
+    '''Four tests, the first of which fails.'''
+    def setUp(self):
+        self.project = testutil.Project(['2', '1', '1', '1'])
+    def tearDown(self):
+        self.project.remove()
+    def check_run(self, *args):
+        '''Run the tests with the given arguments and check the results.'''
+        (ret_val, output) = self.project.run('run', '--total-processors=2',
+                                             '--jobs=2', *args)
+        self.assertEqual(ret_val, 1)
+        self.assertEqual(self.project.summary(output), (3, 4, 0))
+        return output
+    def test_run_threads(self):
+        self.check_run('--engine=threads')
+    def test_run_asyncio(self):
+        self.check_run('--engine=asyncio')
+    def test_compare(self):
+        self.check_run()
+        (ret_val, output) = self.project.run('compare', '--jobs=2')
+        self.assertEqual(ret_val, 1)
+        self.assertEqual(self.project.summary(output), (3, 4, 0))
+        # Results are printed in the same order as the tests.
+        self.assertTrue(output.index('t1 ') < output.index('t4 '), output)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+'''Tests of co-launching parallel tests (--mpmd).'''
+
+import unittest
+
+import testutil
+
+class MPMDTest(unittest.TestCase):
+    '''Four single-processor tests, the first of which fails.  The last two
+tests take longer to run.'''
+    def setUp(self):
+        self.project = testutil.Project(['2', '1', '1 0.5', '1 0.5'],
+                                        nprocs=1)
+    def tearDown(self):
+        self.project.remove()
+    def test_colaunch(self):
+        (ret_val, output) = self.project.run('run', '--mpmd=2',
+                                             '--total-processors=2')
+        self.assertEqual(ret_val, 1)
+        self.assertEqual(self.project.summary(output), (3, 4, 0))
+    def test_max_failures(self):
+        (ret_val, output) = self.project.run('run', '--mpmd=2',
+                                             '--total-processors=2',
+                                             '--max-failures=1')
+        # The first two tests are co-launched; the second launch is either not
+        # started or killed once the failure is found.
+        self.assertEqual(ret_val, 1)
+        self.assertEqual(self.project.summary(output), (1, 2, 2))
+
+if __name__ == '__main__':
+    unittest.main()
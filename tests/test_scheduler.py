@@ -0,0 +1,201 @@
+'''Tests of the backfilling scheduler.'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import testutil
+
+import testcode2
+import testcode2.exceptions as exceptions
+import testcode2.history as history
+import testcode2.scheduler as scheduler
+import testcode2.validation as validation
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='testcode2-tests-')
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+    def make_test(self, name, nprocs=1, njobs=1, min_nprocs=None,
+                  max_nprocs=None, **kwargs):
+        '''Return a test run on nprocs processors.
+
+The test is moldable only if min_nprocs or max_nprocs is given.'''
+        if min_nprocs is None:
+            min_nprocs = nprocs
+        if max_nprocs is None:
+            max_nprocs = nprocs
+        inputs_args = [('in%s.inp' % (ind,), '') for ind in range(njobs)]
+        return testcode2.Test(name, None, os.path.join(self.directory, name),
+                              nprocs=nprocs, min_nprocs=min_nprocs,
+                              max_nprocs=max_nprocs, inputs_args=inputs_args,
+                              **kwargs)
+    def names(self, tests):
+        return [test.name for test in tests]
+    def mark_failed(self, test):
+        '''Mark all jobs in test as failed.'''
+        for inp_arg in test.inputs_args:
+            test._update_status(validation.Status([False]), inp_arg)
+    def test_backfill(self):
+        tests = [self.make_test('a', 3), self.make_test('b', 2),
+                 self.make_test('c', 1)]
+        sched = scheduler.Scheduler([[test] for test in tests], 4)
+        # b does not fit alongside a, but c does.
+        self.assertEqual(self.names(sched.dispatch()), ['a', 'c'])
+        self.assertEqual(sched.free_nprocs, 0)
+        self.assertEqual(sched.dispatch(), [])
+        sched.release(tests[0])
+        self.assertEqual(self.names(sched.dispatch()), ['b'])
+        sched.release(tests[1])
+        sched.release(tests[2])
+        self.assertTrue(sched.finished())
+        self.assertEqual(sched.free_nprocs, 4)
+    def test_nthreads(self):
+        tests = [self.make_test('a', 2, nthreads=2), self.make_test('b', 1)]
+        sched = scheduler.Scheduler([[test] for test in tests], 4)
+        self.assertEqual(self.names(sched.dispatch()), ['a'])
+    def test_group(self):
+        tests = [self.make_test('a'), self.make_test('b')]
+        sched = scheduler.Scheduler([tests], 4)
+        self.assertEqual(self.names(sched.dispatch()), ['a'])
+        self.assertEqual(sched.dispatch(), [])
+        sched.release(tests[0])
+        self.assertEqual(self.names(sched.dispatch()), ['b'])
+    def test_orders(self):
+        groups = [[self.make_test(name, nprocs)]
+                  for (name, nprocs) in [('a', 2), ('b', 3), ('c', 1)]]
+        for (order, names) in [('config', ['a', 'b', 'c']),
+                               ('largest-first', ['b', 'a', 'c']),
+                               ('smallest-first', ['c', 'a', 'b'])]:
+            sched = scheduler.Scheduler(groups, 6, order=order)
+            self.assertEqual(self.names(sched.dispatch()), names)
+    def test_history_order(self):
+        tests = [self.make_test(name) for name in ['a', 'b', 'c']]
+        run_times = history.RuntimeHistory(
+                os.path.join(self.directory, history.HISTORY_FILE))
+        for (test, wall_time) in zip(tests, [1.0, 10.0, 5.0]):
+            run_times.record(test.path, 'in0.inp', '', test.nprocs, wall_time,
+                             0)
+        sched = scheduler.Scheduler([[test] for test in tests], 3,
+                                    order='history', history=run_times)
+        self.assertEqual(self.names(sched.dispatch()), ['b', 'c', 'a'])
+        self.assertRaises(exceptions.TestCodeError, scheduler.Scheduler,
+                          [tests], 3, order='history')
+    def test_unknown_order(self):
+        self.assertRaises(exceptions.TestCodeError, scheduler.Scheduler,
+                          [[self.make_test('a')]], 1, order='random')
+    def test_max_running(self):
+        tests = [self.make_test(name) for name in ['a', 'b', 'c']]
+        sched = scheduler.Scheduler([[test] for test in tests], 4,
+                                    max_running=2)
+        self.assertEqual(self.names(sched.dispatch()), ['a', 'b'])
+        sched.release(tests[1])
+        self.assertEqual(self.names(sched.dispatch()), ['c'])
+    def test_resources(self):
+        tests = [self.make_test('a', memory=3), self.make_test('b', memory=2),
+                 self.make_test('c', resources=dict(licence=1))]
+        sched = scheduler.Scheduler([[test] for test in tests], 4,
+                                    capacities=dict(memory=4))
+        # The licence has no capacity so is not limited.
+        self.assertEqual(self.names(sched.dispatch()), ['a', 'c'])
+        sched.release(tests[0])
+        self.assertEqual(self.names(sched.dispatch()), ['b'])
+        self.assertRaises(exceptions.TestCodeError, scheduler.Scheduler,
+                          [[self.make_test('d', memory=8)]], 4,
+                          capacities=dict(memory=4))
+    def test_failure_limit(self):
+        tests = [self.make_test(name, njobs=2) for name in ['a', 'b', 'c']]
+        sched = scheduler.Scheduler([[test] for test in tests], 2,
+                                    max_failures=3)
+        sched.dispatch()
+        self.mark_failed(tests[0])
+        self.assertEqual(sched.failures(), 2)
+        self.assertFalse(sched.failure_limit_reached())
+        # Failures of tests which have not been started do not count.
+        self.mark_failed(tests[2])
+        self.assertFalse(sched.failure_limit_reached())
+        other_tests = [self.make_test('d')]
+        other = scheduler.Scheduler([other_tests], 1)
+        other.dispatch()
+        self.mark_failed(other_tests[0])
+        self.assertTrue(sched.failure_limit_reached([other]))
+        self.mark_failed(tests[1])
+        self.assertTrue(sched.failure_limit_reached())
+    def test_no_failure_limit(self):
+        test = self.make_test('a')
+        sched = scheduler.Scheduler([[test]], 1)
+        sched.dispatch()
+        self.mark_failed(test)
+        self.assertFalse(sched.failure_limit_reached())
+    def test_cancel(self):
+        tests = [self.make_test(name, njobs=2) for name in ['a', 'b', 'c']]
+        sched = scheduler.Scheduler([tests[:2], tests[2:]], 1)
+        self.assertEqual(self.names(sched.dispatch()), ['a'])
+        self.assertEqual(sched.cancel(), 2)
+        self.assertTrue(tests[0].cancelled)
+        self.assertEqual(tests[0].get_status()['ran'], 0)
+        for test in tests[1:]:
+            self.assertEqual(test.get_status()['skipped'], 2)
+        self.assertEqual(sched.dispatch(), [])
+        sched.release(tests[0])
+        self.assertTrue(sched.finished())
+    def test_cancel_nothing_running(self):
+        # All pending tests are skipped even if nothing is running, after
+        # which the scheduler has finished.
+        tests = [self.make_test('a', 2), self.make_test('b', 2)]
+        sched = scheduler.Scheduler([[test] for test in tests], 2)
+        sched.dispatch()
+        sched.release(tests[0])
+        self.assertEqual(sched.cancel(), 1)
+        self.assertTrue(sched.finished())
+        self.assertEqual(sched.dispatch(), [])
+    def test_shrink(self):
+        # b waits for a (which has three jobs) to finish unless it is run on
+        # the two free processors, which gets it finished sooner.
+        tests = [self.make_test('a', 4, njobs=3),
+                 self.make_test('b', 4, min_nprocs=1)]
+        sched = scheduler.Scheduler([[test] for test in tests], 6,
+                                    moldable=True)
+        self.assertEqual(self.names(sched.dispatch()), ['a', 'b'])
+        self.assertEqual(tests[1].nprocs, 2)
+        self.assertEqual(sched.free_nprocs, 0)
+        sched.release(tests[1])
+        self.assertEqual(sched.free_nprocs, 2)
+    def test_no_shrink(self):
+        # b finishes no sooner on the two free processors than if it waits
+        # for a to finish.
+        tests = [self.make_test('a', 4), self.make_test('b', 4, min_nprocs=1)]
+        sched = scheduler.Scheduler([[test] for test in tests], 6,
+                                    moldable=True)
+        self.assertEqual(self.names(sched.dispatch()), ['a'])
+        sched.release(tests[0])
+        self.assertEqual(self.names(sched.dispatch()), ['b'])
+        self.assertEqual(tests[1].nprocs, 4)
+    def test_widen(self):
+        tests = [self.make_test('a', 2, min_nprocs=1, max_nprocs=16),
+                 self.make_test('b', 2, min_nprocs=1, max_nprocs=3)]
+        sched = scheduler.Scheduler([[test] for test in tests], 8,
+                                    moldable=True)
+        self.assertEqual(self.names(sched.dispatch()), ['a', 'b'])
+        self.assertEqual([test.nprocs for test in tests], [5, 3])
+        self.assertEqual(sched.free_nprocs, 0)
+    def test_no_widen_without_speedup(self):
+        test = self.make_test('a', 2, min_nprocs=1, max_nprocs=8)
+        run_times = history.RuntimeHistory(
+                os.path.join(self.directory, history.HISTORY_FILE))
+        for nprocs in [1, 2, 4]:
+            run_times.record(test.path, 'in0.inp', '', nprocs, 10.0, 0)
+        sched = scheduler.Scheduler([[test]], 8, history=run_times,
+                                    moldable=True)
+        sched.dispatch()
+        self.assertEqual(test.nprocs, 2)
+    def test_not_moldable(self):
+        test = self.make_test('a', 2, min_nprocs=1, max_nprocs=8)
+        sched = scheduler.Scheduler([[test]], 8)
+        sched.dispatch()
+        self.assertEqual(test.nprocs, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+'''Tests of splitting tests into shards.'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import testutil
+
+import testcode2.exceptions as exceptions
+import testcode2.history as history
+import testcode2.shard as shard
+
+class DummyTest:
+    '''Settings of a test used by select_shard.'''
+    def __init__(self, name, directory, njobs=1, nprocs=0):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.inputs_args = [('in%s.inp' % (ind,), '') for ind in range(njobs)]
+        self.nprocs = nprocs
+        self.nthreads = None
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='testcode2-tests-')
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+    def make_tests(self, njobs):
+        '''Return tests with the given number of jobs.'''
+        return [DummyTest('t%s' % (ind,), self.directory, test_njobs)
+                for (ind, test_njobs) in enumerate(njobs)]
+    def shards(self, tests, nshards, run_times=None):
+        '''Return the names of the tests in each of nshards shards.'''
+        shard_history = None
+        if run_times is not None:
+            shard_history = history.RuntimeHistory(
+                    os.path.join(self.directory, history.HISTORY_FILE))
+            for (test, wall_time) in zip(tests, run_times):
+                for (input_file, args) in test.inputs_args:
+                    shard_history.record(test.path, input_file, args,
+                                         test.nprocs, wall_time, 0)
+        return [[test.name for test in shard.select_shard(tests, index,
+                                                          nshards,
+                                                          shard_history)]
+                for index in range(1, nshards+1)]
+    def test_parse(self):
+        self.assertEqual(shard.parse_shard('2/3'), (2, 3))
+        for spec in ['0/3', '4/3', '1/0', '1', 'a/b']:
+            self.assertRaises(exceptions.TestCodeError, shard.parse_shard,
+                              spec)
+    def test_partition(self):
+        tests = self.make_tests([1, 3, 2, 1, 1, 4, 2])
+        shards = self.shards(tests, 3)
+        names = [name for names in shards for name in names]
+        self.assertEqual(sorted(names), sorted(test.name for test in tests))
+        # Tests keep their original order within each shard.
+        for names in shards:
+            self.assertEqual(names, sorted(names))
+    def test_deterministic(self):
+        tests = self.make_tests([1, 3, 2, 1, 1, 4, 2])
+        shards = self.shards(tests, 3)
+        reversed_shards = self.shards(list(reversed(tests)), 3)
+        self.assertEqual(shards, [sorted(names) for names in reversed_shards])
+    def test_balanced(self):
+        tests = self.make_tests([4, 3, 2, 2, 1])
+        costs = [sum(len(test.inputs_args) for test in tests
+                     if test.name in names)
+                 for names in self.shards(tests, 2)]
+        self.assertEqual(costs, [6, 6])
+    def test_nprocs(self):
+        tests = self.make_tests([1, 1, 1])
+        tests[0].nprocs = 2
+        self.assertEqual(self.shards(tests, 2), [['t0'], ['t1', 't2']])
+    def test_more_shards_than_tests(self):
+        shards = self.shards(self.make_tests([1, 1]), 3)
+        self.assertEqual(sorted(len(names) for names in shards), [0, 1, 1])
+    def test_history(self):
+        tests = self.make_tests([1, 1, 1])
+        # Without timings, the tests are balanced by number of jobs.
+        self.assertEqual(self.shards(tests, 2), [['t0', 't2'], ['t1']])
+        self.assertEqual(self.shards(tests, 2, [1.0, 1.0, 10.0]),
+                         [['t2'], ['t0', 't1']])
+    def test_empty_history(self):
+        tests = self.make_tests([1, 3, 2])
+        self.assertEqual(self.shards(tests, 2, []), self.shards(tests, 2))
+
+class ShardOptionTest(unittest.TestCase):
+    def setUp(self):
+        self.project = testutil.Project(['1', '1', '1', '1'])
+    def tearDown(self):
+        self.project.remove()
+    def test_missing_history(self):
+        self.assertRaises(exceptions.TestCodeError, self.project.run,
+                '--shard=1/2', '--shard-history',
+                os.path.join(self.project.directory, 'missing'))
+
+if __name__ == '__main__':
+    unittest.main()
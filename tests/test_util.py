@@ -0,0 +1,53 @@
+'''Tests of extracting data from output files.'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import testutil
+
+import testcode2.exceptions as exceptions
+import testcode2.util as util
+
+class TaggedDataTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='testcode2-tests-')
+        self.filename = os.path.join(self.directory, 'test.out')
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+    def write(self, contents):
+        '''Write contents (bytes) to the output file.'''
+        out = open(self.filename, 'wb')
+        try:
+            out.write(contents)
+        finally:
+            out.close()
+    def test_tagged_lines(self):
+        data = b'[T] a\n  [T] b\nx [T] c\n[T] d\r[T] e\r\n[T] f'
+        self.assertEqual(list(util._tagged_lines(data, b'[T]')),
+                         [b'[T] a', b'[T] b', b'[T] d', b'[T] e', b'[T] f'])
+    def test_tag_is_literal(self):
+        data = b'[T] a\nT b\n'
+        self.assertEqual(list(util._tagged_lines(data, b'[T]')), [b'[T] a'])
+    def test_extract(self):
+        self.write(b'header\n'
+                   b'[T] Energy: 1.5 a.u.\n'
+                   b'   [T] Energy = 2.5\r\n'
+                   b'not [T] Energy = 10\n'
+                   b'[T] Total energy 3\r'
+                   b'[T] Energy = 4.5\n')
+        self.assertEqual(list(util.iter_tagged_data('[T]', self.filename)),
+                         [('Energy', 1.5), ('Energy', 2.5),
+                          ('Total_energy', 3.0), ('Energy', 4.5)])
+        self.assertEqual(util.extract_tagged_data('[T]', self.filename),
+                         dict(Energy=(1.5, 2.5, 4.5), Total_energy=(3.0,)))
+    def test_empty(self):
+        self.write(b'')
+        self.assertEqual(util.extract_tagged_data('[T]', self.filename), {})
+    def test_missing(self):
+        self.assertRaises(exceptions.AnalysisError, util.extract_tagged_data,
+                          '[T]', self.filename)
+
+if __name__ == '__main__':
+    unittest.main()
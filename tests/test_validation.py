@@ -0,0 +1,87 @@
+'''Tests of comparing values to within tolerances.'''
+
+import unittest
+
+import testutil
+
+import testcode2.validation as validation
+
+# Pairs of (test, benchmark) values covering each branch of the comparisons.
+VALUES = [
+    (1.0, 1.0), (1.0, 1.05), (1.0, 1.5), (1.0, 3.0), (-1.0, 1.0),
+    (0.0, 0.0), (0.01, 0.0), (0.5, 0.0), (1.0e-8, 1.0e-8), (1.0e-8, 2.0e-8),
+    (100.0, 100.05), (100.0, 101.0), (100, 100), (100, 101),
+    (float('nan'), 1.0), (1.0, float('nan')),
+    (float('inf'), 1.0), (float('inf'), float('inf')),
+]
+
+TOLERANCES = [
+    validation.Tolerance(absolute=0.1),
+    validation.Tolerance(relative=0.1),
+    validation.Tolerance(absolute=0.1, relative=0.1),
+    validation.Tolerance(absolute=0.1, relative=0.1, strict=False),
+    validation.Tolerance(absolute=1.0e-10, relative=1.0e-3, strict=False),
+]
+
+@unittest.skipUnless(validation._HAVE_NUMPY, 'requires numpy')
+class PassedMaskTest(unittest.TestCase):
+    def test_matches_validate(self):
+        test_vals = [val[0] for val in VALUES]
+        bench_vals = [val[1] for val in VALUES]
+        for tolerance in TOLERANCES:
+            mask = tolerance.passed_mask(test_vals, bench_vals)
+            self.assertEqual(mask.shape, (len(VALUES),))
+            for (passed, (test_val, bench_val)) in zip(mask, VALUES):
+                (status, msg) = tolerance.validate(test_val, bench_val)
+                self.assertEqual(bool(passed), status.passed(),
+                        '%s: %s vs %s' % (tolerance, test_val, bench_val))
+    def test_not_comparable(self):
+        tolerance = validation.Tolerance(absolute=0.1)
+        self.assertEqual(tolerance.passed_mask(['a', 'b'], [1.0, 2.0]), None)
+        self.assertEqual(tolerance.passed_mask([1.0, True], [1.0, 1.0]), None)
+        self.assertEqual(tolerance.passed_mask([2**60+1], [2**60]), None)
+
+    def test_compare_data(self):
+        # Vectorised comparison gives the same result as comparing each value.
+        nvals = validation.VECTORISE_MIN
+        for (test_val, bench_val) in [(1.0, 1.05), (1.0, 3.0), (0.1, 0.15)]:
+            benchmark = dict(energy=tuple([1.0]*nvals + [bench_val]))
+            test = dict(energy=tuple([1.0]*nvals + [test_val]))
+            for tolerance in TOLERANCES:
+                vectorised = validation.compare_data(benchmark, test,
+                                                     tolerance, {})
+                validation._HAVE_NUMPY = False
+                try:
+                    scalar = validation.compare_data(benchmark, test,
+                                                     tolerance, {})
+                finally:
+                    validation._HAVE_NUMPY = True
+                self.assertEqual((vectorised[0], vectorised[1].name(),
+                                  vectorised[2]),
+                                 (scalar[0], scalar[1].name(), scalar[2]))
+
+class ValidateTest(unittest.TestCase):
+    def test_strict(self):
+        # Both tolerances must be met.
+        tolerance = validation.Tolerance(absolute=0.1, relative=0.01)
+        self.assertTrue(tolerance.validate(10.0, 10.05)[0].passed())
+        self.assertTrue(tolerance.validate(0.1, 0.15)[0].failed())
+        self.assertTrue(tolerance.validate(10.0, 10.2)[0].failed())
+    def test_not_strict(self):
+        # Meeting only one tolerance is a warning.
+        tolerance = validation.Tolerance(absolute=0.1, relative=0.01,
+                                         strict=False)
+        self.assertTrue(tolerance.validate(10.0, 10.05)[0].passed())
+        self.assertTrue(tolerance.validate(0.1, 0.15)[0].warning())
+        self.assertTrue(tolerance.validate(10.0, 10.2)[0].failed())
+    def test_strings(self):
+        tolerance = validation.Tolerance(absolute=0.1)
+        self.assertTrue(tolerance.validate('a', 'a')[0].passed())
+        self.assertTrue(tolerance.validate('a', 'b')[0].failed())
+    def test_nan(self):
+        tolerance = validation.Tolerance(absolute=0.1)
+        self.assertTrue(tolerance.validate(float('nan'),
+                                           float('nan'))[0].failed())
+
+if __name__ == '__main__':
+    unittest.main()
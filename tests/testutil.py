@@ -0,0 +1,141 @@
+'''
+testutil
+--------
+
+Helpers for the testcode2 test suite.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import importlib.util
+import io
+import os
+import re
+import shutil
+import stat
+import sys
+import tempfile
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'lib'))
+
+# Test program used by Project: the input file contains a value and,
+# optionally, the time (in seconds) to wait before printing the value, marked
+# with the data tag.  Each run is recorded in the file ran.
+PROGRAM = '''#!/bin/sh
+echo run >> ran
+read val delay < $1
+sleep ${delay:-0}
+echo "[T] val = $val"
+'''
+
+# Parallel launcher used by Project for parallel tests: runs each program in a
+# command line of the form [-np N] prog args [: [-np N] prog args ...] once,
+# ignoring the number of processors, and waits for them all to finish.
+MPIRUN = '''#!%s
+import subprocess
+import sys
+
+contexts = [[]]
+args = sys.argv[1:]
+while args:
+    arg = args.pop(0)
+    if arg == ':':
+        contexts.append([])
+    elif arg in ('-np', '-n'):
+        args.pop(0)
+    else:
+        contexts[-1].append(arg)
+jobs = [subprocess.Popen(context) for context in contexts]
+sys.exit(max(job.wait() for job in jobs))
+''' % (sys.executable,)
+
+_SCRIPT = None
+
+def testcode_script():
+    '''Return the bin/testcode.py script, imported as a module.'''
+    global _SCRIPT
+    if _SCRIPT is None:
+        spec = importlib.util.spec_from_file_location('testcode_script',
+                os.path.join(ROOT_DIR, 'bin', 'testcode.py'))
+        _SCRIPT = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_SCRIPT)
+    return _SCRIPT
+
+class Project:
+    '''Temporary directory containing a set of tests of PROGRAM.
+
+values: value written to the input file of each test, optionally followed by
+    the time the test takes to run.  Tests are called t1, t2, ... and each
+    benchmark contains the value 1, so tests with any other value fail.
+nprocs: number of processors each test is run on.  Parallel tests are run
+    using MPIRUN.
+'''
+    def __init__(self, values, nprocs=0):
+        self.directory = tempfile.mkdtemp(prefix='testcode2-tests-')
+        program = self._write_script('prog.sh', PROGRAM)
+        user = ['[user]', 'benchmark = bench', '', '[prog]',
+                'exe = %s' % (program,), 'data_tag = [T]']
+        if nprocs:
+            mpirun = self._write_script('mpirun.py', MPIRUN)
+            user.append('launch_parallel = %s -np tc.nprocs' % (mpirun,))
+        self._write('userconfig', '\n'.join(user))
+        self._write('jobconfig', '[t*]\ninputs_args = (\'in.inp\', \'\')\n'
+                                 'nprocs = %s\n' % (nprocs,))
+        self.tests = []
+        for (ind, value) in enumerate(values):
+            test = 't%s' % (ind+1,)
+            os.mkdir(os.path.join(self.directory, test))
+            self._write(os.path.join(test, 'in.inp'), '%s\n' % (value,))
+            self._write(os.path.join(test, 'benchmark.out.bench.inp=in.inp'),
+                        '[T] val = 1\n')
+            self.tests.append(test)
+    def _write(self, filename, contents):
+        '''Write contents to filename in the project directory.'''
+        out = open(os.path.join(self.directory, filename), 'w')
+        try:
+            out.write(contents)
+        finally:
+            out.close()
+    def _write_script(self, filename, contents):
+        '''Write an executable script and return its path.'''
+        self._write(filename, contents)
+        path = os.path.join(self.directory, filename)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        return path
+    def run(self, *args):
+        '''Run testcode.py with the given arguments on the project.
+
+Returns (return value, output).'''
+        args = ['--userconfig', os.path.join(self.directory, 'userconfig'),
+                '--jobconfig', os.path.join(self.directory, 'jobconfig')
+               ] + list(args)
+        out = io.StringIO()
+        old_stdout = sys.stdout
+        sys.stdout = out
+        try:
+            ret_val = testcode_script().main(args)
+        finally:
+            sys.stdout = old_stdout
+        return (ret_val, out.getvalue())
+    def nruns(self, test):
+        '''Return the number of times the program has been run in test.'''
+        try:
+            ran = open(os.path.join(self.directory, test, 'ran'))
+        except IOError:
+            return 0
+        try:
+            return len(ran.readlines())
+        finally:
+            ran.close()
+    def summary(self, output):
+        '''Return the number of tests which passed, ran and were skipped from
+the output of run.'''
+        match = re.search(r'(\d+) out of (\d+) tests? passed(?: \((\d+) '
+                          r'skipped\))?', output)
+        return tuple(int(val or 0) for val in match.groups())
+    def remove(self):
+        '''Remove the project directory.'''
+        shutil.rmtree(self.directory, True)